@@ -0,0 +1,112 @@
+"""
+Benchmark of the CSV import on a synthetic 384 well x 50 run CFX export.
+
+Compares the row by row parsing menqu used before (`iterrows`) with the grouped,
+vectorized `CSVImporter`. Run with
+
+    python benchmarks/bench_csv_import.py [runs]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas
+
+from menqu.data_importers import CSVImporter
+
+ROWS = "ABCDEFGHIJKLMNOP"
+GENES = ["GAPDH", "SOX2", "OCT4", "NANOG", "PAX6", "T", "SOX17", "HAND1"]
+
+
+def write_synthetic_export(directory, runs, seed=0):
+    rng = np.random.default_rng(seed)
+    wells = [f"{row}{column:02d}" for row in ROWS for column in range(1, 25)]
+    targets = [GENES[(column - 1) // 3] for row in ROWS for column in range(1, 25)]
+    samples = ["pluri" if row == "A" else str(ROWS.index(row)) for row in ROWS for column in range(1, 25)]
+
+    layout = pandas.DataFrame({"Well": wells, "Fluor": "SYBR", "Target": targets, "Content": "Unkn",
+                               "Sample": samples, "Biological Set Name": ""})
+    meta_path = os.path.join(directory, "meta.csv")
+    layout.to_csv(meta_path)
+
+    n = len(wells) * runs
+    cq = rng.uniform(15, 35, n)
+    cq[rng.random(n) < 0.02] = np.nan
+    data = pandas.concat([layout] * runs, ignore_index=True)
+    data["Cq"] = cq
+    data["Cq Mean"] = cq
+    data["Cq Std. Dev"] = 0.0
+    data["Starting Quantity (SQ)"] = np.nan
+    data_path = os.path.join(directory, "data.csv")
+    data.to_csv(data_path)
+    return meta_path, data_path
+
+
+def legacy_metadata_from_pandas(df):
+    well_to_identifier = {}
+    well_to_gene = {}
+    for _, row in df.iterrows():
+        well = row["Well"]
+        target = str(row["Target"])
+        sample = str(row["Sample"])
+        if target == "nan" and sample == "nan":
+            continue
+        well_to_gene[well] = target
+        well_to_identifier[well] = sample
+    return well_to_identifier, well_to_gene
+
+
+def legacy_data_matrix_from_pandas(df, well_to_gene, well_to_identifier, excluded_wells):
+    measurements = defaultdict(list)
+    for _, row in df.iterrows():
+        well = row["Well"]
+        if well in excluded_wells:
+            continue
+        m = row["Cq"]
+        if np.isnan(m):
+            continue
+        identifier = well_to_identifier.get(well, None)
+        gene = well_to_gene.get(well, None)
+        measurements[(identifier, gene)].append(m)
+    return measurements
+
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+
+def main(runs=50):
+    with tempfile.TemporaryDirectory() as directory:
+        meta_path, data_path = write_synthetic_export(directory, runs)
+
+        def legacy():
+            well_to_identifier, well_to_gene = legacy_metadata_from_pandas(pandas.read_csv(meta_path))
+            return legacy_data_matrix_from_pandas(pandas.read_csv(data_path), well_to_gene, well_to_identifier, [])
+
+        def vectorized():
+            importer = CSVImporter()
+            importer.read_meta(meta_path)
+            return importer.read_data(data_path).table({"GAPDH": "HK"}, {"pluri": "normalize"})
+
+        reference, legacy_time = timed(legacy)
+        table, vectorized_time = timed(vectorized)
+
+        for measurement in table:
+            expected = reference[(measurement.identifier, measurement.gene_name)]
+            assert measurement.data == expected, measurement
+        assert len(table) == len(reference)
+
+        print(f"{len(ROWS) * 24} wells x {runs} runs, {len(table)} (sample, gene) groups")
+        print(f"iterrows:   {legacy_time:8.3f} s")
+        print(f"vectorized: {vectorized_time:8.3f} s")
+        print(f"speedup:    {legacy_time / vectorized_time:8.1f} x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
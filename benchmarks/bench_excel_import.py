@@ -0,0 +1,168 @@
+"""
+Benchmark of the Excel import against an in-memory fake workbook.
+
+Counts the calls into the workbook made by the per cell reading menqu used before and by
+the block reads of `menqu.excel.Workbook`, and times both with a simulated round trip
+latency per call. The same is done for writing a coloured result sheet with
+`write_to_sheet`, where every cell used to be painted on its own. Run with
+
+    python benchmarks/bench_excel_import.py [latency in ms]
+"""
+
+import io
+import sys
+import time
+from contextlib import redirect_stdout
+
+from menqu.analysis import read_gene_mapping, read_setup, read_data, write_to_sheet, sort_measurements
+from menqu.excel import MemoryBackend, Workbook, parse_area
+
+GENES = [("GAPDH", "HK"), ("SOX2", None), ("OCT4", None), ("NANOG", None),
+         ("PAX6", None), ("T", None), ("SOX17", None), ("HAND1", None)]
+COLORS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
+          (0, 255, 255), (255, 0, 255), (128, 128, 128), (255, 128, 0)]
+
+
+def make_sheets():
+    setup = {}
+    for i, ((name, gene_type), color) in enumerate(zip(GENES, COLORS)):
+        setup[(21 + i, 1)] = (None, color)
+        setup[(21 + i, 2)] = (name, None)
+        setup[(21 + i, 3)] = (gene_type, None)
+    for row in range(2, 18):
+        for column in range(2, 26):
+            sample = "pluri" if row == 2 else float(row - 2)
+            setup[(row, column)] = (sample, COLORS[(column - 2) // 3])
+    sybr = {}
+    for row in range(4, 65, 4):
+        for column in range(3, 27):
+            sybr[(row, column)] = (15 + (row * column) % 20, None)
+    return {"Set Up": setup, "SYBR": sybr}
+
+
+class FakeCell:
+    def __init__(self, backend, sheet, row, column):
+        self._backend, self._sheet, self.row, self.column = backend, sheet, row, column
+
+    @property
+    def color(self):
+        return self._backend.read_color(self._sheet, (self.row, self.column, self.row, self.column))
+
+    @property
+    def value(self):
+        return self._backend.read_values(self._sheet, (self.row, self.column, self.row, self.column))[0][0]
+
+
+class FakeRange:
+    def __init__(self, backend, sheet, area):
+        self._backend, self._sheet, self._area = backend, sheet, area
+        self.columns = range(area[1], area[3] + 1)
+
+    def __iter__(self):
+        first_row, first_column, last_row, last_column = self._area
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                yield FakeCell(self._backend, self._sheet, row, column)
+
+    @property
+    def value(self):
+        values = self._backend.read_values(self._sheet, self._area)
+        return values[0] if len(values) == 1 else values
+
+
+class FakeSheet:
+    def __init__(self, backend, name):
+        self._backend, self.name = backend, name
+
+    def range(self, address):
+        return FakeRange(self._backend, self.name, parse_area(address))
+
+    __getitem__ = range
+
+
+class FakeBook:
+    """Mimics the parts of an xlwings book the old per cell import used"""
+
+    def __init__(self, backend):
+        self.sheets = {name: FakeSheet(backend, name) for name in backend.sheets}
+
+
+def legacy_read_setup(analysisbook, color_mapping):
+    plate_setup = analysisbook.sheets['Set Up']['B2:Y17']
+    identifier_mapping = {}
+    cell_values = plate_setup.value
+    for cell, value in zip(plate_setup, [x for row in cell_values for x in row]):
+        identifier_mapping[(cell.row-2, cell.column-2)] = (str(value), cell.color)
+    return identifier_mapping
+
+
+def legacy_read_gene_mapping(analysisbook):
+    cells = iter(analysisbook.sheets["Set Up"].range("A21:C100"))
+    color_mapping = {}
+    while True:
+        color = next(cells).color
+        name = next(cells).value
+        if name is None and color is None:
+            break
+        cell3 = next(cells)
+        gene_type = str(cell3.value) if cell3.value is not None else None
+        if name or gene_type:
+            color_mapping[color] = (name, gene_type)
+    return color_mapping
+
+
+def legacy_read_sybr(databook):
+    values = []
+    for number in range(4, 65, 4):
+        values.append([cell.value for cell in databook.sheets['SYBR'].range(f'C{number}:Z{number}')])
+    return values
+
+
+def legacy(backend):
+    book = FakeBook(backend)
+    color_mapping = legacy_read_gene_mapping(book)
+    identifier_mapping = legacy_read_setup(book, color_mapping)
+    legacy_read_sybr(book)
+    return color_mapping, identifier_mapping
+
+
+def blocks(backend):
+    workbook = Workbook(backend)
+    with redirect_stdout(io.StringIO()):
+        color_mapping = read_gene_mapping(workbook)
+        identifier_mapping = read_setup(workbook, color_mapping)
+        read_data(workbook, color_mapping, identifier_mapping, [])
+    return color_mapping, identifier_mapping
+
+
+def bench_write(latency_ms):
+    workbook = Workbook(MemoryBackend(make_sheets()))
+    with redirect_stdout(io.StringIO()):
+        color_mapping = read_gene_mapping(workbook)
+        data = sort_measurements(read_data(workbook, color_mapping, read_setup(workbook, color_mapping), []))
+
+    per_cell_calls = 1 + len(data) * (3 + data.n_replicates)
+    print(f"{'per cell':10s} {per_cell_calls:5d} calls {per_cell_calls * latency_ms / 1000:8.3f} s (estimated)")
+    for name, value_only in [("rectangles", False), ("values", True)]:
+        backend = MemoryBackend({}, latency=latency_ms / 1000)
+        start = time.perf_counter()
+        write_to_sheet(data, Workbook(backend).sheet("DDCT"), color_mapping, value_only=value_only)
+        print(f"{name:10s} {len(backend.calls):5d} calls {time.perf_counter() - start:8.3f} s")
+
+
+def main(latency_ms=5):
+    results = {}
+    print("reading setup and data")
+    for name, f in [("per cell", legacy), ("blocks", blocks)]:
+        backend = MemoryBackend(make_sheets(), latency=latency_ms / 1000)
+        start = time.perf_counter()
+        results[name] = f(backend)
+        print(f"{name:10s} {len(backend.calls):5d} calls {time.perf_counter() - start:8.3f} s")
+    assert results["per cell"] == results["blocks"]
+
+    print("writing a coloured sheet")
+    bench_write(latency_ms)
+
+
+if __name__ == "__main__":
+    main(*[float(arg) for arg in sys.argv[1:]])
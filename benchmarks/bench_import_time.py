@@ -0,0 +1,74 @@
+"""
+Startup import time of the `menqu` entry point, with a budget.
+
+Imports the modules the desktop app needs before its window appears (`menqu.cli` and
+`menqu.plot`; `menqu.services` adds pywebview) in fresh interpreters and reports the median
+wall time and the slowest modules of one run (`python -X importtime`). Exits with status 1 if
+the median is over the budget or a module that should only load on first use was imported.
+Run with
+
+    python benchmarks/bench_import_time.py [budget in seconds] [runs]
+"""
+
+import statistics
+import subprocess
+import sys
+
+MODULES = ["menqu.cli", "menqu.plot"]
+BUDGET = 1.0
+
+# loaded when first needed: Excel, export, console colours, the update check and the network
+LAZY = ["xlwings", "openpyxl", "selenium", "colr", "requests", "zmq"]
+
+CODE = f"""
+import sys, time
+start = time.perf_counter()
+{"; ".join(f"import {module}" for module in MODULES)}
+print(time.perf_counter() - start)
+print(" ".join(module for module in {LAZY!r} if module in sys.modules))
+"""
+
+
+def import_once():
+    result = subprocess.run([sys.executable, "-c", CODE], capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.splitlines()[-2:]
+    return float(seconds), loaded.split()
+
+
+def slowest_modules(n=10):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CODE], capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.append((int(cumulative), name.rstrip()))
+    return sorted(modules, reverse=True)[:n]
+
+
+def main(budget=BUDGET, runs=5):
+    budget, runs = float(budget), int(runs)
+    times, loaded = [], set()
+    for _ in range(runs):
+        seconds, modules = import_once()
+        times.append(seconds)
+        loaded.update(modules)
+    median = statistics.median(times)
+
+    print(f"import {', '.join(MODULES)}: median {median:.3f} s, min {min(times):.3f} s over {runs} runs, budget {budget:.3f} s")
+    print("slowest modules (cumulative):")
+    for cumulative, name in slowest_modules():
+        print(f"  {cumulative / 1e6:7.3f} s {name}")
+
+    failed = False
+    if median > budget:
+        print(f"FAILED: median import time {median:.3f} s is over the budget of {budget:.3f} s")
+        failed = True
+    if loaded:
+        print(f"FAILED: imported at startup although only needed later: {', '.join(sorted(loaded))}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
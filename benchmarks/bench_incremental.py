@@ -0,0 +1,70 @@
+"""
+Benchmark of toggling excluded wells on a synthetic 384 well CFX export.
+
+Excludes and includes again every well of the plate one after the other, once by importing
+the run again (as menqu did before) and once with `IncrementalAnalysis.set_excluded`, and
+checks that both give the same data. Run with
+
+    python benchmarks/bench_incremental.py [runs]
+"""
+
+import contextlib
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from menqu.data_importers import CSVImporter
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_csv_import import write_synthetic_export, ROWS
+
+
+def assert_same(a, b):
+    for name, column in a["gene_data"].items():
+        np.testing.assert_array_equal(np.asarray(column), np.asarray(b["gene_data"][name]))
+
+
+def main(runs=1):
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        meta_path, data_path = write_synthetic_export(directory, int(runs))
+        importer = CSVImporter()
+        importer.read_meta(meta_path)
+        importer.path_data = data_path
+        analysis = importer.analyse([], "GAPDH", "pluri", cache=None)
+
+        reimport, incremental, changed, full = [], [], [], 0
+        for well in [(row, column) for row in ROWS for column in range(1, 25)]:
+            for excluded_wells in ([well], []):
+                start = time.perf_counter()
+                try:
+                    reference = importer.import_(excluded_wells, "GAPDH", "pluri", cache=None)
+                except (KeyError, ZeroDivisionError, SystemExit):
+                    reference = None
+                reimport.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                try:
+                    rows = analysis.set_excluded(excluded_wells)
+                except ValueError:
+                    assert reference is None
+                    continue
+                incremental.append(time.perf_counter() - start)
+                assert_same(analysis.data, reference)
+                if rows is None:
+                    full += 1
+                else:
+                    changed.append(len(rows))
+
+    print(f"{len(incremental)} toggles, {full} needed the full analysis, "
+          f"{statistics.mean(changed):.1f} of {len(analysis.data['gene_data']['mean'])} rows changed on average")
+    print(f"import again  median {statistics.median(reimport) * 1e3:7.2f} ms")
+    print(f"incremental   median {statistics.median(incremental) * 1e3:7.2f} ms, max {max(incremental) * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,51 @@
+"""
+Benchmark of saving and loading a large session as version 1 (pickle) and version 2
+(columnar, memory mapped) `.menqu` file. Run with
+
+    python benchmarks/bench_menqu_file.py [rows]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from menqu.datasources import save_to_menqu_file, load_from_menqu_file
+
+
+def make_session(rows, replicates=3, seed=0):
+    rng = np.random.default_rng(seed)
+    gene_data = {f"R{i}": (2.0 ** -rng.uniform(15, 35, rows)).tolist() for i in range(1, replicates + 1)}
+    gene_data["mean"] = np.mean([gene_data[f"R{i}"] for i in range(1, replicates + 1)], axis=0).tolist()
+    gene_data["Sample"] = [str(i % 96) for i in range(rows)]
+    gene_data["Gene"] = [f"GENE{i % 40}" for i in range(rows)]
+    samples = [str(i) for i in range(96)]
+    return {"gene_data": gene_data, "condition_data": {"Sample": samples, "beating": ["True"] * 96},
+            "conditions": ["beating"], "genes": [f"GENE{i}" for i in range(40)], "samples": samples,
+            "colors": {"beating": "red"}, "name": "bench"}
+
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+
+def main(rows=1_000_000):
+    data = make_session(rows)
+    with tempfile.TemporaryDirectory() as directory:
+        for version in (1, 2):
+            path = os.path.join(directory, f"v{version}.menqu")
+            _, save_time = timed(lambda: save_to_menqu_file(data, path, version=version))
+            loaded, load_time = timed(lambda: load_from_menqu_file(path))
+            _, touch_time = timed(lambda: float(np.nanmax(loaded["gene_data"]["R1"])))
+            assert loaded["gene_data"]["Sample"] == data["gene_data"]["Sample"]
+            print(f"version {version}: {os.path.getsize(path) / 1e6:6.1f} MB, save {save_time:6.3f} s, "
+                  f"load {load_time:6.3f} s, first column access {touch_time:6.3f} s")
+            del loaded
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+"""
+Benchmark of re-importing a synthetic CFX export with the `ResultCache`.
+
+Imports the same run without cache, into an empty cache, again with the same settings (the
+result is reused) and with another normalizing sample and excluded wells (the parsed table
+is reused only for the former). Checks that cached and uncached imports give the same data.
+Run with
+
+    python benchmarks/bench_result_cache.py [runs]
+"""
+
+import contextlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from menqu.cache import ResultCache
+from menqu.data_importers import CSVImporter
+
+sys.path.insert(0, os.path.dirname(__file__))
+from bench_csv_import import write_synthetic_export
+
+
+def import_run(meta_path, data_path, excluded_wells, normalize, cache):
+    importer = CSVImporter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        importer.read_meta(meta_path)
+        importer.path_data = data_path
+        start = time.perf_counter()
+        data = importer.import_(excluded_wells, "GAPDH", normalize, cache=cache)
+    return data, time.perf_counter() - start
+
+
+def assert_same(a, b):
+    assert a.keys() == b.keys()
+    for name, column in a["gene_data"].items():
+        np.testing.assert_array_equal(np.asarray(column), np.asarray(b["gene_data"][name]))
+    assert a["genes"] == b["genes"] and a["samples"] == b["samples"]
+
+
+def main(runs=50):
+    logging.basicConfig(level=logging.INFO, format="  %(name)s: %(message)s")
+    with tempfile.TemporaryDirectory() as directory:
+        meta_path, data_path = write_synthetic_export(directory, int(runs))
+        cache = ResultCache(os.path.join(directory, "cache"))
+
+        steps = [("no cache", [], "pluri", None),
+                 ("empty cache", [], "pluri", cache),
+                 ("same settings", [], "pluri", cache),
+                 ("other normalizer", [], "1", cache),
+                 ("other exclusion", [("B", 1)], "pluri", cache)]
+        for name, excluded_wells, normalize, step_cache in steps:
+            data, seconds = import_run(meta_path, data_path, excluded_wells, normalize, step_cache)
+            reference, _ = import_run(meta_path, data_path, excluded_wells, normalize, None)
+            assert_same(data, reference)
+            print(f"{name:17s} {seconds:7.3f} s")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,67 @@
+"""
+Benchmark of building the main view and of updating it with new data, with only the visible
+tab drawn and kept up to date (as menqu does) and with all three result tabs active. Times
+include serializing the document, which is what the first render sends to the browser.
+Run with
+
+    python benchmarks/bench_root_widget.py [genes] [samples]
+"""
+
+import sys
+import time
+
+import numpy as np
+from bokeh.document import Document
+
+from menqu.helpers import mutate_bokeh
+from menqu.widgets import RootWidget
+
+
+class StandInApp:
+    rpc = None
+
+
+def make_data(genes, samples, replicates=3, seed=0):
+    rng = np.random.default_rng(seed)
+    gene_names = [f"GENE{i}" for i in range(genes)]
+    sample_names = [str(i) for i in range(samples)]
+    gene_data = {"Gene": [g for g in gene_names for _ in sample_names],
+                 "Sample": [s for _ in gene_names for s in sample_names]}
+    for i in range(1, replicates + 1):
+        gene_data[f"R{i}"] = rng.uniform(0, 4, genes * samples)
+    gene_data["mean"] = np.mean([gene_data[f"R{i}"] for i in range(1, replicates + 1)], axis=0)
+    return {"gene_data": gene_data, "genes": gene_names, "samples": sample_names,
+            "conditions": ["beating"], "condition_data": {"Sample": sample_names, "beating": ["True"] * samples},
+            "colors": {"beating": "red"}}
+
+
+def run(name, data, all_tabs):
+    start = time.perf_counter()
+    root_widget = RootWidget(StandInApp(), dict(data))
+    if all_tabs:
+        for widget in root_widget._tab_widgets:
+            widget.wake()
+    doc = Document()
+    doc.add_root(root_widget.root)
+    size = len(doc.to_json_string())
+    build = time.perf_counter() - start
+
+    new_gene_data = dict(data["gene_data"], mean=data["gene_data"]["mean"] * 2)
+    start = time.perf_counter()
+    for _ in range(5):
+        root_widget.update({"gene_data": new_gene_data})
+        # run the batched update now instead of on the next tick of a server
+        for scheduler in list(mutate_bokeh.schedulers.values()):
+            scheduler.flush()
+    update = (time.perf_counter() - start) / 5
+    print(f"{name:10s} build + serialize {build:6.3f} s ({size / 1e6:5.1f} MB), update {update:6.3f} s")
+
+
+def main(genes=120, samples=96):
+    data = make_data(int(genes), int(samples))
+    run("all tabs", data, all_tabs=True)
+    run("lazy tabs", data, all_tabs=False)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,130 @@
+"""
+Benchmark of the channel between the bokeh thread and the OS thread.
+
+Compares the REQ/REP socket menqu used before, polled with a one second receive timeout and
+guarded by an in-use flag, with the DEALER/ROUTER channel of `menqu.rpc`. The pywebview
+window is replaced by a stand-in whose file dialogs return at once. Measures the round trip
+latency of sequential calls, how many of a burst of concurrent calls get answered and how
+long stopping the OS thread takes. Run with
+
+    python benchmarks/bench_rpc.py [calls]
+"""
+
+import asyncio
+import statistics
+import sys
+import threading
+import time
+
+import zmq
+import zmq.asyncio
+
+from menqu.rpc import RPCClient, RPCServer
+
+LEGACY_ADDRESS = "tcp://127.0.0.1:21935"
+RPC_ADDRESS = "tcp://127.0.0.1:21936"
+
+
+class StandInWindow:
+
+    def create_file_dialog(self, dialog_type, directory, save_filename):
+        return [save_filename]
+
+
+class LegacyOSThread(threading.Thread):
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    def run(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.REP)
+        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        socket.bind(LEGACY_ADDRESS)
+        while not self._stopping:
+            try:
+                msg = socket.recv()
+            except zmq.error.Again:
+                continue
+            filename = "".join(self.window.create_file_dialog(None, ".", "test.menqu"))
+            socket.send(filename.encode("utf-8"))
+        socket.close(linger=0)
+        context.term()
+
+
+class LegacyClient:
+
+    def __init__(self, context):
+        self.socket = context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 1)
+        self.socket.connect(LEGACY_ADDRESS)
+        self._socket_in_use = False
+
+    async def call(self, method):
+        if self._socket_in_use:
+            return None
+        self._socket_in_use = True
+        await self.socket.send(method.encode("utf-8"))
+        file = await self.socket.recv()
+        self._socket_in_use = False
+        return file.decode("utf-8")
+
+
+class RPCOSThread(threading.Thread):
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.context = zmq.Context()
+        self.server = RPCServer(self.context, RPC_ADDRESS)
+        self.server.register("load_dialog", lambda: "".join(window.create_file_dialog(None, ".", "test.menqu")))
+
+    def stop(self):
+        self.server.stop()
+
+    def run(self):
+        self.server.serve_forever()
+        self.context.term()
+
+
+async def measure(client, calls, method):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await client.call(method)
+        latencies.append(time.perf_counter() - start)
+    burst = await asyncio.gather(*[client.call(method) for _ in range(100)])
+    return latencies, sum(result is not None for result in burst)
+
+
+def run(name, thread, make_client, method, calls):
+    thread.start()
+    context = zmq.asyncio.Context()
+    client = make_client(context)
+    latencies, answered = asyncio.run(measure(client, calls, method))
+
+    start = time.perf_counter()
+    thread.stop()
+    thread.join()
+    stop_time = time.perf_counter() - start
+    context.destroy(linger=0)
+
+    latencies = sorted(latencies)
+    print(f"{name:8s} median {statistics.median(latencies) * 1e6:7.0f} us, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.0f} us, "
+          f"burst of 100 answered {answered:3d}, stop {stop_time * 1e3:6.1f} ms")
+
+
+def main(calls=2000):
+    window = StandInWindow()
+    run("REQ/REP", LegacyOSThread(window), LegacyClient, "LOAD", calls)
+    run("RPC", RPCOSThread(window), lambda context: RPCClient(context, RPC_ADDRESS), "load_dialog", calls)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
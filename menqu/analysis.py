@@ -1,25 +1,31 @@
 import math
 import sys
-from collections import namedtuple
-from colr import color as make_color
 import click
 import os
 import tempfile
 import pickle
 
 from os.path import join as pjoin
-from menqu.updater import needs_update, update
+from menqu.updater import cached_needs_update, check_in_background, update
 import menqu
-from collections import defaultdict
 import numpy as np
+from menqu.measurements import Measurement, MeasurementTable, as_table, row_means
+from menqu.excel import as_workbook, as_sheet
 
 
-Measurement = namedtuple("Measurement", ["data", "gene_name", "gene_type", "identifier", "sample_type"])
 alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
-@click.command()
+def make_color(*args, **kwargs):
+    # colr is slow to import and only needed to print Excel cells
+    from colr import color
+    return color(*args, **kwargs)
+
+@click.group(invoke_without_command=True)
 @click.option("--update/--no-update", default=True)
-def main(update):
+@click.pass_context
+def main(ctx, update):
+    if ctx.invoked_subcommand is not None:
+        return
     if update:
         _update()
     app, databook, analysisbook = prepare()
@@ -28,8 +34,37 @@ def main(update):
 
     _main(app, databook, analysisbook, excluded_wells)
 
+@main.command()
+@click.argument("inputs", nargs=-1, required=True)
+@click.option("--manifest", type=click.Path(exists=True, dir_okay=False), help="CSV with per run settings.")
+@click.option("--output", "-o", default="menqu-results", show_default=True, help="Directory for the result CSVs.")
+@click.option("--processes", "-j", type=int, default=None, help="Number of worker processes, one per CPU by default.")
+@click.option("--setup", type=click.Path(exists=True, dir_okay=False), help="Default plate layout or analysis book.")
+@click.option("--exclude", default="", help="Default wells to exclude, ex: A1,B3")
+@click.option("--housekeeping", help="Default housekeeping gene of CSV runs.")
+@click.option("--normalize", help="Default normalizing sample of CSV runs.")
+def batch(inputs, manifest, output, processes, setup, exclude, housekeeping, normalize):
+    """Analyse all runs in INPUTS (files, directories or glob patterns) without Excel."""
+    from menqu.batch import collect_runs, read_manifest, run_batch
+
+    ignore = [manifest] if manifest else []
+    manifest = read_manifest(manifest) if manifest else {}
+    runs = collect_runs(inputs, output, manifest, setup, exclude, housekeeping, normalize, ignore)
+    if not runs:
+        raise click.ClickException("No data files found.")
+    summaries = run_batch(runs, output, processes)
+    failed = sum(summary["status"] != "ok" for summary in summaries)
+    print(f"{len(summaries) - failed} of {len(summaries)} runs analysed, results in {output}")
+    if failed:
+        sys.exit(1)
+
 def _update():
-    update_needed, url = needs_update(menqu.__version__)
+    """Update if the last update check found a newer version and check again in the background.
+
+    Only the cached answer is used, so this never waits for the network.
+    """
+    check_in_background(menqu.__version__)
+    update_needed, url = cached_needs_update(menqu.__version__)
     if update_needed:
         update(url)
 
@@ -37,11 +72,22 @@ def save_as_pickle(obj, name):
     with open(name, mode="wb") as f:
         pickle.dump(obj, f)
 
+def sort_measurements(data):
+    """Sort measurements by gene type, gene name and sample identifier"""
+    data = as_table(data)
+    order = data.argsort([
+        ("gene_type", lambda gene_type: str(gene_type) if gene_type else ''),
+        ("gene", lambda gene_name: str(gene_name) if gene_name else ''),
+        ("sample", lambda identifier: str(identifier).zfill(4) if identifier else ''),
+        ])
+    return data.take(order)
+
 def _main_csv(data):
+    data = as_table(data)
     check_data_validity(data)
-    data = sorted(data, key=lambda m: (str(m.gene_type) if m.gene_type else '', str(m.gene_name) if m.gene_name else '', str(m.identifier).zfill(4) if m.identifier else ''))
+    data = sort_measurements(data)
 
-    data = [m for m in data if any(m.data)]
+    data = data.take(data.has_data())
     print(data)
     housekeeping = calculate_housekeeping_normalisation(data)
     print(housekeeping)
@@ -51,19 +97,24 @@ def _main_csv(data):
     data = normalize_pluripotent(data, pluripotent)
     return data
 
-def _main(app, databook, analysisbook, excluded_wells):
+def read_workbooks(databook, analysisbook, excluded_wells):
+    """Read the gene colors, the plate setup and the sorted measurements of a databook and analysisbook"""
     color_mapping = read_gene_mapping(analysisbook)
     identifier_mapping = read_setup(analysisbook, color_mapping) 
     data = read_data(databook, color_mapping, identifier_mapping, excluded_wells)
 
     check_data_validity(data)
-    data = sorted(data, key=lambda m: (str(m.gene_type) if m.gene_type else '', str(m.gene_name) if m.gene_name else '', str(m.identifier).zfill(4) if m.identifier else ''))
+    data = sort_measurements(data)
+
+    data = data.take(data.has_data())
+    return color_mapping, identifier_mapping, data
 
-    data = [m for m in data if any(m.data)]
+def _main(app, databook, analysisbook, excluded_wells):
+    color_mapping, identifier_mapping, data = read_workbooks(databook, analysisbook, excluded_wells)
 
     name = pjoin(tempfile._get_default_tempdir(), "mendjan.pickle")
     print(name)
-    save_as_pickle({"color_mapping": color_mapping, "identifier_mapping": identifier_mapping, "data": data}, name)
+    save_as_pickle({"color_mapping": color_mapping, "identifier_mapping": identifier_mapping, "data": data.to_measurements()}, name)
 
     write_to_sheet(data, analysisbook.sheets['Excluded'], color_mapping)
 
@@ -91,31 +142,21 @@ def _main(app, databook, analysisbook, excluded_wells):
 def measurement_to_list(m, max_fields=0):
     return [m.gene_name, m.gene_type, m.identifier, *m.data, *[None for x in range(max_fields - 3 - len(m.data))]]
 
-def write_to_sheet(data, sheet, color_mapping=None):
+def write_to_sheet(data, sheet, color_mapping=None, value_only=False):
+    """Write measurements to `sheet`, rows are coloured by gene unless `value_only` is set"""
+    if isinstance(data, MeasurementTable):
+        data = data.to_measurements()
+    sheet = as_sheet(sheet)
     max_fields = max([len(measurement_to_list(m)) for m in data])
     values = [["Name", "Type", "Sample", *["R" + str(i) for i in range(1, max_fields +1 - 3)]]]
     for m in data:
         values.append(measurement_to_list(m, max_fields))
-    sheet.range((1,1), (max_fields, len(values))).value = values
+    sheet.write_values(1, 1, values)
 
-    colors = []
-    if color_mapping:
+    if color_mapping and not value_only and len(values) > 1:
         inverse_color_mapping = {value[0]: key for key, value in color_mapping.items()}
-        for m in data:
-            color = inverse_color_mapping.get(m.gene_name, None)
-            for _ in range(max_fields):
-                colors.append(color)
-        colors.append(color)
-
-    if len(values) > 1:
-        i = 0
-        for color, cell in zip(colors, sheet.range((2,1), (len(values)-1, max_fields))):
-            cell.color = color
-            if i == 9:
-                i = 0
-                print('.', end='')
-            i += 1 
-        print()
+        colors = [[inverse_color_mapping.get(m.gene_name, None)] * max_fields for m in data]
+        sheet.paint(2, 1, colors)
 
 def get_app():
     import xlwings
@@ -164,39 +205,35 @@ def flatten_list_of_lists(l):
     return [x for ll in l for x in ll]
 
 def read_setup(analysisbook, color_mapping):
-
-    plate_setup_sheet = analysisbook.sheets['Set Up']
-    plate_setup = plate_setup_sheet['B2:Y17']
-
-    plate_setup_width = len(plate_setup.columns)
+    workbook = as_workbook(analysisbook)
+    cell_values = workbook.values('Set Up', 'B2:Y17')
+    cell_colors = workbook.colors('Set Up', 'B2:Y17')
 
     identifier_mapping = {}
 
-    cell_values = plate_setup.value
-
-    for cell, value in zip(plate_setup, flatten_list_of_lists(cell_values)):
-        color = cell.color
-        identifier_mapping[(cell.row-2, cell.column-2)] = (str(value), color)
-        if color not in color_mapping.keys():
-            print(f'Unknown color in excel cell {cell.row}, {cell.column}: {make_color(color, color)} with value {value}')
+    for row, (row_values, row_colors) in enumerate(zip(cell_values, cell_colors)):
+        for column, (value, color) in enumerate(zip(row_values, row_colors)):
+            identifier_mapping[(row, column)] = (str(value), color)
+            if color not in color_mapping.keys():
+                print(f'Unknown color in excel cell {row+2}, {column+2}: {make_color(color, color)} with value {value}')
 
     return identifier_mapping
 
 def read_gene_mapping(analysisbook):
-    gene_setup = analysisbook.sheets["Set Up"]
-    gene_template = gene_setup.range("A21:C100")
+    workbook = as_workbook(analysisbook)
+    gene_template = workbook.values("Set Up", "A21:C100")
 
     color_mapping = {}
-    cells = iter(gene_template)
-    while True:
-        cell1 = next(cells)
-        color = cell1.color
-        cell2 = next(cells)
-        name = cell2.value
+    colors = []
+    for i, (_, name, gene_type) in enumerate(gene_template):
+        if i >= len(colors):
+            # the list ends at the first row without name and color, fetch colors up to the next candidate
+            end = next((j for j in range(i, len(gene_template)) if gene_template[j][1] is None), len(gene_template) - 1)
+            colors.extend(row[0] for row in workbook.colors("Set Up", f"A{21+i}:A{21+end}"))
+        color = colors[i]
         if name is None and color is None:
             break
-        cell3 = next(cells)
-        gene_type = str(cell3.value) if cell3.value is not None else None
+        gene_type = str(gene_type) if gene_type is not None else None
         if name or gene_type:
             color_mapping[color] = (name, gene_type)
     print("Detected the following genes/colorcodes:")
@@ -206,14 +243,12 @@ def read_gene_mapping(analysisbook):
     return color_mapping
 
 def check_data_validity(data):
-    invalid_data = False
-    for measurement in data:
-        if type(measurement.identifier) == float:
-            if math.modf(measurement.identifier)[0] != 0.0:
-                invalid_data = True
-                print(f'Invalid measurement: {measurement}')
-                print('If the identifier is messed up (i.e. a float) try restarting excel. Sometimes excel randomly returns invalid data.')
-    if invalid_data:
+    data = as_table(data)
+    invalid = data.category_mask("sample", lambda identifier: type(identifier) == float and math.modf(identifier)[0] != 0.0)
+    for measurement in data.take(invalid):
+        print(f'Invalid measurement: {measurement}')
+        print('If the identifier is messed up (i.e. a float) try restarting excel. Sometimes excel randomly returns invalid data.')
+    if invalid.any():
         print('Detected invalid data. Aborting.')
         sys.exit(-1)
                 
@@ -224,14 +259,15 @@ def read_data(databook, color_mapping, identifier_mapping, excluded_wells):
     data_matrix = []
     identifier_to_sample_type = {"pluri": "normalize"}
 
+    sybr = as_workbook(databook).values('SYBR', 'C4:Z64')
+
     for row, number in enumerate(range(4, 65, 4)):
-     datatransfer = databook.sheets['SYBR'].range(f'C{number}:Z{number}')
+     datatransfer = sybr[number - 4]
 
-     for column, cell in enumerate(datatransfer):
-      data = cell.value
+     for column, data in enumerate(datatransfer):
       if data == None:
        data = 40
-      if parse_well(excel_to_well(cell.row, cell.column)) in excluded_wells:
+      if parse_well(excel_to_well(number, column + 3)) in excluded_wells:
           data = None
       #filled_data.append(data)
 
@@ -258,47 +294,122 @@ def read_data(databook, color_mapping, identifier_mapping, excluded_wells):
     #data_matrix.append(Measurement(filled_data[0], filled_data[1], filled_data[2], gene_name, gene_type, identifier))
     filled_data = []
 
-    return data_matrix
+    return MeasurementTable.from_measurements(data_matrix)
 
 def metadata_from_pandas(df):
-    well_to_identifier = {}
-    well_to_gene = {}
-    for _, row in df.iterrows():
-        well = row["Well"]
-        target = str(row["Target"])
-        sample = str(row["Sample"])
-        content = str(row["Content"])
-
-        if target == "nan" and sample == "nan":
-            continue
+    targets = df["Target"].fillna("nan").astype(str)
+    samples = df["Sample"].fillna("nan").astype(str)
+    assigned = ~((targets == "nan") & (samples == "nan"))
 
-        well_to_gene[well] = target
-        well_to_identifier[well] = sample
+    wells = df["Well"][assigned].tolist()
+    well_to_gene = dict(zip(wells, targets[assigned].tolist()))
+    well_to_identifier = dict(zip(wells, samples[assigned].tolist()))
 
     return well_to_identifier, well_to_gene
 
-def data_matrix_from_pandas(df, well_to_gene, well_to_identifier, gene_to_gene_type, excluded_wells, identifier_to_type):
-    data_matrix = []
-    measurements = defaultdict(list)
-    for _, row in df.iterrows():
-        well = row["Well"]
-        if well in excluded_wells:
-            continue
-        m = row["Cq"]
-        if np.isnan(m):
-            continue
-        identifier = well_to_identifier.get(well, None)
-        gene = well_to_gene.get(well, None)
-        gene_type = gene_to_gene_type.get(gene, None)
-        measurements[identifier].append((m, gene, gene_type, identifier))
+def _well_key(row, column):
+    return f"{row.upper()}{int(column)}"
 
-    for identifier in measurements:
-        ms = [x[0] for x in measurements[identifier]]
-        _, gene_name, gene_type, identifier = measurements[identifier][0]
+def excluded_well_keys(excluded_wells):
+    """Set of "A1" style keys of `excluded_wells`.
 
-        data_matrix.append(Measurement(ms, gene_name, gene_type, identifier, identifier_to_type.get(identifier, None)))
+    Wells like "A01", "A1" and the tuples returned by `parse_well` all refer to the same well.
+    """
+    excluded = set()
+    for well in excluded_wells:
+        if well is None:
+            continue
+        if isinstance(well, str):
+            well = parse_well(well.strip())
+        excluded.add(_well_key(*well))
+    return excluded
+
+def well_keys(wells):
+    """"A1" style keys of the entries in the pandas Series `wells`, NaN where it is no well"""
+    parts = wells.astype(str).str.strip().str.extract(r"^([A-Za-z])0*(\d+)$")
+    return parts[0].str.upper() + parts[1]
+
+def excluded_well_mask(wells, excluded_wells):
+    """Boolean mask of the entries in the pandas Series `wells` that are excluded, see `excluded_well_keys`"""
+    excluded = excluded_well_keys(excluded_wells)
+    if not excluded:
+        return np.zeros(len(wells), dtype=bool)
+    return well_keys(wells).isin(excluded).to_numpy()
+
+class MeasurementAccumulator:
+    """Collects the Cq values of an export per (sample, gene), one chunk of rows at a time.
+
+    Only the group index and Cq value of every measured well are kept, so a file can be
+    read in bounded chunks. Groups and replicates keep the order of their first appearance,
+    which makes the result independent of how the file was split into chunks. With
+    `keep_wells` the well of every measurement is kept as well, see `measurements`.
+    """
+
+    def __init__(self, well_to_gene, well_to_identifier, excluded_wells, keep_wells=False):
+        self.well_to_gene = well_to_gene
+        self.well_to_identifier = well_to_identifier
+        self.excluded_wells = excluded_wells
+        self.keep_wells = keep_wells
+        self._groups = {}
+        self._group_ids = []
+        self._cq = []
+        self._wells = []
+
+    def add(self, df):
+        cq = df["Cq"].to_numpy(dtype=np.float64)
+        keep = ~np.isnan(cq) & ~excluded_well_mask(df["Well"], self.excluded_wells)
+        wells = df["Well"][keep]
+        measured = df[keep].assign(Sample=wells.map(self.well_to_identifier), Gene=wells.map(self.well_to_gene))
+
+        groups = measured.groupby(["Sample", "Gene"], sort=False, dropna=False)
+        local_ids = groups.ngroup().to_numpy()
+        _, first_rows = np.unique(local_ids, return_index=True)
+        keys = zip(measured["Sample"].to_numpy()[first_rows], measured["Gene"].to_numpy()[first_rows])
+        global_ids = np.array([self._groups.setdefault(tuple(None if x != x else x for x in key), len(self._groups)) for key in keys], dtype=np.intp)
+
+        self._group_ids.append(global_ids[local_ids])
+        self._cq.append(cq[keep])
+        if self.keep_wells:
+            self._wells.append(well_keys(wells).to_numpy(dtype=object))
+
+    def measurements(self):
+        """(sample, gene) of every group, and group index, Cq value and well key of every measurement"""
+        group_ids = np.concatenate(self._group_ids) if self._group_ids else np.zeros(0, dtype=np.intp)
+        cq = np.concatenate(self._cq) if self._cq else np.zeros(0)
+        wells = np.concatenate(self._wells) if self._wells else np.zeros(len(cq), dtype=object)
+        return list(self._groups), group_ids, cq, wells
+
+    def table(self, gene_to_gene_type, identifier_to_type):
+        groups, group_ids, cq, _ = self.measurements()
+        values, lengths = pack_replicates(group_ids, cq, len(groups))
+
+        identifiers = [identifier for identifier, _ in self._groups]
+        genes = [gene for _, gene in self._groups]
+        return MeasurementTable.from_columns(values, genes,
+                                             [gene_to_gene_type.get(gene, None) for gene in genes],
+                                             identifiers,
+                                             [identifier_to_type.get(identifier, None) for identifier in identifiers],
+                                             lengths=lengths)
+
+def pack_replicates(group_ids, cq, n_groups):
+    """Replicate matrix of `n_groups` rows, NaN padded, and the number of replicates of every row.
+
+    The replicates of a group keep the order of `cq`.
+    """
+    lengths = np.bincount(group_ids, minlength=n_groups)
+    order = np.argsort(group_ids, kind="stable")
+    starts = np.cumsum(lengths) - lengths
+    replicate = np.empty_like(group_ids)
+    replicate[order] = np.arange(len(group_ids)) - starts[group_ids[order]]
+
+    values = np.full((n_groups, lengths.max(initial=0)), np.nan)
+    values[group_ids, replicate] = cq
+    return values, lengths
 
-    return data_matrix
+def data_matrix_from_pandas(df, well_to_gene, well_to_identifier, gene_to_gene_type, excluded_wells, identifier_to_type):
+    accumulator = MeasurementAccumulator(well_to_gene, well_to_identifier, excluded_wells)
+    accumulator.add(df)
+    return accumulator.table(gene_to_gene_type, identifier_to_type)
 
 def parse_well(well):
     if len(well) == 2:
@@ -334,39 +445,55 @@ def mean(l):
     ll = [x for x in l if x is not None]
     return sum(ll) / len(ll)
 
+def _row_mean_or_raise(values):
+    means = row_means(values)
+    if np.isnan(means).any():
+        raise ZeroDivisionError("division by zero")
+    return [float(m) for m in means]
+
+def _category_offsets(data, column, norms):
+    """Per row offset looked up by the category of each row, raises KeyError like a dict lookup"""
+    codes = getattr(data, column + "_codes")
+    categories = getattr(data, column + "s")
+    offsets = np.zeros(len(categories))
+    for code in np.unique(codes):
+        offsets[code] = norms[categories[code]]
+    return offsets[codes]
+
 def calculate_housekeeping_normalisation(data):
-    norms = {}
-    for m in data:
-        if m.gene_type == 'HK':
-            norms[m.identifier] = mean(m.data)
+    data = as_table(data)
+    housekeeping = data.take(data.category_mask("gene_type", lambda gene_type: gene_type == 'HK'))
+    norms = dict(zip(housekeeping.column("sample"), _row_mean_or_raise(housekeeping.values)))
     norms['water'] = 0
     return norms
 
 def normalize_housekeeping(data, housekeeping):
-    r = []
-    for m in data:
-        if m.identifier:
-            r.append(Measurement([x - housekeeping[m.identifier] if x is not None else None for x in m.data ], m.gene_name, m.gene_type, m.identifier, m.sample_type))
-    return r
+    data = as_table(data)
+    data = data.take(data.category_mask("sample", bool))
+    return data.with_values(data.values - _category_offsets(data, "sample", housekeeping)[:, None])
 
 def calculate_pluripotent_normalisation(data):
+    data = as_table(data)
+    pluripotent = data.take(data.category_mask("sample_type", lambda sample_type: sample_type == 'normalize'))
     norms = {}
-    for m in data:
-        if m.sample_type == 'normalize':
-            print(f'Processing {m.gene_name} pluri')
-            try:
-                norms[m.gene_name] = mean(m.data)
-            except ZeroDivisionError as e:
-                print('Could not calculate pluri average, is every pluri excluded?')
-                sys.exit(1)
+    for gene_name, values in zip(pluripotent.column("gene"), pluripotent.values):
+        print(f'Processing {gene_name} pluri')
+        try:
+            norms[gene_name] = _row_mean_or_raise(values[None, :])[0]
+        except ZeroDivisionError as e:
+            print('Could not calculate pluri average, is every pluri excluded?')
+            sys.exit(1)
     return norms
 
 def normalize_pluripotent(data, pluripotent):
-    r = []
-    for m in data:
-        if m.identifier:
-            r.append(Measurement([x - pluripotent[m.gene_name] if x is not None else None for x in m.data ], m.gene_name, m.gene_type, m.identifier, m.sample_type))
-    return r
+    data = as_table(data)
+    data = data.take(data.category_mask("sample", bool))
+    return data.with_values(data.values - _category_offsets(data, "gene", pluripotent)[:, None])
+
+def fold_change(data):
+    """Convert (delta) Ct values into fold changes, 2^-x"""
+    data = as_table(data)
+    return data.with_values(np.power(2.0, -data.values))
 
 def get_sort_key(row):
     if row[0] == 'pluri':
@@ -377,26 +504,28 @@ def get_sort_key(row):
 def write_results(deltadata, deltadeltadata, sheet):
     values = []
 
-    max_fields = max([len(m.data)+1 for m in deltadata])
+    deltadata = as_table(deltadata)
+    deltadeltadata = as_table(deltadeltadata)
+
+    max_fields = max([length+1 for length in deltadata.lengths])
 
     values = [["Name", "Type", "Sample", *["DCT [Foldchange] R" + str(i) for i in range(1, max_fields +1 - 3)], "", *["DDCT [Foldchange] R" + str(i) for i in range(1, max_fields +1 - 3)]]]
 
     results = {}
-    for m in deltadata:
+    for m in fold_change(deltadata):
         gene = results.get(m.gene_name, {})
-        gene[m.identifier] = [m.gene_name, m.gene_type, m.identifier, *[2**-x if x is not None else None for x in m.data], *[None for x in range(max_fields-1-len(m.data))]]
+        gene[m.identifier] = [m.gene_name, m.gene_type, m.identifier, *m.data, *[None for x in range(max_fields-1-len(m.data))]]
         results[m.gene_name] = gene
 
-    for m in deltadeltadata:
+    for m in fold_change(deltadeltadata):
         results[m.gene_name][m.identifier].append("")
-        for x in m.data:
-            results[m.gene_name][m.identifier].append(2**-x if x is not None else None)
+        results[m.gene_name][m.identifier].extend(m.data)
         for x in range(max_fields-1-len(m.data)):
             results[m.gene_name][m.identifier].append(None)
 
     values = [value for gene in results.values() for value in sorted(gene.values(), key=get_sort_key)]
 
-    sheet.range("A1:G100").value = values
+    as_sheet(sheet).write_values(1, 1, values)
 
 def prepare():
     import xlwings
@@ -419,7 +548,7 @@ def parse_condition(v):
     return "True" if v == "+" else "False"
 
 def get_sample_data(analysisbook):
-    values = analysisbook.sheets["Identifying samples"].range("A1:Z100").value
+    values = as_workbook(analysisbook).values("Identifying samples", "A1:Z100")
 
     conditions = [str(x) for x in values[0] if x is not None]
     condition_data = {condition: [] for condition in conditions}
@@ -0,0 +1,181 @@
+"""
+Non-interactive analysis of many runs
+
+A run is either a CFX CSV export together with its plate layout CSV, or an Excel databook
+(.xlsx with a "SYBR" sheet) together with its analysis book (.xlsx with a "Set Up" sheet).
+Runs are collected from directories and glob patterns, the name of a run is the file name
+of its data file without extension. Runs with the same file name in different directories
+are named by their path relative to the directory they have in common instead (e.g.
+"day1/plate1" and "day2/plate1", their results go into subdirectories). Per run settings
+come from an optional manifest CSV, rows are matched by the name of the run or else by its
+file name:
+
+    run,setup,exclude,housekeeping,normalize
+    plate1,plate1_layout.csv,"A1,B3",GAPDH,pluri
+    plate2,setup.xlsx,,,
+
+Paths in the manifest are relative to the manifest. Settings missing from the manifest, or
+left blank, fall back to the defaults given on the command line, except for the excluded
+wells: a blank exclude cell excludes no wells, only runs without a manifest row or a
+manifest without an exclude column use the default. CSV runs need a housekeeping gene and a
+normalizing sample, Excel runs take them from the analysis book.
+
+Runs are analysed in a process pool, one result CSV is written per run and a summary of all
+runs, including the error of every failed run, to `summary.csv`.
+"""
+
+import contextlib
+import csv
+import glob
+import io
+import multiprocessing
+import os
+import time
+from collections import Counter, namedtuple
+
+from menqu.analysis import parse_well, fold_change
+from menqu.data_importers import CSVImporter, XlsxImporter
+from menqu.engine import PlateStack, delta_delta_ct
+
+Run = namedtuple("Run", ["name", "data", "setup", "exclude", "housekeeping", "normalize", "output"])
+
+DATA_EXTENSIONS = (".csv", ".xlsx")
+SUMMARY_FIELDS = ["run", "status", "genes", "samples", "rows", "seconds", "output", "error"]
+
+
+def parse_excluded_wells(text):
+    return [parse_well(well.strip()) for well in (text or "").split(",") if well.strip()]
+
+
+def find_data_files(inputs):
+    """All data files in the given files, directories and glob patterns, in sorted order"""
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isfile(path) and path.lower().endswith(DATA_EXTENSIONS) and path not in files:
+                files.append(path)
+    return files
+
+
+def read_manifest(path):
+    """Map run names to their manifest row, paths made relative to the working directory"""
+    directory = os.path.dirname(os.path.abspath(path))
+    manifest = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            row = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key}
+            if row.get("setup"):
+                row["setup"] = os.path.join(directory, row["setup"])
+            manifest[row["run"]] = row
+    return manifest
+
+
+def run_names(paths):
+    """Unique names of the runs of the data files `paths`, see the module docstring"""
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    counts = Counter(names)
+    duplicates = [os.path.abspath(path) for path, name in zip(paths, names) if counts[name] > 1]
+    if not duplicates:
+        return names
+    root = os.path.commonpath([os.path.dirname(path) for path in duplicates])
+    relative = [os.path.relpath(os.path.abspath(path), root).replace(os.sep, "/") for path in paths]
+    names = [os.path.splitext(path)[0] if counts[name] > 1 else name for path, name in zip(relative, names)]
+    # "plate.csv" and "plate.xlsx" in the same directory keep their extension
+    counts = Counter(names)
+    return [path if counts[name] > 1 else name for path, name in zip(relative, names)]
+
+
+def collect_runs(inputs, output, manifest=None, setup=None, exclude="", housekeeping=None, normalize=None, ignore=()):
+    """One `Run` per data file, layout and analysis books (and the files in `ignore`) are skipped"""
+    manifest = manifest or {}
+    setup_files = {os.path.abspath(row["setup"]) for row in manifest.values() if row.get("setup")}
+    setup_files.update(os.path.abspath(path) for path in ignore)
+    if setup:
+        setup_files.add(os.path.abspath(setup))
+
+    runs = []
+    paths = [path for path in find_data_files(inputs) if os.path.abspath(path) not in setup_files]
+    for path, name in zip(paths, run_names(paths)):
+        settings = manifest.get(name) or manifest.get(os.path.splitext(os.path.basename(path))[0], {})
+        runs.append(Run(name=name,
+                        data=path,
+                        setup=settings.get("setup") or setup,
+                        exclude=parse_excluded_wells(exclude if settings.get("exclude") is None else settings["exclude"]),
+                        housekeeping=settings.get("housekeeping") or housekeeping,
+                        normalize=settings.get("normalize") or normalize,
+                        output=os.path.join(output, name + ".csv")))
+    return runs
+
+
+def read_run(run):
+    """Read the measurements of a run into a `MeasurementTable`"""
+    if run.data.lower().endswith(".xlsx"):
+        return XlsxImporter(run.data, run.setup).read(run.exclude)
+
+    if not run.setup:
+        raise ValueError("CSV runs need a plate layout (setup) file.")
+    if not run.housekeeping or not run.normalize:
+        raise ValueError("CSV runs need a housekeeping gene and a normalizing sample.")
+    importer = CSVImporter()
+    importer.read_meta(run.setup)
+    if run.housekeeping not in importer.genes:
+        raise ValueError(f"Housekeeping gene {run.housekeeping} is not in the plate layout.")
+    if run.normalize not in importer.samples:
+        raise ValueError(f"Normalizing sample {run.normalize} is not in the plate layout.")
+    return importer.read_data(run.data, run.exclude).table({run.housekeeping: "HK"}, {run.normalize: "normalize"})
+
+
+def write_run_results(path, delta, delta_delta):
+    """Write ΔCt and ΔΔCt fold changes of every (gene, sample) pair as CSV"""
+    replicates = max(delta.n_replicates, delta_delta.n_replicates)
+    header = ["Gene", "Type", "Sample",
+              *[f"DCT [Foldchange] R{i}" for i in range(1, replicates + 1)],
+              *[f"DDCT [Foldchange] R{i}" for i in range(1, replicates + 1)]]
+
+    def padded(data):
+        return data + [None] * (replicates - len(data))
+
+    with open(path, mode="w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for m, mm in zip(fold_change(delta), fold_change(delta_delta)):
+            writer.writerow([m.gene_name, m.gene_type, m.identifier, *padded(m.data), *padded(mm.data)])
+
+
+def analyse_run(run):
+    """Analyse one run, never raises: failures are reported in the returned summary row"""
+    start = time.perf_counter()
+    summary = {"run": run.name, "status": "ok", "output": run.output, "error": ""}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            table = read_run(run)
+            stack = PlateStack.from_tables([table])
+            result = delta_delta_ct(stack)
+            delta, delta_delta = stack.to_table(0, result.delta), stack.to_table(0, result.delta_delta)
+            os.makedirs(os.path.dirname(run.output), exist_ok=True)
+            write_run_results(run.output, delta, delta_delta)
+        summary.update(genes=len(stack.genes), samples=len(stack.samples), rows=len(delta))
+    except (Exception, SystemExit) as e:
+        summary.update(status="failed", output="", error=f"{type(e).__name__}: {e}")
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def run_batch(runs, output, processes=None):
+    """Analyse `runs` in a pool of `processes` workers (one per CPU by default), returns the summary rows"""
+    os.makedirs(output, exist_ok=True)
+    summaries = []
+    with multiprocessing.Pool(processes) as pool:
+        for summary in pool.imap_unordered(analyse_run, runs, chunksize=1):
+            print(f"{summary['status']:7s} {summary['run']} {summary['error']}")
+            summaries.append(summary)
+
+    order = {run.name: i for i, run in enumerate(runs)}
+    summaries.sort(key=lambda summary: order[summary["run"]])
+    with open(os.path.join(output, "summary.csv"), mode="w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
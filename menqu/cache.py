@@ -0,0 +1,192 @@
+"""
+Content-addressed cache of import results
+
+Importing a run parses its files and normalizes the measurements, and the same run is often
+imported again and again with other excluded wells or another normalizing sample. The
+`ResultCache` keeps two kinds of entries on disk:
+
+* tables: the parsed `MeasurementTable` of a run, before gene and sample types are assigned
+  and before normalization. Keyed by the contents of the input files and the excluded wells.
+* results: the final data (`gene_data`, genes, samples, conditions, ...) as `.menqu` file.
+  Keyed by the table key plus housekeeping gene and normalizing sample.
+* measurements: the Cq value and well of every measurement of a run, nothing excluded, see
+  `menqu.incremental`. Keyed by the contents of the input files.
+
+Keys are hashes of file contents and settings (`file_digest`, `make_key`), so a changed file
+is a new entry and nothing has to be invalidated. Every key also contains the menqu version
+and `FORMAT`, so results of older code or entries in an older layout are never used; they
+are removed as least recently used. Every entry is one file, written to a
+temporary file first and moved into place, so processes can share the cache. The cache is
+bounded to `max_bytes`, the least recently used entries are removed first (a hit updates
+the modification time of its file). Hits and misses are logged on the "menqu.cache" logger.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import appdirs
+import numpy as np
+
+import menqu
+from menqu.datasources import load_from_menqu_file, save_to_menqu_file
+from menqu.measurements import MeasurementTable
+from menqu.incremental import Measurements
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(appdirs.user_cache_dir("menqu"), "results")
+MAX_BYTES = 512 * 1024 * 1024
+# increase when the layout of an entry changes
+FORMAT = 1
+
+TABLE_ARRAYS = ("values", "lengths", "gene_codes", "gene_type_codes", "sample_codes", "sample_type_codes")
+TABLE_CATEGORIES = ("genes", "gene_types", "samples", "sample_types")
+
+
+def file_digest(path):
+    """SHA-256 of the contents of the file at `path`"""
+    digest = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def excluded_key(excluded_wells):
+    """Excluded wells in a canonical order, empty entries dropped"""
+    return sorted({tuple(well) for well in excluded_wells if well})
+
+
+def make_key(*parts):
+    """Hash of JSON serializable `parts`, the menqu version and the cache format"""
+    parts = (menqu.__version__, FORMAT, *parts)
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _save_table(table, f):
+    np.savez(f,
+             categories=np.array(json.dumps({name: getattr(table, name) for name in TABLE_CATEGORIES})),
+             **{name: getattr(table, name) for name in TABLE_ARRAYS})
+
+
+def _load_table(path):
+    with np.load(path, allow_pickle=False) as f:
+        categories = json.loads(str(f["categories"]))
+        arrays = {name: f[name] for name in TABLE_ARRAYS}
+    return MeasurementTable(**arrays, **categories)
+
+
+def _save_measurements(measurements, f):
+    wells = np.array([well if isinstance(well, str) else "" for well in measurements.wells], dtype=str)
+    np.savez(f, groups=np.array(json.dumps(measurements.groups)), group_ids=measurements.group_ids,
+             cq=measurements.cq, wells=wells)
+
+
+def _load_measurements(path):
+    with np.load(path, allow_pickle=False) as f:
+        groups = [tuple(group) for group in json.loads(str(f["groups"]))]
+        return Measurements(groups, f["group_ids"], f["cq"], f["wells"])
+
+
+class ResultCache:
+
+    KINDS = {"table": ".npz", "result": ".menqu", "measurements": ".wells.npz"}
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = {kind: 0 for kind in self.KINDS}
+        self.misses = {kind: 0 for kind in self.KINDS}
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, key + self.KINDS[kind])
+
+    def _count(self, kind, key, hit):
+        (self.hits if hit else self.misses)[kind] += 1
+        total = self.hits[kind] + self.misses[kind]
+        logger.info("%s cache %s %s, hit rate %.0f%% (%d of %d)", kind, "hit" if hit else "miss", key[:12],
+                    100 * self.hits[kind] / total, self.hits[kind], total)
+
+    def _get(self, kind, key, load):
+        path = self._path(kind, key)
+        try:
+            value = load(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning("Dropping unreadable cache entry %s: %s", path, e)
+                self._remove(path)
+            self._count(kind, key, hit=False)
+            return None
+        self._count(kind, key, hit=True)
+        return value
+
+    def _put(self, kind, key, save):
+        path = self._path(kind, key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            save(tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", path, e)
+            self._remove(tmp)
+            return
+        self.evict()
+
+    def get_table(self, key):
+        """The cached `MeasurementTable` of `key`, None on a miss"""
+        return self._get("table", key, _load_table)
+
+    def put_table(self, key, table):
+        def save(path):
+            with open(path, mode="wb") as f:
+                _save_table(table, f)
+        self._put("table", key, save)
+
+    def get_result(self, key):
+        """The cached data of `key`, None on a miss"""
+        # not memory mapped, so the entry can be replaced or evicted while the data is in use
+        return self._get("result", key, lambda path: load_from_menqu_file(path, mmap=False))
+
+    def put_result(self, key, data):
+        self._put("result", key, lambda path: save_to_menqu_file(data, path))
+
+    def get_measurements(self, key):
+        """The cached `Measurements` of `key`, None on a miss"""
+        return self._get("measurements", key, _load_measurements)
+
+    def put_measurements(self, key, measurements):
+        def save(path):
+            with open(path, mode="wb") as f:
+                _save_measurements(measurements, f)
+        self._put("measurements", key, save)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into `max_bytes`"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(tuple(self.KINDS.values())):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+
+RESULTS = ResultCache()
@@ -1,19 +1,47 @@
+from menqu import timeline
+
 import logging
 
 from menqu.analysis import _update
-from menqu.services import start_all
 
 import click
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("--update/--no-update", default=True)
-def main(update):
+@click.option("--verbose", is_flag=True, help="Log the startup timeline.")
+@click.pass_context
+def main(ctx, update, verbose):
+    if ctx.invoked_subcommand is not None:
+        return
+    # pywebview is only needed for the desktop window
+    from menqu.services import start_all
+    timeline.mark("imports")
+
+    if verbose:
+        logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+        for name, seconds in timeline.marks():
+            timeline.logger.info("%8.3f s  %s", seconds, name)
     try:
         if update:
             _update()
     except:
-        logging.exception()
+        logging.exception("Update check failed")
+    timeline.mark("update check")
     start_all()
 
+@main.command()
+@click.option("--port", default=5006, show_default=True)
+@click.option("--address", default=None, help="Address to listen on, all interfaces by default.")
+@click.option("--processes", default=1, show_default=True, help="Server processes, 0 for one per CPU.")
+@click.option("--job-processes", default=1, show_default=True, help="Import processes per server process, shared by its sessions.")
+@click.option("--allow-websocket-origin", multiple=True, help="Host[:port] browsers may connect from, repeatable.")
+def serve(port, address, processes, job_processes, allow_websocket_origin):
+    """Serve menqu to browsers, without the desktop window"""
+    from menqu.serve import serve as serve_menqu
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    serve_menqu(port=port, address=address, processes=processes, job_processes=job_processes,
+               allow_websocket_origin=list(allow_websocket_origin))
+
 if __name__ == "__main__":
     main()
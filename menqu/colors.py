@@ -0,0 +1,85 @@
+"""
+Colours of the conditions, remembered between runs of menqu
+
+`ColorCache` keeps the colours in memory. The file is read once per process, when the
+colours are first needed. Changes are written behind: `update` only changes the
+dictionary and (re)starts a timer, and the file is written in the timer thread once no
+colour changed for `delay` seconds, so dragging a colour picker writes the file once. The
+file is written to a temporary file and moved into place, and pending changes are written
+when the interpreter exits (or by calling `flush`).
+"""
+
+import atexit
+import logging
+import os
+import pickle
+import threading
+
+logger = logging.getLogger(__name__)
+
+# seconds without a change before the colours are written
+DELAY = 1.0
+
+
+class ColorCache:
+
+    def __init__(self, path, delay=DELAY):
+        self.path = path
+        self.delay = delay
+        self._colors = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _load(self):
+        try:
+            with open(self.path, mode="rb") as f:
+                return dict(pickle.load(f))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Ignoring unreadable colour cache %s: %s", self.path, e)
+            return {}
+
+    def get(self):
+        """Copy of all remembered colours, condition -> colour"""
+        with self._lock:
+            if self._colors is None:
+                self._colors = self._load()
+            return dict(self._colors)
+
+    def update(self, colors):
+        """Remember `colors`, they are written to the file later"""
+        with self._lock:
+            if self._colors is None:
+                self._colors = self._load()
+            self._colors.update(colors)
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write pending changes now"""
+        # `update` only waits for `_lock`, which is never held while writing
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                colors = dict(self._colors)
+                self._dirty = False
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp, mode="wb") as f:
+                    pickle.dump(colors, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.warning("Could not write the colour cache %s: %s", self.path, e)
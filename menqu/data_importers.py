@@ -1,81 +1,247 @@
-from menqu.analysis import prepare, _main, parse_well, get_sample_data, _update, metadata_from_pandas, data_matrix_from_pandas, _main_csv
+from menqu.analysis import prepare, _main, parse_well, get_sample_data, _update, metadata_from_pandas, MeasurementAccumulator, _main_csv, read_workbooks
+from menqu.excel import Workbook, OpenpyxlBackend
+from menqu.measurements import as_table, row_means
+from menqu.jobs import NO_JOB
+from menqu.cache import RESULTS, excluded_key, file_digest, make_key
+from menqu.incremental import IncrementalAnalysis, Measurements
+import multiprocessing
+import os
 import numpy as np
-import pandas
 
 def calculate_data(data, name, condition_data, conditions):
-    means = []
-    samples = []
-    genes = []
-    max_repititions = max(len(x.data) for x in data)
-    repitions = [[] for x in range(max_repititions)]
-    for m in data:
-        mean = np.sum(2**-x for x in m.data if x is not None) / np.sum(1 for x in m.data if x is not None)
-        for i, x in enumerate(m.data):
-            repitions[i].append(2**-x if x is not None else None)
-        for i in range(len(m.data), max_repititions):
-            repitions[i].append(None)
-
-        means.append(mean)
-        samples.append(str(m.identifier))
-        genes.append(m.gene_name)
+    """Fold changes of every measurement as `gene_data` columns.
+
+    The replicate columns R1, R2, ... and the mean are contiguous float64 arrays with NaN
+    for missing values, Sample and Gene are lists of strings.
+    """
+    data = as_table(data)
+    width = int(data.lengths.max(initial=0))
+    fold_changes = np.power(2.0, -data.values[:, :width])
+    # one copy, after which every replicate column is a contiguous row of the transpose
+    repitions = np.ascontiguousarray(fold_changes.T)
+    means = row_means(fold_changes)
+
+    samples = np.array([str(sample) for sample in data.samples], dtype=object)[data.sample_codes].tolist()
+    genes = data.column("gene").tolist()
 
     gene_data = {"mean":means, "Sample":samples, "Gene": genes, **{"R"+str(i+1) : d for i, d in enumerate(repitions)}}
 
-    samples_found = set()
-    samples = []
-    for x in gene_data["Sample"]:
-        if x in samples_found:
-            continue
-        samples.append(x)
-        samples_found.add(x)
+    samples = list(dict.fromkeys(gene_data["Sample"]))
 
     colors = {}
-    genes = list(set(gene_data["Gene"]))
+    genes = list(dict.fromkeys(gene_data["Gene"]))
 
 
     data =  {"gene_data": gene_data, "condition_data": condition_data, "conditions": conditions, "genes": genes, "samples":samples, "colors":colors, "name":name}
     return data
 
 class ExcelImporter:
+    """Import from the databook and analysisbook open in the running Excel"""
 
-    async def prepare(self):
+    def prepare(self):
         self._app, self._databook, self._analysisbook = prepare()
 
-    async def get_sample_data(self):
+    def get_sample_data(self):
         if self._analysisbook is not None:
             self.condition_data, self.conditions = get_sample_data(self._analysisbook)
 
-    #name = ".".join(self._databook.fullname.split(".")[:-1])
-    def import_(self, excluded_wells):
+    def import_(self, excluded_wells, job=NO_JOB):
+        job.progress(0.2, "analysing")
         data = _main(self._app, self._databook, self._analysisbook, excluded_wells)
 
-        condition_data, conditions = get_sample_data(self._analysisbook)
-        self.data = calculate_data(data, self.condition_data, self.conditions)
+        job.progress(0.8, "reading conditions")
+        self.get_sample_data()
+        job.progress(0.9, "calculating fold changes")
+        name = ".".join(self._databook.name.split(".")[:-1])
+        self.data = calculate_data(data, name, self.condition_data, self.conditions)
+        return self.data
+
+def import_excel(excluded_wells, job=NO_JOB):
+    """Job importing from the running Excel, has to run in a thread of the process owning Excel"""
+    try:
+        import pythoncom
+        pythoncom.CoInitialize()
+    except ImportError:
+        pass
+    importer = ExcelImporter()
+    job.progress(0.1, "connecting to Excel")
+    importer.prepare()
+    return importer.import_(excluded_wells, job)
+
+class XlsxImporter:
+    """Import a databook and analysisbook directly from .xlsx files, no running Excel needed.
+
+    `data_path` is the file with the "SYBR" sheet and `setup_path` the one with the "Set Up"
+    and "Identifying samples" sheets, both may be the same file. Every file is opened once
+    and only the sheets the analysis needs are parsed.
+    """
+
+    def __init__(self, data_path, setup_path=None):
+        self.data_path = data_path
+        self.setup_path = setup_path or data_path
+
+    def read(self, excluded_wells):
+        """Read the setup and the measurements, returns the sorted `MeasurementTable`"""
+        backends = {path: OpenpyxlBackend(path) for path in {self.data_path, self.setup_path}}
+        try:
+            databook = Workbook(backends[self.data_path])
+            analysisbook = Workbook(backends[self.setup_path])
+            self.color_mapping, self.identifier_mapping, data = read_workbooks(databook, analysisbook, excluded_wells)
+            if "Identifying samples" in analysisbook.sheet_names:
+                self.condition_data, self.conditions = get_sample_data(analysisbook)
+            else:
+                self.condition_data, self.conditions = {"Sample": []}, []
+        finally:
+            for backend in backends.values():
+                backend.close()
+        return data
+
+    def import_(self, excluded_wells, cache=RESULTS):
+        """Import the run, with a `ResultCache` the result is reused while files and exclusions are the same"""
+        if cache is not None:
+            key = make_key("xlsx", file_digest(self.data_path), file_digest(self.setup_path), excluded_key(excluded_wells))
+            data = cache.get_result(key)
+            if data is not None:
+                data["name"] = self.data_path
+                self.data = data
+                return data
+
+        data = _main_csv(self.read(excluded_wells))
+        self.data = calculate_data(data, self.data_path, self.condition_data, self.conditions)
+        if cache is not None:
+            cache.put_result(key, self.data)
         return self.data
 
+def import_xlsx(data_path, setup_path=None, excluded_wells=(), cache=RESULTS):
+    return XlsxImporter(data_path, setup_path).import_(excluded_wells, cache)
+
+def import_xlsx_files(paths, excluded_wells=(), processes=None):
+    """Import many (data_path, setup_path) pairs in parallel, one worker process per CPU by default"""
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(import_xlsx, [(data_path, setup_path, excluded_wells) for data_path, setup_path in paths])
+
 class CSVImporter:
+    """Import Bio-Rad CFX exports.
+
+    `read_meta` reads the plate layout (which well holds which target and sample) and
+    `import_` the Cq values of a run. Only the needed columns are parsed and their types
+    are fixed up front, the layout is then applied to all rows at once.
+
+    With a `chunksize` the files are streamed in chunks of that many rows, which keeps
+    memory bounded for exports of many concatenated runs. Files bigger than
+    `STREAMING_THRESHOLD` bytes are always streamed. Both ways give the same result.
+    """
+
+    META_COLUMNS = {"Well": str, "Target": str, "Sample": str}
+    DATA_COLUMNS = {"Well": str, "Cq": np.float64}
+    STREAMING_THRESHOLD = 64 * 1024 * 1024
+    DEFAULT_CHUNKSIZE = 100_000
+
+    def __init__(self, chunksize=None):
+        self.chunksize = chunksize
+
+    def _read_chunks(self, path, columns):
+        import pandas
+
+        chunksize = self.chunksize
+        if chunksize is None and os.path.getsize(path) > self.STREAMING_THRESHOLD:
+            chunksize = self.DEFAULT_CHUNKSIZE
+        if chunksize is None:
+            return [pandas.read_csv(path, usecols=list(columns), dtype=columns)]
+        return pandas.read_csv(path, usecols=list(columns), dtype=columns, chunksize=chunksize)
 
     def read_meta(self, path):
         self.path_meta = path
-        df_meta = pandas.read_csv(self.path_meta)
-        self.well_to_identifier, self.well_to_gene = metadata_from_pandas(df_meta)
+        self.well_to_identifier, self.well_to_gene = {}, {}
+        for df_meta in self._read_chunks(self.path_meta, self.META_COLUMNS):
+            well_to_identifier, well_to_gene = metadata_from_pandas(df_meta)
+            self.well_to_identifier.update(well_to_identifier)
+            self.well_to_gene.update(well_to_gene)
 
-        list_of_genes = list(self.well_to_gene.values())
-        self.genes = list(set(list_of_genes))
-        self.genes.sort(key=list_of_genes.index)
-
-        list_of_samples = list(self.well_to_identifier.values())
-        self.samples = list(set(list_of_samples))
-        self.samples.sort(key=list_of_samples.index)
+        self.genes = list(dict.fromkeys(self.well_to_gene.values()))
+        self.samples = list(dict.fromkeys(self.well_to_identifier.values()))
 
         self.conditions = []
         self.condition_data = {"Sample": [cond for cond in self.conditions]}
         print(self.samples)
 
-    def import_(self, excluded_wells, housekeeping, normalize):
-        df = pandas.read_csv(self.path_data)
-        data_matrix = data_matrix_from_pandas(df, self.well_to_gene, self.well_to_identifier, {housekeeping: "HK"}, excluded_wells, {normalize: "normalize"})
+    def read_data(self, path, excluded_wells=(), job=NO_JOB):
+        """Read the Cq values of `path` into a `MeasurementAccumulator`"""
+        accumulator = MeasurementAccumulator(self.well_to_gene, self.well_to_identifier, excluded_wells)
+        for i, df in enumerate(self._read_chunks(path, self.DATA_COLUMNS)):
+            job.progress(0.1, f"reading chunk {i + 1}")
+            accumulator.add(df)
+        return accumulator
+
+    def read_measurements(self, path, job=NO_JOB, cache=RESULTS):
+        """`Measurements` of every well of `path`, none excluded, for an `IncrementalAnalysis`"""
+        if cache is not None:
+            key = make_key("csv-measurements", file_digest(self.path_meta), file_digest(path))
+            measurements = cache.get_measurements(key)
+            if measurements is not None:
+                return measurements
+
+        accumulator = MeasurementAccumulator(self.well_to_gene, self.well_to_identifier, (), keep_wells=True)
+        for i, df in enumerate(self._read_chunks(path, self.DATA_COLUMNS)):
+            job.progress(0.1, f"reading chunk {i + 1}")
+            accumulator.add(df)
+        measurements = Measurements(*accumulator.measurements())
+        if cache is not None:
+            cache.put_measurements(key, measurements)
+        return measurements
+
+    def analyse(self, excluded_wells, housekeeping, normalize, job=NO_JOB, cache=RESULTS):
+        """Import the run as `IncrementalAnalysis`, whose excluded wells can be changed afterwards"""
+        measurements = self.read_measurements(self.path_data, job, cache)
+        job.progress(0.6, "normalizing")
+        analysis = IncrementalAnalysis(measurements, housekeeping, normalize, self.path_data,
+                                       self.condition_data, self.conditions, excluded_wells)
+        self.data = analysis.data
+        return analysis
+
+    def import_(self, excluded_wells, housekeeping, normalize, job=NO_JOB, cache=RESULTS):
+        """Import the run, with a `ResultCache` the parsed table and the result are reused.
+
+        The parsed table only depends on the files and the excluded wells, so another
+        housekeeping gene or normalizing sample skips parsing as well.
+        """
+        table = None
+        if cache is not None:
+            table_key = make_key("csv", file_digest(self.path_meta), file_digest(self.path_data), excluded_key(excluded_wells))
+            result_key = make_key(table_key, housekeeping, normalize)
+            data = cache.get_result(result_key)
+            if data is not None:
+                data["name"] = self.path_data
+                self.data = data
+                return data
+            table = cache.get_table(table_key)
+
+        if table is None:
+            table = self.read_data(self.path_data, excluded_wells, job).table({}, {})
+            if cache is not None:
+                cache.put_table(table_key, table)
+        job.progress(0.6, "normalizing")
+        data_matrix = table.with_types({housekeeping: "HK"}, {normalize: "normalize"})
         data = _main_csv(data_matrix)
+        job.progress(0.9, "calculating fold changes")
         data = calculate_data(data, self.path_data, self.condition_data, self.conditions)
+        if cache is not None:
+            cache.put_result(result_key, data)
         self.data = data
         return data
+
+def import_csv(meta_path, data_path, excluded_wells, housekeeping, normalize, job=NO_JOB):
+    """Job importing a CFX export with its plate layout"""
+    importer = CSVImporter()
+    job.progress(0.05, "reading plate layout")
+    importer.read_meta(meta_path)
+    importer.path_data = data_path
+    return importer.import_(excluded_wells, housekeeping, normalize, job)
+
+def analyse_csv(meta_path, data_path, excluded_wells, housekeeping, normalize, job=NO_JOB):
+    """Job importing a CFX export as `IncrementalAnalysis`"""
+    importer = CSVImporter()
+    job.progress(0.05, "reading plate layout")
+    importer.read_meta(meta_path)
+    importer.path_data = data_path
+    return importer.analyse(excluded_wells, housekeeping, normalize, job)
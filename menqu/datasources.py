@@ -1,7 +1,35 @@
-"""Loading and saving data"""
+"""Loading and saving data
 
-import numpy as np
+Version 1 `.menqu` files are a pickle of `{"version": 1, "data": data}`.
+
+Version 2 files are columnar and can be memory mapped. A file starts with `MAGIC`, followed
+by the length of a JSON header as little endian uint64 and the header itself. The header
+holds everything except the columns of `gene_data`: name, genes, samples, conditions,
+condition data and colors. Every `gene_data` column is stored as one typed binary array,
+the arrays follow the header and start at multiples of `ALIGNMENT` bytes counted from the
+end of the header. Numeric columns are float64 with NaN for missing values, string columns
+such as Sample and Gene are stored as uint32 codes into a list of categories in the header.
+On load numeric columns are read-only `np.memmap`s, so only the columns that are touched
+are read from disk.
+
+`RunCache` keeps runs loaded from file contents (e.g. uploads) to share them read-only
+between the sessions of a server.
+"""
+
+import collections
+import gc
+import hashlib
+import io
+import json
+import os
 import pickle
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b"\x89MENQU\r\n"
+ALIGNMENT = 64
 
 def get_fake_data():
     gene_data = {"R1": np.array([1, 2, 4, 4]),
@@ -55,13 +83,186 @@ def get_fake_data2():
     return {"gene_data": gene_data, "condition_data": condition_data, "conditions": conditions, "genes": genes, "samples":samples, "colors":colors, "name":name}
 
 
-def load_from_menqu_file(filename):
+def _aligned(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def _is_number(x):
+    return x is None or (isinstance(x, (int, float, np.integer, np.floating)) and not isinstance(x, (bool, np.bool_)))
+
+
+def _to_json(obj):
+    """numpy scalars and arrays in the header, e.g. in condition_data"""
+    return obj.tolist()
+
+
+def _encode_column(column):
+    """Return the header entry and the array of one `gene_data` column"""
+    array = np.asarray(column)
+    if array.dtype.kind in "iuf":
+        return {"kind": "numeric"}, array.astype(np.float64)
+    if array.dtype.kind == "U":
+        categories, codes = np.unique(array, return_inverse=True)
+        return {"kind": "categorical", "categories": categories.tolist()}, codes.astype(np.uint32)
+    # mixed columns, e.g. replicates padded with None or strings with missing values
+    column = list(column)
+    if all(_is_number(x) for x in column):
+        return {"kind": "numeric"}, np.array([np.nan if x is None else x for x in column], dtype=np.float64)
+    if all(x is None or isinstance(x, str) for x in column):
+        categories = {}
+        codes = np.array([categories.setdefault(x, len(categories)) for x in column], dtype=np.uint32)
+        return {"kind": "categorical", "categories": list(categories)}, codes
+    raise TypeError("gene_data columns must contain only numbers or only strings")
+
+
+def _decode_column(entry, f, offset, mmap):
+    dtype = np.dtype(entry["dtype"])
+    if entry["length"] == 0:
+        array = np.empty(0, dtype=dtype)
+    elif mmap:
+        array = np.memmap(f, dtype=dtype, mode="r", offset=offset + entry["offset"], shape=(entry["length"],))
+    else:
+        f.seek(offset + entry["offset"])
+        array = np.frombuffer(bytearray(f.read(entry["length"] * dtype.itemsize)), dtype=dtype)
+    if entry["kind"] == "categorical":
+        categories = np.empty(len(entry["categories"]), dtype=object)
+        categories[:] = entry["categories"]
+        return categories[array].tolist()
+    return array
+
+
+def _save_v2(data, f):
+    header = {"version": 2, **{key: value for key, value in data.items() if key != "gene_data"}, "gene_data": {}}
+    arrays = []
+    offset = 0
+    for name, column in data["gene_data"].items():
+        entry, array = _encode_column(column)
+        array = array.astype(array.dtype.newbyteorder("<"))
+        entry.update(dtype=array.dtype.str, offset=offset, length=len(array))
+        header["gene_data"][name] = entry
+        arrays.append(array)
+        offset = _aligned(offset + array.nbytes)
+
+    encoded = json.dumps(header, default=_to_json).encode("utf-8")
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(encoded)))
+    f.write(encoded)
+    f.write(b"\0" * (start - f.tell()))
+    for array in arrays:
+        f.write(array.tobytes())
+        f.write(b"\0" * (_aligned(array.nbytes) - array.nbytes))
+
+
+def _load_v2(f, mmap):
+    length, = struct.unpack("<Q", f.read(8))
+    header = json.loads(f.read(length).decode("utf-8"))
+    start = _aligned(len(MAGIC) + 8 + length)
+    gene_data = {name: _decode_column(entry, f, start, mmap) for name, entry in header.pop("gene_data").items()}
+    del header["version"]
+    return {"gene_data": gene_data, **header}
+
+
+def load_from_menqu_file(filename, mmap=True):
+    """Load a version 1 or version 2 `.menqu` file, see the module docstring.
+
+    With `mmap` the columns keep the file open, on Windows it can then not be replaced
+    while the data is in use. `save_to_menqu_file` copies them into memory when saving over
+    the file.
+    """
     with open(filename, mode="rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return _load_v2(f, mmap)
+        f.seek(0)
         data = pickle.load(f)
     assert data["version"] == 1
     return data["data"]
 
-def save_to_menqu_file(data, filename):
-    with open(filename, mode="wb") as f:
-        pickle.dump({"version":1, "data": data}, f)
 
+def load_from_menqu_bytes(contents):
+    """Load the contents of a version 2 `.menqu` file, e.g. an upload.
+
+    Version 1 files are pickles, which can run arbitrary code when loaded, so they are refused.
+    """
+    f = io.BytesIO(contents)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a version 2 .menqu file, save it again with a current menqu.")
+    return _load_v2(f, mmap=False)
+
+
+def _unmap(gene_data, filename):
+    """Replace the columns memory mapped from `filename` by copies in memory"""
+    for name, column in gene_data.items():
+        if isinstance(column, np.memmap) and column.filename is not None and os.path.exists(filename) \
+                and os.path.samefile(column.filename, filename):
+            copy = np.array(column)
+            copy.flags.writeable = column.flags.writeable
+            gene_data[name] = copy
+    # the mapping is closed once the last array using it is gone
+    gc.collect()
+
+
+def save_to_menqu_file(data, filename, version=2):
+    """Save `data` as `.menqu` file.
+
+    The file is written next to `filename` and then moved into place, so an existing file
+    is never left half written. Columns of `data` memory mapped from `filename` are replaced
+    by copies in memory first, on Windows a mapped file can not be replaced.
+    """
+    filename = os.fsdecode(filename)
+    tmp = filename + ".tmp"
+    with open(tmp, mode="wb") as f:
+        if version == 1:
+            pickle.dump({"version": 1, "data": data}, f)
+        else:
+            _save_v2(data, f)
+    _unmap(data["gene_data"], filename)
+    os.replace(tmp, filename)
+
+
+def _freeze(data):
+    for column in data["gene_data"].values():
+        if isinstance(column, np.ndarray):
+            column.flags.writeable = False
+    return data
+
+
+def _copy(obj):
+    """Copy the dicts and lists of `obj`, arrays are shared"""
+    if isinstance(obj, dict):
+        return {key: _copy(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return list(obj)
+    return obj
+
+
+class RunCache:
+    """The last `size` runs loaded with `load`, keyed by a hash of the file contents.
+
+    The gene_data arrays of a cached run are made read-only and shared by everyone loading the
+    same contents, the dicts and lists around them are copied for every caller, so a session
+    can change the name, colors or conditions of its run. Safe to use from several threads.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._runs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, contents):
+        key = hashlib.sha256(contents).hexdigest()
+        with self._lock:
+            data = self._runs.get(key)
+            if data is not None:
+                self._runs.move_to_end(key)
+                self.hits += 1
+        if data is None:
+            data = _freeze(load_from_menqu_bytes(contents))
+            with self._lock:
+                self.misses += 1
+                self._runs[key] = data
+                while len(self._runs) > self.size:
+                    self._runs.popitem(last=False)
+        return _copy(data)
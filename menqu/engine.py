@@ -0,0 +1,162 @@
+"""
+Vectorized ΔCt/ΔΔCt calculation for many plates at once
+
+`PlateStack` aligns the measurements of several plates into one float array of shape
+(plate, gene, sample, replicate). `delta_delta_ct` then performs housekeeping subtraction,
+calibrator subtraction and the 2^-x fold change as broadcast operations over the whole
+stack, so the cost of a call is dominated by the size of the stack and not by the number
+of plates.
+
+The rules are the same as in `menqu.analysis._main_csv`: a sample is normalized to the
+housekeeping gene measured for it ("water" is never normalized) and every gene is
+normalized to its mean in the calibrator ("normalize") sample. Where the per plate analysis
+would abort with a missing housekeeping or calibrator value, the engine returns NaN.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from menqu.measurements import MeasurementTable, row_means
+
+
+EngineResult = namedtuple("EngineResult", ["delta", "delta_delta", "fold_change"])
+
+
+def _gene_key(gene_name):
+    return str(gene_name) if gene_name else ''
+
+
+def _sample_key(identifier):
+    return str(identifier).zfill(4) if identifier else ''
+
+
+def _sorted_union(tables, column, key):
+    """All categories of `column` over all tables, stably sorted by `key`"""
+    union = {}
+    for table in tables:
+        for category in getattr(table, column + "s"):
+            union.setdefault(category, None)
+    return sorted(union, key=key)
+
+
+def _last_true(mask, axis):
+    """Index of the last True entry along `axis`, -1 where there is none"""
+    if mask.shape[axis] == 0:
+        return np.full(np.delete(mask.shape, axis), -1)
+    last = mask.shape[axis] - 1 - np.argmax(np.flip(mask, axis=axis), axis=axis)
+    return np.where(mask.any(axis=axis), last, -1)
+
+
+def _gather(values, index, axis):
+    """Select one entry along `axis` for every position of `index`, NaN where `index` is -1"""
+    expanded = np.expand_dims(np.maximum(index, 0), (axis, -1))
+    gathered = np.take_along_axis(values, expanded, axis=axis).squeeze(axis)
+    return np.where(index[..., None] >= 0, gathered, np.nan)
+
+
+class PlateStack:
+    """Measurements of several plates aligned on shared gene and sample axes.
+
+    `values` has the shape (plate, gene, sample, replicate) and is NaN for missing and
+    excluded wells. `present` marks the (plate, gene, sample) cells that had a measurement.
+    Genes and samples are sorted like the per plate analysis sorts its measurements.
+    """
+
+    def __init__(self, values, present, lengths, genes, samples, gene_types, sample_types):
+        self.values = values
+        self.present = present
+        self.lengths = lengths
+        self.genes = genes
+        self.samples = samples
+        self.gene_types = gene_types
+        self.sample_types = sample_types
+
+    @classmethod
+    def from_tables(cls, tables):
+        """Stack `MeasurementTable`s, one per plate.
+
+        Rows without data and rows without a sample identifier are dropped, as they are
+        by the per plate analysis.
+        """
+        tables = [table.take(table.has_data() & table.category_mask("sample", bool)) for table in tables]
+
+        genes = _sorted_union(tables, "gene", _gene_key)
+        samples = _sorted_union(tables, "sample", _sample_key)
+        gene_index = {gene: i for i, gene in enumerate(genes)}
+        sample_index = {sample: i for i, sample in enumerate(samples)}
+        width = max((table.n_replicates for table in tables), default=0)
+
+        shape = (len(tables), len(genes), len(samples))
+        values = np.full(shape + (width,), np.nan)
+        present = np.zeros(shape, dtype=bool)
+        lengths = np.zeros(shape, dtype=np.intp)
+        gene_types = np.full(shape[:2], None, dtype=object)
+        sample_types = np.full((shape[0], shape[2]), None, dtype=object)
+
+        for p, table in enumerate(tables):
+            g = np.array([gene_index[gene] for gene in table.genes], dtype=np.intp)[table.gene_codes]
+            s = np.array([sample_index[sample] for sample in table.samples], dtype=np.intp)[table.sample_codes]
+            if np.unique(g * len(samples) + s).size != len(table):
+                raise ValueError(f"Plate {p} has more than one measurement for the same gene and sample.")
+            values[p, g, s, :table.n_replicates] = table.values
+            present[p, g, s] = True
+            lengths[p, g, s] = table.lengths
+            gene_types[p, g] = table.column("gene_type")
+            sample_types[p, s] = table.column("sample_type")
+
+        return cls(values, present, lengths, genes, samples, gene_types, sample_types)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def to_table(self, plate, values):
+        """`MeasurementTable` of one plate, `values` is an array shaped like `self.values`.
+
+        Rows are in the order the per plate analysis returns them.
+        """
+        g, s = np.nonzero(self.present[plate])
+        gene_types = self.gene_types[plate, g]
+        order = np.lexsort((s, g, [str(t) if t else '' for t in gene_types]))
+        g, s = g[order], s[order]
+        return MeasurementTable.from_columns(values[plate, g, s],
+                                             [self.genes[i] for i in g],
+                                             self.gene_types[plate, g].tolist(),
+                                             [self.samples[i] for i in s],
+                                             self.sample_types[plate, s].tolist(),
+                                             lengths=self.lengths[plate, g, s])
+
+
+def housekeeping_means(stack):
+    """Housekeeping Ct per (plate, sample).
+
+    If several housekeeping genes were measured for a sample, the last one in gene order
+    is used, as in `calculate_housekeeping_normalisation`.
+    """
+    is_housekeeping = stack.gene_types == 'HK'
+    housekeeping_gene = _last_true(is_housekeeping[:, :, None] & stack.present, axis=1)
+    means = row_means(_gather(stack.values, housekeeping_gene, axis=1))
+    is_water = np.array([sample == 'water' for sample in stack.samples], dtype=bool)
+    means[:, is_water] = 0
+    return means
+
+
+def calibrator_means(stack, delta):
+    """Mean ΔCt of every (plate, gene) in the calibrator sample, see `calculate_pluripotent_normalisation`"""
+    is_calibrator = stack.sample_types == 'normalize'
+    calibrator_sample = _last_true(is_calibrator[:, None, :] & stack.present, axis=2)
+    return row_means(_gather(delta, calibrator_sample, axis=2))
+
+
+def delta_delta_ct(stack):
+    """ΔCt, ΔΔCt and fold change of every well in the stack in one pass"""
+    delta = stack.values - housekeeping_means(stack)[:, None, :, None]
+    delta_delta = delta - calibrator_means(stack, delta)[:, :, None, None]
+    return EngineResult(delta, delta_delta, np.power(2.0, -delta_delta))
+
+
+def analyse_tables(tables):
+    """Run the ΔΔCt analysis on many plates, return one ΔΔCt `MeasurementTable` per plate"""
+    stack = PlateStack.from_tables(tables)
+    result = delta_delta_ct(stack)
+    return [stack.to_table(p, result.delta_delta) for p in range(len(stack))]
@@ -0,0 +1,389 @@
+"""
+Block access to Excel workbooks
+
+Every property read through xlwings is a round trip to Excel. Reading a plate cell by cell
+therefore costs hundreds of round trips. `Workbook` instead fetches the values of a whole
+block in one call and resolves fill colours by asking for the colour of large areas first
+and only splitting areas that are not uniformly coloured, which for a plate layout made of
+coloured blocks needs a few dozen calls. The analysis only sees plain lists of lists.
+
+The actual Excel access is done by a backend:
+
+* `XlwingsBackend` talks to a running Excel through xlwings.
+* `OpenpyxlBackend` parses .xlsx files directly, so analysis books can be processed on
+  machines without Excel.
+* `MemoryBackend` keeps sheets in memory and records every call, so the import can be
+  benchmarked and tested on machines without Excel.
+
+A backend implements `sheet_names()`, `read_values(sheet, area)` and `read_color(sheet, area)`,
+where `area` is a `(first_row, first_column, last_row, last_column)` tuple of 1-based
+indices. `read_color` returns the fill colour as an `(r, g, b)` tuple, None for no fill or
+`MIXED` if the area has more than one fill. A backend that can read all fill colours of an
+area at once can additionally implement `read_colors(sheet, area)`. A backend that can only
+answer for single cells sets `uniform_colors = False`, its colours are then read cell by
+cell instead of splitting areas down to every cell anyway. Backends that can be
+written to implement `write_values(sheet, area, values)` and `write_color(sheet, area, color)`.
+
+Writing works the same way in reverse: `Sheet.paint` merges cells of the same colour into
+rectangles and fills every rectangle with one call.
+"""
+
+import colorsys
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+
+MIXED = object()
+
+_alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + _alphabet.index(letter) + 1
+    return index
+
+
+def parse_area(address):
+    """Convert an address like "B2:Y17" or "C4" into an area tuple"""
+    corners = []
+    for corner in address.replace("$", "").split(":"):
+        letters = corner.rstrip("0123456789")
+        corners.append((int(corner[len(letters):]), column_index(letters)))
+    if len(corners) == 1:
+        corners.append(corners[0])
+    (first_row, first_column), (last_row, last_column) = corners
+    return first_row, first_column, last_row, last_column
+
+
+class Workbook:
+    """Reads blocks of values and fill colours from a backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def sheet_names(self):
+        return self.backend.sheet_names()
+
+    def sheet(self, name):
+        return Sheet(self, name)
+
+    def values(self, sheet, address):
+        """Values of the area at `address` as a list of rows"""
+        return self.backend.read_values(sheet, parse_area(address))
+
+    def colors(self, sheet, address):
+        """Fill colours of the area at `address` as a list of rows"""
+        area = parse_area(address)
+        if hasattr(self.backend, "read_colors"):
+            return self.backend.read_colors(sheet, area)
+        first_row, first_column, last_row, last_column = area
+        if not getattr(self.backend, "uniform_colors", True):
+            return [[self.backend.read_color(sheet, (row, column, row, column)) for column in range(first_column, last_column + 1)]
+                    for row in range(first_row, last_row + 1)]
+        colors = [[None] * (last_column - first_column + 1) for _ in range(last_row - first_row + 1)]
+        self._fill_colors(sheet, area, area, colors)
+        return colors
+
+    def _fill_colors(self, sheet, area, origin, colors):
+        first_row, first_column, last_row, last_column = area
+        color = self.backend.read_color(sheet, area)
+        if color is not MIXED:
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    colors[row - origin[0]][column - origin[1]] = color
+            return
+        if first_row == last_row and first_column == last_column:
+            raise ValueError(f"Backend reported mixed colours for the single cell {area}.")
+        # split the area in half along its longer side
+        if last_row - first_row >= last_column - first_column:
+            middle = (first_row + last_row) // 2
+            halves = [(first_row, first_column, middle, last_column), (middle + 1, first_column, last_row, last_column)]
+        else:
+            middle = (first_column + last_column) // 2
+            halves = [(first_row, first_column, last_row, middle), (first_row, middle + 1, last_row, last_column)]
+        for half in halves:
+            self._fill_colors(sheet, half, origin, colors)
+
+
+def color_rectangles(colors):
+    """Split a grid of colours into rectangles of one colour.
+
+    Returns a list of `((first_row, first_column, last_row, last_column), color)` with
+    0-based indices into `colors`. Runs of equal colour within a row are merged first,
+    identical runs in consecutive rows are then merged into one rectangle.
+    """
+    rectangles = []
+    open_runs = {}
+    for row, row_colors in enumerate(colors + [[]]):
+        runs = {}
+        start = 0
+        for column in range(1, len(row_colors) + 1):
+            if column == len(row_colors) or row_colors[column] != row_colors[start]:
+                runs[(start, column - 1, row_colors[start])] = row
+                start = column
+        for run, first_row in open_runs.items():
+            if run in runs:
+                runs[run] = first_row
+            else:
+                first_column, last_column, color = run
+                rectangles.append(((first_row, first_column, row - 1, last_column), color))
+        open_runs = runs
+    return rectangles
+
+
+class Sheet:
+    """One sheet of a `Workbook`, addresses are relative to the whole sheet"""
+
+    def __init__(self, workbook, name):
+        self.workbook = workbook
+        self.name = name
+
+    def values(self, address):
+        return self.workbook.values(self.name, address)
+
+    def colors(self, address):
+        return self.workbook.colors(self.name, address)
+
+    def write_values(self, row, column, values):
+        """Write a list of rows with its top left corner at `(row, column)`"""
+        if not values:
+            return
+        area = (row, column, row + len(values) - 1, column + max(len(line) for line in values) - 1)
+        self.workbook.backend.write_values(self.name, area, values)
+
+    def paint(self, row, column, colors):
+        """Fill a grid of colours with its top left corner at `(row, column)`, one call per rectangle of equal colour"""
+        for (first_row, first_column, last_row, last_column), color in color_rectangles(colors):
+            area = (row + first_row, column + first_column, row + last_row, column + last_column)
+            self.workbook.backend.write_color(self.name, area, color)
+
+
+def as_sheet(sheet):
+    """Wrap an xlwings sheet in a `Sheet`, sheets are returned unchanged"""
+    if isinstance(sheet, Sheet):
+        return sheet
+    return Sheet(as_workbook(sheet.book), sheet.name)
+
+
+def as_workbook(book):
+    """Wrap an xlwings book in a `Workbook`, workbooks are returned unchanged"""
+    if isinstance(book, Workbook):
+        return book
+    return Workbook(XlwingsBackend(book))
+
+
+class XlwingsBackend:
+    """Backend for a workbook opened in a running Excel"""
+
+    XL_COLOR_INDEX_NONE = -4142
+
+    def __init__(self, book):
+        self.book = book
+        # only the windows COM interface tells us whether an area is uniformly filled
+        self.uniform_colors = sys.platform.startswith("win")
+
+    def _range(self, sheet, area):
+        first_row, first_column, last_row, last_column = area
+        return self.book.sheets[sheet].range((first_row, first_column), (last_row, last_column))
+
+    def sheet_names(self):
+        return [sheet.name.strip() for sheet in self.book.sheets]
+
+    def read_values(self, sheet, area):
+        return self._range(sheet, area).options(ndim=2).value
+
+    def read_color(self, sheet, area):
+        rng = self._range(sheet, area)
+        if area[0] == area[2] and area[1] == area[3]:
+            return rng.color
+        if not self.uniform_colors:
+            return MIXED
+        from xlwings.utils import int_to_rgb
+        interior = rng.api.Interior
+        color_index = interior.ColorIndex
+        if color_index is None:
+            return MIXED
+        if color_index == self.XL_COLOR_INDEX_NONE:
+            return None
+        color = interior.Color
+        if color is None:
+            return MIXED
+        return int_to_rgb(color)
+
+    def write_values(self, sheet, area, values):
+        self._range(sheet, area).value = values
+
+    def write_color(self, sheet, area, color):
+        self._range(sheet, area).color = color
+
+
+def _hex_to_rgb(value):
+    value = value[-6:]
+    return tuple(int(value[i:i+2], 16) for i in (0, 2, 4))
+
+
+def _apply_tint(rgb, tint):
+    """Lighten (positive tint) or darken (negative tint) a colour the way Excel does"""
+    if not tint:
+        return rgb
+    hue, lightness, saturation = colorsys.rgb_to_hls(*[c / 255 for c in rgb])
+    if tint < 0:
+        lightness = lightness * (1 + tint)
+    else:
+        lightness = lightness * (1 - tint) + tint
+    return tuple(int(round(c * 255)) for c in colorsys.hls_to_rgb(hue, lightness, saturation))
+
+
+def _theme_colors(theme_xml):
+    """RGB colours of a workbook theme, in the order fills refer to them"""
+    if not theme_xml:
+        return []
+    namespace = {"a": "http://schemas.openxmlformats.org/drawingml/2006/main"}
+    scheme = ElementTree.fromstring(theme_xml).find("a:themeElements/a:clrScheme", namespace)
+    if scheme is None:
+        return []
+    colors = []
+    for entry in scheme:
+        value = None
+        for color in entry:
+            value = color.get("val") if color.tag.endswith("srgbClr") else color.get("lastClr")
+        colors.append(_hex_to_rgb(value) if value else None)
+    # fills count light before dark: lt1, dk1, lt2, dk2, accents...
+    colors[0:4] = colors[1:2] + colors[0:1] + colors[3:4] + colors[2:3]
+    return colors
+
+
+class OpenpyxlBackend:
+    """Read-only backend parsing an .xlsx file with openpyxl.
+
+    The file is opened once and a sheet is only parsed when it is first used. Values are
+    returned like xlwings returns them, in particular numbers are always floats. Fill
+    colours are resolved to `(r, g, b)` tuples, including theme colours with a tint.
+    """
+
+    def __init__(self, path):
+        import openpyxl
+        from openpyxl.styles.colors import COLOR_INDEX
+        self.path = path
+        self.book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        self._indexed = COLOR_INDEX
+        self._theme = _theme_colors(self.book.loaded_theme)
+        self._sheets = {}
+
+    def close(self):
+        self.book.close()
+
+    def sheet_names(self):
+        return [name.strip() for name in self.book.sheetnames]
+
+    def _worksheet(self, sheet):
+        for name in self.book.sheetnames:
+            if name.strip() == sheet:
+                return self.book[name]
+        raise KeyError(sheet)
+
+    def _color(self, fill):
+        if fill is None or fill.fill_type is None:
+            return None
+        color = fill.fgColor
+        if color.type == "rgb":
+            return _hex_to_rgb(color.rgb)
+        if color.type == "indexed" and color.indexed < len(self._indexed):
+            return _hex_to_rgb(self._indexed[color.indexed])
+        if color.type == "theme" and color.theme < len(self._theme):
+            return _apply_tint(self._theme[color.theme], color.tint)
+        return None
+
+    def _value(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if value == "":
+            return None
+        return value
+
+    def _cells(self, sheet):
+        if sheet not in self._sheets:
+            cells = {}
+            for row in self._worksheet(sheet).iter_rows():
+                for cell in row:
+                    if not hasattr(cell, "row"):
+                        continue
+                    color = self._color(cell.fill) if cell.has_style else None
+                    if cell.value is not None or color is not None:
+                        cells[(cell.row, cell.column)] = (self._value(cell.value), color)
+            self._sheets[sheet] = cells
+        return self._sheets[sheet]
+
+    def _area(self, sheet, area):
+        first_row, first_column, last_row, last_column = area
+        cells = self._cells(sheet)
+        return [[cells.get((row, column), (None, None)) for column in range(first_column, last_column + 1)]
+                for row in range(first_row, last_row + 1)]
+
+    def read_values(self, sheet, area):
+        return [[value for value, _ in row] for row in self._area(sheet, area)]
+
+    def read_colors(self, sheet, area):
+        return [[color for _, color in row] for row in self._area(sheet, area)]
+
+    def read_color(self, sheet, area):
+        colors = {color for row in self.read_colors(sheet, area) for color in row}
+        return colors.pop() if len(colors) == 1 else MIXED
+
+
+class MemoryBackend:
+    """Backend keeping sheets in memory.
+
+    `sheets` maps sheet names to dicts mapping `(row, column)` to `(value, color)`. Every
+    call is appended to `calls` and, to simulate the cost of talking to Excel, takes at least
+    `latency` seconds.
+    """
+
+    def __init__(self, sheets, latency=0):
+        self.sheets = sheets
+        self.latency = latency
+        self.calls = []
+
+    def _call(self, name, *args):
+        self.calls.append((name, *args))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _cells(self, sheet, area):
+        first_row, first_column, last_row, last_column = area
+        cells = self.sheets[sheet]
+        return [[cells.get((row, column), (None, None)) for column in range(first_column, last_column + 1)]
+                for row in range(first_row, last_row + 1)]
+
+    def sheet_names(self):
+        self._call("sheet_names")
+        return list(self.sheets)
+
+    def read_values(self, sheet, area):
+        self._call("read_values", sheet, area)
+        return [[value for value, _ in row] for row in self._cells(sheet, area)]
+
+    def read_color(self, sheet, area):
+        self._call("read_color", sheet, area)
+        colors = {color for row in self._cells(sheet, area) for _, color in row}
+        if len(colors) > 1:
+            return MIXED
+        return colors.pop()
+
+    def write_values(self, sheet, area, values):
+        self._call("write_values", sheet, area)
+        cells = self.sheets.setdefault(sheet, {})
+        for row, line in enumerate(values, start=area[0]):
+            for column, value in enumerate(line, start=area[1]):
+                cells[(row, column)] = (value, cells.get((row, column), (None, None))[1])
+
+    def write_color(self, sheet, area, color):
+        self._call("write_color", sheet, area, color)
+        cells = self.sheets.setdefault(sheet, {})
+        first_row, first_column, last_row, last_column = area
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                cells[(row, column)] = (cells.get((row, column), (None, None))[0], color)
@@ -1,21 +1,19 @@
 from bokeh.plotting import figure
 from bokeh.layouts import layout
+import re
 import sys
+import weakref
 from bokeh.models import Whisker, ColumnDataSource, Slope, Span, Row, Column
-from bokeh.io import show, output_notebook, export_svgs
 from bokeh.core.properties import value
 #import xlwings
-import pandas
 import numpy as np
-import numpy as np
-import pandas as pd
 from bokeh.models import LabelSet, ColumnDataSource, CustomJSTransform
 from bokeh.palettes import Category10_10
 from bokeh.transform import transform
-from bokeh.io import export_svgs
-from bokeh.io import export_png
 
 def save(obj, filename):
+    # exporting needs a browser driver, only load it when exporting
+    from bokeh.io import export_png
 
     backend = obj.output_backend
     obj.output_backend = "svg"
@@ -27,6 +25,8 @@ def export_as_svg(figure, name):
         for i, p in enumerate(figure.children):
             export_as_svg(p, name+'.'+str(i))
         return
+    from bokeh.io import export_svgs
+
     backend = figure.output_backend
     figure.output_backend = 'svg'
     figure.toolbar_location=None
@@ -170,12 +170,111 @@ def general_mapper(column, mapped_to, to_map):
     return transform(column, t)
 
 
+def category_index(values, categories):
+    """Position of every value in `categories`, -1 for values not in `categories`"""
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.intp)
+    lookup = {str(c): i for i, c in enumerate(categories)}
+    uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return np.array([lookup.get(u, -1) for u in uniques.tolist()], dtype=np.intp)[inverse]
+
+
+def natural_key(text):
+    """Sort key comparing the numbers in `text` by value, so d2 sorts before d10"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text)]
+
+
+def natural_rank(values):
+    """Rank of every value in natural order (see `natural_key`), for sorting with numpy"""
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.intp)
+    uniques, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    ranks = np.empty(len(uniques), dtype=np.intp)
+    ranks[sorted(range(len(uniques)), key=lambda i: natural_key(uniques[i]))] = np.arange(len(uniques))
+    return ranks[inverse]
+
+
+def replicate_columns(gene_data):
+    """Names of the replicate columns R1, R2, ... of `gene_data` in order"""
+    return sorted((name for name in gene_data if re.fullmatch(r"R\d+", name)), key=lambda name: int(name[1:]))
+
+
+def pivot(gene_data, genes, samples, column="mean"):
+    """Dense genes x samples matrix of a `gene_data` column, NaN where a pair was not measured"""
+    matrix = np.full((len(genes), len(samples)), np.nan)
+    gene_index = category_index(gene_data["Gene"], genes)
+    sample_index = category_index(gene_data["Sample"], samples)
+    found = (gene_index >= 0) & (sample_index >= 0)
+    values = np.asarray(gene_data[column], dtype=np.float64)
+    matrix[gene_index[found], sample_index[found]] = values[found]
+    return matrix
+
+
+class UpdateScheduler:
+    """Collects the calls of `mutate_bokeh` methods and runs them in one next tick callback.
+
+    A repeated call of the same method on the same object replaces the pending one, dict
+    arguments of both calls are merged. All calls of one tick run inside a single document
+    hold, so the browser receives the changes as one batch. Calls made while the pending
+    calls run, e.g. a widget updating its children, are run in the same batch.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self._pending = {}
+        self._scheduled = False
+        self._flushing = False
+
+    @staticmethod
+    def _merge(old, new):
+        if len(old) != len(new):
+            return new
+        return tuple({**o, **n} if isinstance(o, dict) and isinstance(n, dict) else n for o, n in zip(old, new))
+
+    def schedule(self, f, obj, args, kwargs):
+        key = (f, id(obj))
+        if key in self._pending:
+            _, old_args, old_kwargs = self._pending[key]
+            args = self._merge(old_args, args)
+            kwargs = {**old_kwargs, **kwargs}
+        self._pending[key] = (obj, args, kwargs)
+        if not self._scheduled and not self._flushing:
+            self._scheduled = True
+            self.doc.add_next_tick_callback(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        self._flushing = True
+        self.doc.hold("combine")
+        try:
+            while self._pending:
+                (f, _), (obj, args, kwargs) = _pop_first(self._pending)
+                f(obj, *args, **kwargs)
+        finally:
+            self._flushing = False
+            self.doc.unhold()
+
+
+def _pop_first(d):
+    key = next(iter(d))
+    return key, d.pop(key)
+
+
 def mutate_bokeh(f):
+    """Run a method that changes bokeh models through the `UpdateScheduler` of the document of `self`.
+
+    `self.doc` is the bokeh document the models of the object belong to, or None while they
+    are not part of a document, then the method runs at once.
+    """
     def wrapped(self, *args, **kwargs):
-        if mutate_bokeh.doc is not None:
-            mutate_bokeh.doc.add_next_tick_callback(lambda: f(self, *args, **kwargs))
+        doc = getattr(self, "doc", None)
+        if doc is not None:
+            scheduler = mutate_bokeh.schedulers.get(doc)
+            if scheduler is None:
+                scheduler = mutate_bokeh.schedulers[doc] = UpdateScheduler(doc)
+            scheduler.schedule(f, self, args, kwargs)
         else:
             return f(self, *args, **kwargs)
     return wrapped
 
-mutate_bokeh.doc = None
+mutate_bokeh.schedulers = weakref.WeakKeyDictionary()
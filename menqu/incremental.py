@@ -0,0 +1,196 @@
+"""
+ΔΔCt analysis that follows changes of the excluded wells without starting over
+
+`IncrementalAnalysis` keeps the Cq value and well of every measurement of a run, so wells
+can be excluded and included again without reading the files. The first analysis runs the
+same steps as `menqu.analysis._main_csv`, afterwards `set_excluded` only recomputes what
+depends on the wells that changed:
+
+* a (sample, gene) row depends on its own wells,
+* the housekeeping norm of a sample on its housekeeping row, and every row of the sample
+  on that norm,
+* the calibrator norm of a gene on its row in the normalizing sample (and so on the
+  housekeeping norm of that sample), and every row of the gene on that norm.
+
+Rows of `gene_data` keep their place, only the changed entries get new values. When the
+rows or replicate columns themselves change (a row loses or gains all its wells, the most
+replicates of any row changes) the analysis is run again from the start.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from menqu.analysis import (excluded_well_keys, pack_replicates, check_data_validity, sort_measurements,
+                            calculate_housekeeping_normalisation, normalize_housekeeping,
+                            calculate_pluripotent_normalisation, normalize_pluripotent)
+from menqu.measurements import MeasurementTable, row_means
+
+
+Measurements = namedtuple("Measurements", ["groups", "group_ids", "cq", "wells"])
+Measurements.__doc__ = """Raw measurements of a run, see `MeasurementAccumulator.measurements`"""
+
+
+class IncrementalAnalysis:
+    """Analysis of `measurements` that can change its excluded wells, see the module docstring.
+
+    `data` is the result as returned by `menqu.data_importers.calculate_data`.
+    """
+
+    def __init__(self, measurements, housekeeping, normalize, name, condition_data, conditions, excluded_wells=()):
+        self.groups = [tuple(group) for group in measurements.groups]
+        self.group_ids = np.asarray(measurements.group_ids, dtype=np.intp)
+        self.cq = np.asarray(measurements.cq, dtype=np.float64)
+        self.housekeeping = housekeeping
+        self.normalize = normalize
+        self.name = name
+        self.condition_data = condition_data
+        self.conditions = conditions
+
+        # wells that are no well ("", NaN) are never excluded
+        wells = np.array([well if isinstance(well, str) else "" for well in measurements.wells], dtype=str)
+        well_names, self._well_codes = np.unique(wells, return_inverse=True)
+        self._well_index = {well: code for code, well in enumerate(well_names) if well}
+
+        counts = np.bincount(self.group_ids, minlength=len(self.groups))
+        self._order = np.argsort(self.group_ids, kind="stable")
+        self._starts = np.cumsum(counts) - counts
+        self._counts = counts
+
+        self.__dict__.update(self._analyse(excluded_well_keys(excluded_wells)))
+
+    def _excluded_mask(self, excluded):
+        codes = [self._well_index[well] for well in excluded if well in self._well_index]
+        return np.isin(self._well_codes, codes)
+
+    def _analyse(self, excluded):
+        """Run the whole analysis, returns the new state"""
+        from menqu.data_importers import calculate_data
+
+        measured = ~self._excluded_mask(excluded)
+        values, lengths = pack_replicates(self.group_ids[measured], self.cq[measured], len(self.groups))
+        identifiers = [identifier for identifier, _ in self.groups]
+        genes = [gene for _, gene in self.groups]
+        table = MeasurementTable.from_columns(values, genes, [None] * len(genes), identifiers, [None] * len(identifiers), lengths=lengths)
+        table = table.with_types({self.housekeeping: "HK"}, {self.normalize: "normalize"})
+
+        check_data_validity(table)
+        table = sort_measurements(table)
+        table = table.take(table.has_data())
+        housekeeping = calculate_housekeeping_normalisation(table)
+        table = table.take(table.category_mask("sample", bool))
+        delta = normalize_housekeeping(table, housekeeping)
+        pluripotent = calculate_pluripotent_normalisation(delta)
+        data = calculate_data(normalize_pluripotent(delta, pluripotent), self.name, self.condition_data, self.conditions)
+
+        group_index = {group: i for i, group in enumerate(self.groups)}
+        row_of_group = np.full(len(self.groups), -1, dtype=np.intp)
+        for row, group in enumerate(zip(table.column("sample"), table.column("gene"))):
+            row_of_group[group_index[group]] = row
+
+        # the last row wins, like the dicts of the norms
+        hk_row = np.full(len(table.samples), -1, dtype=np.intp)
+        for row in np.flatnonzero(table.category_mask("gene_type", lambda gene_type: gene_type == "HK")):
+            if table.samples[table.sample_codes[row]] != "water":
+                hk_row[table.sample_codes[row]] = row
+        calibrator_row = np.full(len(table.genes), -1, dtype=np.intp)
+        for row in np.flatnonzero(table.category_mask("sample_type", lambda sample_type: sample_type == "normalize")):
+            calibrator_row[table.gene_codes[row]] = row
+
+        return {"data": data,
+                "excluded": set(excluded),
+                "_ct": table.values.copy(),
+                "_lengths": table.lengths.copy(),
+                "_width": int(table.lengths.max(initial=0)),
+                "_sample_codes": table.sample_codes,
+                "_gene_codes": table.gene_codes,
+                "_row_of_group": row_of_group,
+                "_hk_row": hk_row,
+                "_calibrator_row": calibrator_row,
+                "_hk": np.array([housekeeping.get(sample, np.nan) for sample in table.samples]),
+                "_calibrator": np.array([pluripotent.get(gene, np.nan) for gene in table.genes])}
+
+    def _replicates(self, group, excluded_mask):
+        index = self._order[self._starts[group]:self._starts[group] + self._counts[group]]
+        return self.cq[index[~excluded_mask[index]]]
+
+    def set_excluded(self, excluded_wells):
+        """Exclude `excluded_wells` (and include all others) and update `data`.
+
+        Returns the indices of the changed `gene_data` rows, or None if the analysis was run
+        again because its rows or columns changed. Raises ValueError if the analysis is not
+        possible with these exclusions (e.g. all wells of a housekeeping row are excluded),
+        the previous exclusions and data are kept then.
+        """
+        excluded = excluded_well_keys(excluded_wells)
+        changed_wells = excluded ^ self.excluded
+        if not changed_wells:
+            return np.zeros(0, dtype=np.intp)
+        excluded_mask = self._excluded_mask(excluded)
+        changed_groups = np.unique(self.group_ids[self._excluded_mask(changed_wells)])
+        identifiers = [self.groups[group][0] for group in changed_groups]
+        changed_groups = np.array([group for group, identifier in zip(changed_groups, identifiers) if identifier], dtype=np.intp)
+
+        state = self._update_rows(changed_groups, excluded_mask)
+        if state is None:
+            try:
+                state = self._analyse(excluded)
+            except (KeyError, ZeroDivisionError, SystemExit) as e:
+                raise ValueError(f"Can't analyse the run without the wells {', '.join(sorted(excluded))}: {e!r}")
+            changed_rows = None
+        else:
+            changed_rows = state.pop("changed_rows")
+        state["excluded"] = excluded
+        self.__dict__.update(state)
+        return changed_rows
+
+    def _update_rows(self, changed_groups, excluded_mask):
+        """New state after the wells of `changed_groups` changed, None if the rows or columns change"""
+        rows = self._row_of_group[changed_groups]
+        if (rows < 0).any():
+            return None
+        ct = self._ct.copy()
+        lengths = self._lengths.copy()
+        for group, row in zip(changed_groups, rows):
+            replicates = self._replicates(group, excluded_mask)
+            if len(replicates) > ct.shape[1] or not np.any(replicates != 0):
+                return None
+            ct[row] = np.nan
+            ct[row, :len(replicates)] = replicates
+            lengths[row] = len(replicates)
+        if int(lengths.max(initial=0)) != self._width:
+            return None
+
+        # housekeeping norms of the samples whose housekeeping row changed
+        hk = self._hk.copy()
+        samples = np.unique(self._sample_codes[rows])
+        samples = samples[np.isin(self._hk_row[samples], rows)]
+        hk[samples] = row_means(ct[self._hk_row[samples]])
+        if np.isnan(hk[samples]).any():
+            return None
+        delta_rows = np.flatnonzero(np.isin(self._sample_codes, samples[hk[samples] != self._hk[samples]]))
+        delta_rows = np.union1d(rows, delta_rows)
+
+        # calibrator norms of the genes whose calibrator row changed
+        calibrator = self._calibrator.copy()
+        genes = np.unique(self._gene_codes[delta_rows])
+        genes = genes[np.isin(self._calibrator_row[genes], delta_rows)]
+        calibrator_rows = self._calibrator_row[genes]
+        calibrator[genes] = row_means(ct[calibrator_rows] - hk[self._sample_codes[calibrator_rows]][:, None])
+        if np.isnan(calibrator[genes]).any():
+            return None
+        changed_rows = np.flatnonzero(np.isin(self._gene_codes, genes[calibrator[genes] != self._calibrator[genes]]))
+        changed_rows = np.union1d(delta_rows, changed_rows)
+
+        # the same operations in the same order as the full analysis, so the values are identical
+        delta = ct[changed_rows] - hk[self._sample_codes[changed_rows]][:, None]
+        fold_changes = np.power(2.0, -(delta - calibrator[self._gene_codes[changed_rows]][:, None])[:, :self._width])
+        gene_data = dict(self.data["gene_data"])
+        gene_data["mean"] = gene_data["mean"].copy()
+        gene_data["mean"][changed_rows] = row_means(fold_changes)
+        for i in range(self._width):
+            gene_data[f"R{i + 1}"] = gene_data[f"R{i + 1}"].copy()
+            gene_data[f"R{i + 1}"][changed_rows] = fold_changes[:, i]
+
+        return {"data": dict(self.data, gene_data=gene_data), "_ct": ct, "_lengths": lengths,
+                "_hk": hk, "_calibrator": calibrator, "changed_rows": changed_rows}
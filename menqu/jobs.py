@@ -0,0 +1,220 @@
+"""
+Running analysis jobs outside of the bokeh IO loop
+
+Imports parse files, normalize and calculate fold changes, which takes a while for big runs.
+Done inside a bokeh callback this freezes the interface, so `JobExecutor` runs such jobs in
+a process pool. Job functions get a `JobContext` as `job` keyword argument to report progress,
+which also raises `JobCancelled` once the job was cancelled:
+
+    def import_something(path, job=NO_JOB):
+        job.progress(0.5, "parsing")
+        ...
+
+The executor never calls back on its own. `poll` has to be called regularly from the thread
+owning the interface (the App does so from a periodic bokeh callback); it applies progress
+events to the `Job`s and calls `on_done` with the result of every finished job.
+
+Jobs that have to stay in this process, e.g. because they talk to Excel over COM, can run
+in a thread instead. Several executors, e.g. one per session of a server, can share the
+worker processes of one `JobPools`.
+"""
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import queue
+import threading
+
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """Passed to a job function to report progress and to check for cancellation"""
+
+    def __init__(self, job_id, events, cancelled):
+        self.job_id = job_id
+        self._events = events
+        self._cancelled = cancelled
+
+    def progress(self, fraction, message=""):
+        if self.job_id in self._cancelled:
+            raise JobCancelled()
+        self._events.put((self.job_id, fraction, message))
+
+
+class _NoJob:
+
+    def progress(self, fraction, message=""):
+        pass
+
+NO_JOB = _NoJob()
+
+
+def _run(f, args, kwargs, context):
+    return f(*args, job=context, **kwargs)
+
+
+class Job:
+
+    def __init__(self, job_id, name, future, on_done):
+        self.id = job_id
+        self.name = name
+        self.future = future
+        self.on_done = on_done
+        self.status = RUNNING
+        self.progress = 0.0
+        self.message = "queued"
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name} {self.status} {self.progress:.0%} {self.message}>"
+
+
+class JobPools:
+    """Worker pools and the manager process of one or more `JobExecutor`s.
+
+    `processes` worker processes, one per CPU by default. The pools and the manager process
+    sharing progress events and cancellations with the workers are started with the first
+    job. Progress events of all executors arrive on the same queues, whichever executor polls
+    first keeps the events of the others until they poll.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._ids = itertools.count(1)
+        self._process_pool = None
+        self._thread_pool = None
+        self._manager = None
+        self._events = None
+        self._cancelled = None
+        self._local_events = queue.Queue()
+        self._local_cancelled = set()
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def submit(self, f, args, kwargs, thread):
+        """Start `f` in a worker, returns the job id and the future"""
+        with self._lock:
+            job_id = next(self._ids)
+            if thread:
+                if self._thread_pool is None:
+                    self._thread_pool = concurrent.futures.ThreadPoolExecutor(1)
+                pool, context = self._thread_pool, JobContext(job_id, self._local_events, self._local_cancelled)
+            else:
+                if self._process_pool is None:
+                    self._manager = multiprocessing.Manager()
+                    self._events = self._manager.Queue()
+                    self._cancelled = self._manager.dict()
+                    self._process_pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+                pool, context = self._process_pool, JobContext(job_id, self._events, self._cancelled)
+        return job_id, pool.submit(_run, f, args, kwargs, context)
+
+    def cancel(self, job_id):
+        self._local_cancelled.add(job_id)
+        if self._cancelled is not None:
+            self._cancelled[job_id] = True
+
+    def _drain(self, events):
+        while True:
+            try:
+                yield events.get_nowait()
+            except queue.Empty:
+                return
+
+    def progress(self, job_ids):
+        """The latest (fraction, message) of the jobs in `job_ids` that reported progress since the last call"""
+        with self._lock:
+            for events in (self._events, self._local_events):
+                if events is None:
+                    continue
+                for job_id, fraction, message in self._drain(events):
+                    self._progress[job_id] = (fraction, message)
+            return {job_id: self._progress.pop(job_id) for job_id in job_ids if job_id in self._progress}
+
+    def forget(self, job_id):
+        """Drop the state of a finished job"""
+        with self._lock:
+            self._progress.pop(job_id, None)
+
+    def shutdown(self):
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+
+class JobExecutor:
+    """Run jobs in `pools`, or in own `JobPools` of `processes` worker processes.
+
+    Every executor only reports and finishes its own jobs, so the sessions of a server can
+    each have an executor sharing one `JobPools`.
+    """
+
+    def __init__(self, processes=None, pools=None):
+        self._owns_pools = pools is None
+        self.pools = JobPools(processes) if pools is None else pools
+        self.jobs = {}
+
+    def submit(self, f, *args, name="", on_done=None, thread=False, **kwargs):
+        """Run `f(*args, job=context, **kwargs)` in a worker and return its `Job`.
+
+        `f` has to be importable by the worker processes, i.e. a module level function.
+        With `thread` the job runs in a worker thread of this process instead.
+        """
+        job_id, future = self.pools.submit(f, args, kwargs, thread)
+        job = Job(job_id, name, future, on_done)
+        self.jobs[job_id] = job
+        return job
+
+    def cancel(self, job):
+        """Cancel a job, a running job stops at its next progress report and its result is dropped"""
+        if job.status != RUNNING:
+            return
+        if not job.future.cancel():
+            self.pools.cancel(job.id)
+        job.status = CANCELLED
+        job.message = "cancelled"
+        self.jobs.pop(job.id, None)
+
+    def poll(self):
+        """Apply progress events and finish completed jobs, returns the jobs that changed"""
+        changed = {}
+        for job_id, (fraction, message) in self.pools.progress(list(self.jobs)).items():
+            job = self.jobs[job_id]
+            job.progress, job.message = fraction, message
+            changed[job_id] = job
+
+        for job in [job for job in self.jobs.values() if job.future.done()]:
+            del self.jobs[job.id]
+            self.pools.forget(job.id)
+            changed[job.id] = job
+            try:
+                job.result = job.future.result()
+            except JobCancelled:
+                job.status, job.message = CANCELLED, "cancelled"
+                continue
+            except (Exception, SystemExit) as e:
+                # the analysis still calls sys.exit on bad data, which must not stop the server
+                job.status, job.message, job.error = FAILED, "failed", e
+                continue
+            job.status, job.progress, job.message = DONE, 1.0, "done"
+            if job.on_done is not None:
+                job.on_done(job.result)
+        return list(changed.values())
+
+    def shutdown(self):
+        """Cancel the jobs of this executor, and stop the pools if they are its own"""
+        for job in list(self.jobs.values()):
+            self.cancel(job)
+        if self._owns_pools:
+            self.pools.shutdown()
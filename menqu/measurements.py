@@ -0,0 +1,199 @@
+"""
+Columnar storage of measurements
+
+The analysis originally passed around lists of `Measurement` namedtuples, one per
+(gene, sample) pair, where `data` is a list of Ct values padded with `None`.
+`MeasurementTable` stores the same information as a struct of arrays: gene, gene type,
+sample and sample type are integer codes into small lists of categories and all Ct
+values live in one float matrix (rows x replicates) with NaN for missing or excluded wells.
+
+Tables can be converted from and to the old list of namedtuples and iterating over a
+table yields `Measurement`s, so code written against the list keeps working.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+
+Measurement = namedtuple("Measurement", ["data", "gene_name", "gene_type", "identifier", "sample_type"])
+
+COLUMNS = ("gene", "gene_type", "sample", "sample_type")
+
+
+def _factorize(values):
+    """Return integer codes for `values` and the distinct values in order of first appearance"""
+    categories = {}
+    codes = np.empty(len(values), dtype=np.intp)
+    for i, v in enumerate(values):
+        codes[i] = categories.setdefault(v, len(categories))
+    return codes, list(categories)
+
+
+def _dense_rank(categories, key):
+    """Rank categories by `key`, categories with equal keys get the same rank"""
+    keys = [key(c) for c in categories]
+    ranks = np.empty(len(keys), dtype=np.intp)
+    rank = -1
+    previous = object()
+    for i in sorted(range(len(keys)), key=keys.__getitem__):
+        if keys[i] != previous:
+            rank += 1
+            previous = keys[i]
+        ranks[i] = rank
+    return ranks
+
+
+def row_means(values):
+    """Mean along the last axis ignoring NaN, NaN where there are no values.
+
+    Replicates are summed in order, so the result is bit for bit the same as the
+    python `sum(l) / len(l)` the analysis used before.
+    """
+    present = ~np.isnan(values)
+    total = np.zeros(values.shape[:-1])
+    for j in range(values.shape[-1]):
+        total = total + np.where(present[..., j], values[..., j], 0.0)
+    counts = present.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, total / np.maximum(counts, 1), np.nan)
+
+
+class MeasurementTable:
+    """Measurements of one plate as categorical codes and a float replicate matrix.
+
+    `values` has one row per (gene, sample) pair and one column per replicate, missing
+    or excluded wells are NaN. `lengths` holds the number of replicate slots every row had
+    originally, which keeps the conversion to and from `Measurement` lists lossless.
+    For every column in `COLUMNS` the table has `<column>_codes`, an integer array with
+    one entry per row, and `<column>s`, the list of categories the codes point into.
+    """
+
+    def __init__(self, values, lengths, gene_codes, genes, gene_type_codes, gene_types,
+                 sample_codes, samples, sample_type_codes, sample_types):
+        self.values = values
+        self.lengths = lengths
+        self.gene_codes = gene_codes
+        self.genes = genes
+        self.gene_type_codes = gene_type_codes
+        self.gene_types = gene_types
+        self.sample_codes = sample_codes
+        self.samples = samples
+        self.sample_type_codes = sample_type_codes
+        self.sample_types = sample_types
+
+    @classmethod
+    def from_columns(cls, values, gene_names, gene_types, identifiers, sample_types, lengths=None):
+        """Create a table from a replicate matrix and one python value per row and column"""
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 2:
+            values = values.reshape(len(gene_names), -1)
+        if lengths is None:
+            lengths = np.full(values.shape[0], values.shape[1], dtype=np.intp)
+        gene_codes, genes = _factorize(gene_names)
+        gene_type_codes, gene_types = _factorize(gene_types)
+        sample_codes, samples = _factorize(identifiers)
+        sample_type_codes, sample_types = _factorize(sample_types)
+        return cls(values, np.asarray(lengths, dtype=np.intp), gene_codes, genes, gene_type_codes, gene_types,
+                   sample_codes, samples, sample_type_codes, sample_types)
+
+    @classmethod
+    def from_measurements(cls, measurements):
+        """Create a table from a list of `Measurement` namedtuples"""
+        lengths = [len(m.data) for m in measurements]
+        width = max(lengths, default=0)
+        values = np.full((len(measurements), width), np.nan)
+        for i, m in enumerate(measurements):
+            values[i, :len(m.data)] = [np.nan if x is None else x for x in m.data]
+        return cls.from_columns(values,
+                                [m.gene_name for m in measurements],
+                                [m.gene_type for m in measurements],
+                                [m.identifier for m in measurements],
+                                [m.sample_type for m in measurements],
+                                lengths=lengths)
+
+    def to_measurements(self):
+        """Convert the table back into a list of `Measurement` namedtuples"""
+        values = self.values.tolist()
+        missing = np.isnan(self.values).tolist()
+        measurements = []
+        for i in range(len(self)):
+            length = self.lengths[i]
+            data = [None if m else x for x, m in zip(values[i][:length], missing[i][:length])]
+            measurements.append(Measurement(data,
+                                            self.genes[self.gene_codes[i]],
+                                            self.gene_types[self.gene_type_codes[i]],
+                                            self.samples[self.sample_codes[i]],
+                                            self.sample_types[self.sample_type_codes[i]]))
+        return measurements
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __iter__(self):
+        return iter(self.to_measurements())
+
+    def __repr__(self):
+        return f"<MeasurementTable {len(self)} rows x {self.n_replicates} replicates>"
+
+    @property
+    def n_replicates(self):
+        return self.values.shape[1]
+
+    def column(self, name):
+        """Per row values of the categorical column `name` as an object array"""
+        categories = np.empty(len(getattr(self, name + "s")), dtype=object)
+        categories[:] = getattr(self, name + "s")
+        return categories[getattr(self, name + "_codes")]
+
+    def category_mask(self, name, predicate):
+        """Boolean row mask of all rows whose category in column `name` satisfies `predicate`"""
+        matches = np.array([bool(predicate(c)) for c in getattr(self, name + "s")], dtype=bool)
+        return matches[getattr(self, name + "_codes")]
+
+    def take(self, index):
+        """New table with the rows selected by an index array or boolean mask, categories are shared"""
+        return MeasurementTable(self.values[index], self.lengths[index],
+                                self.gene_codes[index], self.genes,
+                                self.gene_type_codes[index], self.gene_types,
+                                self.sample_codes[index], self.samples,
+                                self.sample_type_codes[index], self.sample_types)
+
+    def with_values(self, values):
+        """New table with the same rows but different replicate values"""
+        return MeasurementTable(values, self.lengths, self.gene_codes, self.genes,
+                                self.gene_type_codes, self.gene_types, self.sample_codes, self.samples,
+                                self.sample_type_codes, self.sample_types)
+
+    def copy(self):
+        return self.with_values(self.values.copy())
+
+    def with_types(self, gene_to_gene_type, identifier_to_type):
+        """New table with gene and sample types looked up by gene and sample, None if missing"""
+        gene_type_codes, gene_types = _factorize([gene_to_gene_type.get(gene) for gene in self.column("gene")])
+        sample_type_codes, sample_types = _factorize([identifier_to_type.get(sample) for sample in self.column("sample")])
+        return MeasurementTable(self.values, self.lengths, self.gene_codes, self.genes,
+                                gene_type_codes, gene_types, self.sample_codes, self.samples,
+                                sample_type_codes, sample_types)
+
+    def argsort(self, keys):
+        """Stable sort order of the rows.
+
+        `keys` is a list of `(column, key)` pairs, most significant first. `key` is called
+        once per category and not once per row.
+        """
+        if len(self) == 0:
+            return np.arange(0)
+        ranks = [_dense_rank(getattr(self, column + "s"), key)[getattr(self, column + "_codes")] for column, key in keys]
+        return np.lexsort(ranks[::-1])
+
+    def has_data(self):
+        """Row mask of rows with at least one truthy value, the columnar `any(m.data)`"""
+        return np.any(~np.isnan(self.values) & (self.values != 0), axis=1)
+
+
+def as_table(data):
+    """Accept a `MeasurementTable` or a list of `Measurement`s and return a table"""
+    if isinstance(data, MeasurementTable):
+        return data
+    return MeasurementTable.from_measurements(list(data))
@@ -5,13 +5,12 @@ from bokeh.palettes import Viridis256
 from bokeh.core.properties import value
 from bokeh.models import Plot, Tabs, Panel, ColorPicker
 from bokeh.plotting.figure import Figure
-from bokeh.io.export import export_svg
 import json
+import base64
+import shutil
+import tempfile
 import threading
 import asyncio
-import pathlib
-import zmq
-import zmq.asyncio
 
 import menqu
 from menqu.helpers import apply_theme
@@ -19,8 +18,12 @@ from menqu.themes import CONDITIONS_THEME
 
 from menqu.analysis import prepare, _main, parse_well, get_sample_data, _update
 from menqu.widgets import BarGraphs, HeatmapGraphs, ColorPickers, Table, WellExcluder, ButtonBar
-from menqu.updater import update, needs_update
-from menqu.datasources import get_fake_data, get_fake_data2, load_from_menqu_file, save_to_menqu_file
+from menqu.updater import update, check_in_background
+from menqu.datasources import get_fake_data, get_fake_data2, load_from_menqu_file, load_from_menqu_bytes, save_to_menqu_file
+from menqu.jobs import JobExecutor
+from menqu.colors import ColorCache
+from menqu import timeline
+from bokeh.events import DocumentReady
 import sys
 import os.path
 import appdirs
@@ -30,12 +33,14 @@ NAME = 'AD20A7_D10.5'
 EXCEL_AREA = 'A1:M1000'
 CACHE_DIR = appdirs.user_cache_dir("menqu")
 CACHE_FILE = os.path.join(CACHE_DIR, "cache")
+# colours of the conditions, shared by all sessions of this process
+COLORS = ColorCache(CACHE_FILE)
+# seconds to wait for the window to confirm closing
+EXIT_TIMEOUT = 5
 
-from menqu.helpers import get_app, get_analysisbook, map_show, plot_data, export_as_svg, show, mutate_bokeh
+from menqu.helpers import get_app, get_analysisbook, map_show, plot_data, export_as_svg, mutate_bokeh
 from menqu.widgets import RootWidget
 import numpy as np
-import pickle
-import pandas
 import os.path
 from functools import wraps
 
@@ -46,10 +51,18 @@ from bokeh.models import ColumnDataSource, Whisker, FactorRange, CDSView, Boolea
 
 
 class App:
+    """One user session: the data, the widgets showing it and the jobs working on it.
 
-    def __init__(self):
+    `rpc` is the `RPCClient` of the desktop window. Without it the app runs in a browser
+    (`menqu serve`), files are then uploaded instead of picked in OS dialogs. `runs` is a
+    `RunCache` shared by the sessions of a server, `processes` the number of job processes.
+    `pools` are `JobPools` shared with other sessions, the session then starts no processes
+    of its own.
+    """
+
+    def __init__(self, rpc=None, runs=None, processes=None, pools=None):
         self.data = get_fake_data()
-        colors = self._load_colors()
+        colors = COLORS.get()
         gene_data = self.data["gene_data"]
         condition_data = self.data["condition_data"]
         conditions = self.data["conditions"]
@@ -59,17 +72,24 @@ class App:
         
         self._importer_step = 0
 
-        self.socket = None
+        self.rpc = rpc
+        self.runs = runs
+        # the `IncrementalAnalysis` of the shown data if it was imported from CSV
+        self.analysis = None
+        self.jobs = JobExecutor(processes, pools)
+        self._upload_dir = None
+        self._update_url = None
+        # the desktop app offers updates, a shared server is updated by whoever runs it
+        self._update_check = check_in_background(menqu.__version__) if rpc is not None else None
 
         data = {"gene_data": gene_data, "condition_data": condition_data, "samples": samples,
                 "genes": genes, "conditions": conditions, "colors": colors}
         self.root_widget = RootWidget(self, data)
         self.root = self.root_widget.root
 
-
-        self._socket_in_use = False
-
-        self._doc = None
+    @property
+    def doc(self):
+        return self.root.document
 
     def _get_suggested_name(self):
         name = self.data["name"]
@@ -79,46 +99,33 @@ class App:
         return name 
 
     async def save_file_dialog(self):
-        if self.socket and not self._socket_in_use:
-            self._socket_in_use = True
-            name = self._get_suggested_name().encode("utf-8")
-            await self.socket.send(b"SAVE" + name)
-            file = await self.socket.recv()
-            self._socket_in_use = False
-
-            if file != b"":
+        if self.rpc is not None:
+            file = await self.rpc.call("save_dialog", self._get_suggested_name())
+
+            if file != "":
                 self.save_to_menqu(file)
 
     async def _load_file_dialog(self):
-        if self.socket and not self._socket_in_use:
-            self._socket_in_use = True
-            await self.socket.send(b"LOAD")
-            file = await self.socket.recv()
-            self._socket_in_use = False
-            return file
+        if self.rpc is not None:
+            return await self.rpc.call("load_dialog")
         return None
 
     async def load_file_dialog(self):
         file = await self._load_file_dialog()
-        if file is not None and file != b"":
-            self.load_from_menqu_file(file)
+        if file:
+            self.load_from_menqu(file)
 
     async def export_file_dialog(self):
-        if self.socket and not self._socket_in_use:
-            self._socket_in_use = True
-            await self.socket.send(b"EXPORT")
-            file = await self.socket.recv()
-            self._socket_in_use = False
+        if self.rpc is not None:
+            file = await self.rpc.call("export_dialog")
 
-            if file != b"":
+            if file != "":
                 self.export_as_svg(file)
 
     async def exit(self):
-        if self.socket and not self._socket_in_use:
-            self._socket_in_use = True
-            await self.socket.send(b"EXIT")
-            file = await self.socket.recv()
-            self._socket_in_use = False
+        if self.rpc is not None:
+            COLORS.flush()
+            await self.rpc.call("exit", timeout=EXIT_TIMEOUT)
 
             sys.exit(0)
 
@@ -126,50 +133,53 @@ class App:
         if self._update_url != None:
             update(self._update_url)
 
-    def update_needed(self):
-        return needs_update(menqu.__version__)
+    def poll_update_check(self):
+        """Show the update button once the background update check found a newer version"""
+        if not self._update_check.done():
+            return
+        self.doc.remove_periodic_callback(self._update_callback)
+        update_needed, self._update_url = self._update_check.result()
+        if update_needed:
+            self.root_widget.show_update()
 
-    def save_colors(self):
-        pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
-        colors = self._load_colors()
-        colors.update(self.colorpickers.colors)
-        self._save_colors(colors)
+    def save_colors(self, colors):
+        """Remember `colors` for later runs, the cache file is written in the background"""
+        COLORS.update(colors)
 
     def load_colors(self):
-        colors = self._load_colors()
-        self.colorpickers.colors.update(colors)
-
-    def _save_colors(self, colors):
-        with open(CACHE_FILE, mode="wb") as f:
-            pickle.dump(colors, f)
+        self.root_widget.colorpickers.update({"colors": {**self.data["colors"], **COLORS.get()}})
 
-    def _load_colors(self):
-        colors = {}
-        try:
-            with open(CACHE_FILE, mode="rb") as f:
-                colors = pickle.load(f)
-        except Exception:
-            pass
-        return colors
-
-    def load_data(self, data):
+    def load_data(self, data, analysis=None):
         self.data = data
+        self.analysis = analysis
+        self.root_widget.exclusion_editor.show(analysis)
         self.load_data_to_plots()
 
+    def load_analysis(self, analysis):
+        self.load_data(analysis.data, analysis)
+
+    def set_excluded_wells(self, text):
+        """Change the excluded wells of the shown analysis, only the changed values are sent to the plots"""
+        if self.analysis is None:
+            return
+        try:
+            changed_rows = self.analysis.set_excluded([well for well in text.split(",") if well.strip()])
+        except Exception as e:
+            self.root_widget.exclusion_editor.show_message(str(e))
+            return
+        self.root_widget.exclusion_editor.show_message("")
+        self.data = self.analysis.data
+        if changed_rows is None:
+            self.load_data_to_plots()
+        elif len(changed_rows):
+            self.update_data({"gene_data": self.data["gene_data"]})
+
     @mutate_bokeh
     def update_data(self, data):
         self.root_widget.update(data)
 
     @mutate_bokeh
     def load_data_to_plots(self):
-        gene_data = self.data["gene_data"]
-        condition_data = self.data["condition_data"]
-        conditions = self.data["conditions"]
-        genes = self.data["genes"]
-        samples = self.data["condition_data"]["Sample"]
-        colors = self._load_colors()
-        colors.update(self.data["colors"])
-
         self.root_widget.update(self.data)
 
     def save_to_menqu(self, filename):
@@ -180,12 +190,40 @@ class App:
         data = load_from_menqu_file(name)
         self.load_data(data)
 
+    def load_upload(self, contents):
+        """Load an uploaded `.menqu` file, `contents` is base64 encoded as sent by a FileInput"""
+        contents = base64.b64decode(contents)
+        if self.runs is not None:
+            data = self.runs.load(contents)
+        else:
+            data = load_from_menqu_bytes(contents)
+        self.load_data(data)
+
+    def store_upload(self, name, contents):
+        """Write an uploaded file into the upload directory of this session and return its path"""
+        if self._upload_dir is None:
+            self._upload_dir = tempfile.mkdtemp(prefix="menqu-")
+        path = os.path.join(self._upload_dir, name)
+        with open(path, mode="wb") as f:
+            f.write(base64.b64decode(contents))
+        return path
+
+    def close(self):
+        """Cancel the jobs and remove the uploads of this session"""
+        self.jobs.shutdown()
+        COLORS.flush()
+        if self._upload_dir is not None:
+            shutil.rmtree(self._upload_dir, ignore_errors=True)
+
     def _get_color_data(self):
-        for name, cp in self.colorpickers.color_pickers.items():
+        for name, cp in self.root_widget.colorpickers.color_pickers.items():
             self.data["colors"][name] = cp.color
 
     @mutate_bokeh
     def export_as_svg(self, filename):
+        # exporting needs a browser driver, only load it when exporting
+        from bokeh.io.export import export_svg
+
         p = self._tabs.tabs[self._tabs.active].child
         self._change_backend_to_svg(p)
         export_svg(p, filename=filename)
@@ -206,8 +244,18 @@ class App:
     
     def transform(self, doc):
         doc.add_root(self.root)
-        self._doc = doc
-        mutate_bokeh.doc = doc
+        doc.add_periodic_callback(self.poll_jobs, 200)
+        if self._update_check is not None:
+            self._update_callback = doc.add_periodic_callback(self.poll_update_check, 500)
+        if timeline.elapsed("first document") is None:
+            timeline.mark("first document")
+            doc.on_event(DocumentReady, lambda event: timeline.mark("first render"))
+
+    def poll_jobs(self):
+        """Apply job progress and load the results of finished jobs"""
+        changed = self.jobs.poll()
+        if changed:
+            self.root_widget.job_progress.show(changed)
 
     def load_fake_data_1(self):
         data = get_fake_data()
@@ -0,0 +1,141 @@
+"""
+Request/reply channel between the bokeh server thread and the OS (pywebview) thread
+
+The bokeh side uses an `RPCClient` on a DEALER socket: every call gets a request id and a
+future, so any number of calls can be in flight at once, each with its own timeout. The OS
+side runs an `RPCServer` on a ROUTER socket, which handles the calls one after the other
+(file dialogs are modal anyway) and sends every reply with the id of its request.
+
+Messages are multipart:
+
+    request: request id, method name, JSON encoded list of arguments
+    reply:   request id, b"OK" or b"ERROR", JSON encoded result or error message
+
+The server blocks in `zmq.Poller.poll` without a timeout and is woken through an inproc
+socket when it has to stop, so stopping takes effect immediately.
+"""
+
+import asyncio
+import itertools
+import json
+
+import zmq
+import zmq.asyncio
+
+
+OK = b"OK"
+ERROR = b"ERROR"
+
+
+class RPCError(Exception):
+    """The remote handler raised an exception"""
+
+
+class RPCClient:
+    """Call methods of an `RPCServer` from asyncio code.
+
+    `context` has to be a `zmq.asyncio.Context`. `timeout` is the default timeout of a call
+    in seconds, None waits forever.
+    """
+
+    def __init__(self, context, address, timeout=None):
+        self.timeout = timeout
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        self._ids = itertools.count()
+        self._pending = {}
+        self._reader = None
+
+    async def call(self, method, *args, timeout=...):
+        """Call `method` on the server and return its result, raises `asyncio.TimeoutError` or `RPCError`"""
+        if timeout is ...:
+            timeout = self.timeout
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+
+        request_id = str(next(self._ids)).encode("ascii")
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self.socket.send_multipart([request_id, method.encode("utf-8"), json.dumps(args).encode("utf-8")])
+            if timeout is None:
+                return await future
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _read(self):
+        while True:
+            request_id, status, payload = await self.socket.recv_multipart()
+            future = self._pending.get(request_id)
+            # replies to calls that timed out are dropped
+            if future is None or future.done():
+                continue
+            if status == OK:
+                future.set_result(json.loads(payload))
+            else:
+                future.set_exception(RPCError(payload.decode("utf-8")))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        self.socket.close()
+
+
+class RPCServer:
+    """Serve registered handlers on a ROUTER socket, see `serve_forever`.
+
+    The sockets are created here and used by the thread calling `serve_forever`. `stop` may
+    be called from any thread.
+    """
+
+    def __init__(self, context, address):
+        self.context = context
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+        self._wake_address = f"inproc://menqu-rpc-wake-{id(self)}"
+        self._wake = context.socket(zmq.PULL)
+        self._wake.bind(self._wake_address)
+        self.handlers = {}
+        self._closed = False
+
+    def register(self, name, handler):
+        self.handlers[name.encode("utf-8")] = handler
+
+    def stop(self):
+        """Make `serve_forever` return after the request it is handling"""
+        if self._closed:
+            return
+        wake = self.context.socket(zmq.PUSH)
+        wake.setsockopt(zmq.LINGER, 1000)
+        wake.connect(self._wake_address)
+        wake.send(b"")
+        wake.close()
+
+    def _handle(self, method, payload):
+        try:
+            result = self.handlers[method](*json.loads(payload))
+            return OK, json.dumps(result).encode("utf-8")
+        except Exception as e:
+            return ERROR, f"{type(e).__name__}: {e}".encode("utf-8")
+
+    def serve_forever(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._wake, zmq.POLLIN)
+        try:
+            while True:
+                events = dict(poller.poll())
+                if self.socket in events:
+                    identity, request_id, method, payload = self.socket.recv_multipart()
+                    status, result = self._handle(method, payload)
+                    self.socket.send_multipart([identity, request_id, status, result])
+                if self._wake in events:
+                    self._wake.recv()
+                    return
+        finally:
+            self._closed = True
+            self.socket.close()
+            self._wake.close()
@@ -0,0 +1,53 @@
+"""
+Headless server for several users
+
+`menqu serve` runs the bokeh server without the pywebview window, so a group can share one
+machine from their browsers. Every browser session gets its own `App` with its own widgets,
+data and jobs; the jobs and uploads of a session are removed when bokeh discards it. The
+jobs of all sessions of a process run in the same worker processes. Files
+are uploaded from the browser instead of picked in OS dialogs. Saving, exporting and the
+Excel import need the desktop app.
+
+With more than one process bokeh forks the server after binding the port and the processes
+share the incoming connections (not on Windows). A session stays in the process it was
+created in. The runs opened by the sessions of a process are kept in `RUNS`, so opening a
+run somebody else already opened skips parsing it and shares its arrays.
+"""
+
+import functools
+import logging
+
+from bokeh.server.server import Server
+
+from menqu.datasources import RunCache
+from menqu.jobs import JobPools
+
+logger = logging.getLogger(__name__)
+
+RUNS = RunCache()
+
+
+def make_document(doc, pools):
+    from menqu.plot import App
+
+    app = App(runs=RUNS, pools=pools)
+    app.transform(doc)
+    doc.on_session_destroyed(lambda session_context: app.close())
+
+
+def serve(port=5006, address=None, processes=1, job_processes=1, allow_websocket_origin=None):
+    """Serve menqu on `port` until interrupted.
+
+    `processes` is the number of server processes, 0 starts one per CPU. `job_processes`
+    is the number of import processes of every server process, they are started with the
+    first import (after forking) and shared by all its sessions.
+    """
+    pools = JobPools(job_processes)
+    server = Server({"/": functools.partial(make_document, pools=pools)},
+                    port=port,
+                    address=address,
+                    num_procs=processes,
+                    allow_websocket_origin=allow_websocket_origin or None)
+    server.start()
+    logger.info("Serving menqu on http://%s:%s/", address or "localhost", server.port)
+    server.io_loop.start()
@@ -11,7 +11,10 @@ The Bokeh server generates plots which are syncronized via a websocket to the cl
 can trigger callbacks which are processed by the server.
 
 So that the bokeh server and handling the pywebview functions does not interfer with each other, they're running in seperate threads. 
-There are three threads: The pywebview GUI thread, the pywebview function handling thread (OSThread) and the Bokeh Server thread (BokehThread). OSThread and BokehThread communicate via a ZMQ socket when necessary (e.g. when exiting and closing).
+There are three threads: The pywebview GUI thread, the pywebview function handling thread (OSThread) and the Bokeh Server thread (BokehThread). OSThread and BokehThread communicate through the request/reply channel in `menqu.rpc` when necessary (e.g. when exiting and closing).
+
+Both services bind to a free port chosen by the OS. The bokeh thread reports its port on a ready
+queue once the server listens, the window is only created then.
 """
 
 import threading
@@ -19,34 +22,43 @@ import asyncio
 import os
 import webview
 import sys
-import time
+import queue
 
+from menqu import timeline
 from menqu.plot import App
+from menqu.rpc import RPCClient, RPCServer
 
 import zmq
+import zmq.asyncio
 from bokeh.server.server import Server
 
+# seconds to wait for the services to report that they are listening
+STARTUP_TIMEOUT = 30
+
 class BokehThread(threading.Thread):
+    """Runs the bokeh server on a free port and puts ("bokeh", port) on `ready` once it listens,
+    or ("bokeh", exception) if it failed to start"""
 
-    def __init__(self, port):
-        self.port = port
+    def __init__(self, rpc_address, ready):
+        self.rpc_address = rpc_address
+        self.ready = ready
         super().__init__()
 
     def run(self):
 
         self.loop = loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        app = App()
-
         self.context = context = zmq.asyncio.Context()
-        self.socket = socket = context.socket(zmq.REQ)
-        socket.setsockopt(zmq.LINGER, 1)
-        socket.connect(f"tcp://127.0.0.1:{self.port}")
-
-        app.socket = socket
-
-        self.server = server = Server({'/': app.transform}, num_procs=1)
-        server.start()
+        self.app = app = App(rpc=RPCClient(context, self.rpc_address))
+
+        try:
+            self.server = server = Server({'/': app.transform}, num_procs=1, port=0)
+            server.start()
+        except Exception as e:
+            self.ready.put(("bokeh", e))
+            raise
+        timeline.mark("server bound")
+        self.ready.put(("bokeh", server.port))
         #server.io_loop.add_callback(server.show, "/")
         server.io_loop.start()
 
@@ -56,77 +68,89 @@ class BokehThread(threading.Thread):
 
     def _stop(self):
         """Stop the server"""
+        self.app.jobs.shutdown()
         self.loop.stop()
         self.context.destroy(linger=0)
         self.context.term()
         self.stop()
 
 class OSThread(threading.Thread):
+    """Serves the pywebview functions to the bokeh thread, see `menqu.rpc`
+
+    The RPC socket is bound to a free port in the constructor, `address` is the address to
+    connect to. Calls made before the thread runs are queued by zmq. `window` has to be set
+    before the thread is started.
+    """
 
-    def __init__(self, window, port):
+    def __init__(self, window=None):
         super().__init__()
         self.window = window
-        self.port = port
-        self._stopping = False
+        self._exiting = False
+
+        self.context = zmq.Context()
+        self.server = server = RPCServer(self.context, "tcp://127.0.0.1:*")
+        self.address = server.socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        server.register("save_dialog", self.save_dialog)
+        server.register("load_dialog", self.load_dialog)
+        server.register("export_dialog", self.export_dialog)
+        server.register("exit", self.exit)
 
     def stop(self):
-        self._stopping = True
+        self.server.stop()
 
-    def run(self):
-        window = self.window
-        port = self.port
+    def _file_dialog(self, dialog_type, save_filename):
+        filename = self.window.create_file_dialog(dialog_type, directory=os.getcwd(), save_filename=save_filename)
+        if filename:
+            return "".join(filename)
+        return ""
 
-        context = zmq.Context()
-        socket = context.socket(zmq.REP)
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
-        socket.bind(f"tcp://127.0.0.1:{port}")
+    def save_dialog(self, suggested_name):
+        return self._file_dialog(webview.SAVE_DIALOG, suggested_name + ".menqu")
 
+    def load_dialog(self):
+        return self._file_dialog(webview.OPEN_DIALOG, 'test.menqu')
+
+    def export_dialog(self):
+        return self._file_dialog(webview.SAVE_DIALOG, 'test.svg')
+
+    def exit(self):
+        self._exiting = True
+        self.server.stop()
+        return "BYE"
+
+    def run(self):
+        self.server.serve_forever()
+        self.context.term()
+        if self._exiting:
+            self.window.destroy()
+
+def wait_ready(ready, service, timeout=STARTUP_TIMEOUT):
+    """Wait until `service` reported on `ready` and return what it reported"""
+    try:
         while True:
-            if self._stopping:
+            name, value = ready.get(timeout=timeout)
+            if name == service:
                 break
-            try:
-                msg = socket.recv()
-            except zmq.error.Again:
-                continue
-            if msg[:4] == b"SAVE":
-                suggested_name = msg[4:].decode("utf-8")
-                filename = window.create_file_dialog(webview.SAVE_DIALOG, directory=os.getcwd(), save_filename=suggested_name + ".menqu")
-                if filename:
-                    filename = "".join(filename)
-                else:
-                    filename = ""
-                socket.send(filename.encode("utf-8"))
-            elif msg == b"LOAD":
-                filename = window.create_file_dialog(webview.OPEN_DIALOG, directory=os.getcwd(), save_filename='test.menqu')
-                if filename:
-                    filename = "".join(filename)
-                else:
-                    filename = ""
-                socket.send(filename.encode("utf-8"))
-            elif msg == b"EXPORT":
-                filename = window.create_file_dialog(webview.SAVE_DIALOG, directory=os.getcwd(), save_filename='test.svg')
-                if filename:
-                    filename = "".join(filename)
-                else:
-                    filename = ""
-                socket.send(filename.encode("utf-8"))
-            elif msg == b"EXIT":
-                socket.send(b"BYE")
-                window.destroy()
-                sys.exit(0)
+    except queue.Empty:
+        raise RuntimeError(f"The {service} service did not start within {timeout} seconds.") from None
+    if isinstance(value, Exception):
+        raise RuntimeError(f"The {service} service failed to start.") from value
+    return value
+
 
 def start_all():
-    PORT = 21934
+    ready = queue.Queue()
 
-    bokeh_thread = BokehThread(PORT)
+    web_view_thread = OSThread()
+    bokeh_thread = BokehThread(web_view_thread.address, ready)
     bokeh_thread.start()
 
-    # make sure bokeh started up and bound to port 5006
-    time.sleep(0.3)
-
-    window = webview.create_window('menqu', 'http://localhost:5006/')
+    port = wait_ready(ready, "bokeh")
+    timeline.mark("bokeh ready")
+    window = webview.create_window('menqu', f'http://localhost:{port}/')
+    timeline.mark("window created")
 
-    web_view_thread = OSThread(window, PORT)
+    web_view_thread.window = window
     web_view_thread.start()
 
     window.closing += bokeh_thread.stop
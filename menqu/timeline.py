@@ -0,0 +1,36 @@
+"""
+Startup timeline
+
+`mark` records how long after the first import of this module a startup step finished and
+logs it on the "menqu.timeline" logger. Import this module first to include the imports
+in the timeline.
+"""
+
+import logging
+import time
+
+START = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+_marks = []
+
+
+def mark(name):
+    elapsed = time.perf_counter() - START
+    _marks.append((name, elapsed))
+    logger.info("%8.3f s  %s", elapsed, name)
+    return elapsed
+
+
+def marks():
+    """All (name, seconds since start) pairs in the order they were marked"""
+    return list(_marks)
+
+
+def elapsed(name):
+    """Seconds from the start to the first mark called `name`, None if it was not marked"""
+    for mark_name, seconds in _marks:
+        if mark_name == name:
+            return seconds
+    return None
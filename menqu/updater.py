@@ -5,18 +5,80 @@ Menqu checks by default every time it is called whether a new version is availab
 This is performed by calling `needs_update(current_version)`, which checks github to see if a version with a bigger
 version number is available and returns whether an update is available and the URL to the newest version.
 The `update(url)` function can then download the newest version from that URL and restarts menqu.
+
+The check must never hold up startup (instrument PCs are often offline): the request has a short
+timeout, the answer is cached in `CACHE_FILE` for `CACHE_TTL` seconds and `check_in_background`
+runs the check in a daemon thread. `cached_needs_update` only looks at the cache. The URL of the
+release API can be changed with the MENQU_UPDATE_URL environment variable.
 """
 
-import requests
+import concurrent.futures
+import json
 import os
 import sys
 import logging
 import subprocess
+import threading
+import time
+
+import appdirs
+
+RELEASE_URL = os.environ.get("MENQU_UPDATE_URL", "https://api.github.com/repos/syntonym/qpcr_analysis/releases/latest")
+# seconds to wait for the release API
+TIMEOUT = 3
+CACHE_FILE = os.path.join(appdirs.user_cache_dir("menqu"), "update.json")
+# seconds an answer (or a failed check) is reused
+CACHE_TTL = 24 * 60 * 60
+FAILURE_TTL = 60 * 60
+
+def _get_latest_release(url=RELEASE_URL, timeout=TIMEOUT):
+    # runs in the background, keep requests out of the startup
+    import requests
 
-def _get_latest_release():
-    response = requests.get("https://api.github.com/repos/syntonym/qpcr_analysis/releases/latest").json()
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    response = response.json()
     return response["tag_name"], response["assets"][0]["browser_download_url"]
 
+def _read_cache(cache_file, url):
+    """The cached (tag, download url) of `url`, (None, None) for a cached failure, None if there is no fresh entry"""
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    ttl = CACHE_TTL if cached.get("latest") else FAILURE_TTL
+    if cached.get("url") != url or not 0 <= time.time() - cached.get("checked", 0) < ttl:
+        return None
+    return cached.get("latest"), cached.get("download_url")
+
+def _write_cache(cache_file, url, latest, download_url):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, mode="w") as f:
+            json.dump({"url": url, "checked": time.time(), "latest": latest, "download_url": download_url}, f)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        logging.warning("Could not cache the update check: %s", e)
+
+def latest_release(url=RELEASE_URL, timeout=TIMEOUT, cache_file=CACHE_FILE):
+    """The tag and download URL of the latest release, from the cache if it is fresh.
+
+    Raises if the release could not be fetched, a failure is cached as well.
+    """
+    cached = _read_cache(cache_file, url)
+    if cached is None:
+        try:
+            cached = _get_latest_release(url, timeout)
+        except Exception:
+            _write_cache(cache_file, url, None, None)
+            raise
+        _write_cache(cache_file, url, *cached)
+    if cached[0] is None:
+        raise RuntimeError(f"Checking {url} for updates failed recently.")
+    return cached
+
 def _parse_semver(ver: str) -> list[int]:
     return [int(x) for x in ver.split(".")]
 
@@ -28,29 +90,58 @@ def _semver_bigger_then(a: list[int], b: list[int]):
             return False
     return False
 
-def needs_update(current_version):
+def _compare(current_version, latest, download_url):
+    try:
+        if _semver_bigger_then(_parse_semver(latest), _parse_semver(current_version)):
+            return (True, download_url)
+    except Exception as e:
+        logging.exception(e)
+    return (False, None)
+
+def needs_update(current_version, url=RELEASE_URL, timeout=TIMEOUT, cache_file=CACHE_FILE):
     """Checks whether a newer verison then the passed `current_version` is available.
 
     Return a tuple, the first item is a boolean indicating whether a newer version is available, 
     the second entry item is None or the URL at which the newer verison is available. 
 
-    This function requires internet access, if case of any exceptions this function will default 
-    to return that no update is necessary. Currently there is no way to know whether no update is
-    neccessary or whether asking for updates failed.
+    This function requires internet access unless the answer is cached, it waits at most `timeout`
+    seconds for it. In case of any exceptions this function will default to return that no update
+    is necessary. Currently there is no way to know whether no update is neccessary or whether
+    asking for updates failed.
     """
     try:
-        latest, download_url = _get_latest_release()
-        latest = _parse_semver(latest)
+        latest, download_url = latest_release(url, timeout, cache_file)
     except Exception as e:
-        logging.exception(e)
+        logging.warning("Update check failed: %s", e)
         return (False, None)
+    return _compare(current_version, latest, download_url)
 
-    try:
-        if _semver_bigger_then(latest, _parse_semver(current_version)):
-            return (True, download_url)
-    except Exception as e:
-        logging.exception(e)
-    return (False, None)
+def cached_needs_update(current_version, url=RELEASE_URL, cache_file=CACHE_FILE):
+    """Like `needs_update`, but only answers from the cache and never touches the network"""
+    cached = _read_cache(cache_file, url)
+    if cached is None or cached[0] is None:
+        return (False, None)
+    return _compare(current_version, *cached)
+
+_checks = {}
+_checks_lock = threading.Lock()
+
+def check_in_background(current_version, url=RELEASE_URL, timeout=TIMEOUT, cache_file=CACHE_FILE):
+    """Run `needs_update` in a daemon thread and return a `concurrent.futures.Future` of its result.
+
+    The check runs once per process, later calls return the future of the first one.
+    """
+    key = (current_version, url, cache_file)
+    with _checks_lock:
+        if key in _checks:
+            return _checks[key]
+        future = _checks[key] = concurrent.futures.Future()
+
+    def run():
+        future.set_result(needs_update(current_version, url, timeout, cache_file))
+
+    threading.Thread(target=run, name="menqu-update-check", daemon=True).start()
+    return future
 
 def update(url):
     """Download a new menqu version from `url` and relaunch menqu"""
@@ -11,15 +11,18 @@ from bokeh.plotting import figure
 from bokeh.palettes import Viridis256
 from bokeh.core.properties import value
 from bokeh.transform import linear_cmap
-from bokeh.models import Column, FactorRange, ColumnDataSource, BooleanFilter, CDSView, Row, ColorPicker, DataTable, TableColumn, TextInput, Div, Button, Tabs, Panel, Dropdown
+from bokeh.models import Column, FactorRange, ColumnDataSource, BooleanFilter, CDSView, Row, ColorPicker, DataTable, TableColumn, TextInput, Div, Button, Tabs, Panel, Dropdown, LinearColorMapper, Whisker, FixedTicker, Select, Toggle, FileInput, LabelSet
 from bokeh.models.widgets.tables import HTMLTemplateFormatter
 from bokeh.models.callbacks import CustomJS
 
 import menqu
-from menqu.helpers import apply_theme, general_mapper, mutate_bokeh
+from menqu.helpers import apply_theme, general_mapper, mutate_bokeh, pivot, replicate_columns, category_index, natural_rank
 from menqu.themes import CONDITIONS_THEME
 from menqu.analysis import parse_well
-from menqu.data_importers import ExcelImporter, CSVImporter
+from menqu.data_importers import CSVImporter, analyse_csv, import_excel
+from menqu.jobs import FAILED, CANCELLED
+import os
+import math
 import asyncio
 
 import numpy as np
@@ -27,22 +30,88 @@ from collections import defaultdict
 
 MIN_BORDER_LEFT = 100
 
+def _nice_ticks(maximum):
+    """A few round values from 0 to `maximum`"""
+    half = maximum / 2
+    magnitude = 10 ** math.floor(math.log10(half))
+    step = max(f * magnitude for f in (1, 2, 5) if f * magnitude <= half)
+    return [i * step for i in range(int(maximum / step + 1e-9) + 1)]
+
+def _tick_key(tick):
+    # labels are looked up by the tick as javascript prints it, "2" and not "2.0"
+    return int(tick) if float(tick).is_integer() else float(tick)
+
 class Widget:
+    """Base class of all widgets.
+
+    `update` stores the new data, lets the widget apply it with `_update` and forwards it to
+    linked child widgets. Widgets should change their existing models in `_update` and only
+    build new ones when the structure of the data changes. `models_created` counts the bokeh
+    models the last update added below `_root_widget`.
+
+    Updates are batched per bokeh document, `doc` is the document `_root_widget` belongs to.
 
-    def __init__(self, data):
+    A dormant widget, e.g. one on a hidden tab, only stores the data it gets and applies it
+    when it is woken up. Widgets created dormant are drawn the first time they are woken up.
+    """
+
+    def __init__(self, data, dormant=False):
         self._data = data
         self._links = defaultdict(list)
+        self.models_created = 0
+        self.dormant = dormant
+        self._built = not dormant
+        self._pending = set()
+
+    @property
+    def doc(self):
+        root = getattr(self, "_root_widget", None)
+        return root.document if root is not None else None
+
+    def _model_ids(self):
+        root = getattr(self, "_root_widget", None)
+        if root is None:
+            return set()
+        return {model.id for model in root.references()}
+
+    def _update(self, names):
+        pass
 
     @mutate_bokeh
     def update(self, d):
         # update this widget
+        before = self._model_ids()
         for dataname, datavalue in d.items():
             self._data[dataname] = datavalue
+        if self.dormant:
+            self._pending.update(d)
+        else:
+            self._update(set(d))
+        self.models_created = len(self._model_ids() - before)
 
         # update the child widget with all data it needs in one go
         for child_widget, data_names in self._links.items():
             child_widget.update({data_name: d[data_name] for data_name in data_names if data_name in d})
 
+    def sleep(self):
+        self.dormant = True
+
+    def wake(self):
+        self.dormant = False
+        self._apply_pending()
+
+    @mutate_bokeh
+    def _apply_pending(self):
+        """Draw the widget if it was never drawn, else apply the updates made while dormant"""
+        if self.dormant:
+            return
+        names, self._pending = self._pending, set()
+        if not self._built:
+            self._built = True
+            self.redraw()
+        elif names:
+            self._update(names)
+
     def link(self, widget, dataname):
         self._links[widget].append(dataname)
 
@@ -60,6 +129,7 @@ class RootWidget(Widget):
         self.table_container = Column()
         self.importer_container = Column()
         self.importer_csv_container = Column()
+        self.exclusions_container = Row()
 
         self._tabs = Tabs(tabs=[
                     Panel(child=self.plot_container, title="Heatmap"),
@@ -70,6 +140,7 @@ class RootWidget(Widget):
                 Div(text="", height=100), 
                 Row(Div(text="", width=100), self.tools_container),
                 Div(text="", height=100), 
+                Row(Div(text="", width=100), self.exclusions_container),
                 Row(Div(text="", width=100), 
                     self._tabs
                     )
@@ -77,22 +148,29 @@ class RootWidget(Widget):
 
         self.root = Column()
         self._button_bar = ButtonBar(self.root, app, self)
+        self.job_progress = JobProgress(self.root, app)
         self.root.children.append(self._main_column)
 
-        self.colorpickers = ColorPickers(self.tools_container, {"conditions": data["conditions"], "colors": data["colors"]}, app=self)
+        self.colorpickers = ColorPickers(self.tools_container, {"conditions": data["conditions"], "colors": data["colors"]}, app=app)
         self.link(self.colorpickers, "conditions")
         self.link(self.colorpickers, "colors")
 
+        # only the widget of the visible tab is drawn and kept up to date, see `_on_tab_change`
         self.heatmap = HeatmapGraphs(self.plot_container, data, color_pickers=self.colorpickers.color_pickers)
 
-        self.bargraphs = BarGraphs(self.bargraphs_container, data, color_pickers=self.colorpickers.color_pickers)
+        self.bargraphs = BarGraphs(self.bargraphs_container, data, color_pickers=self.colorpickers.color_pickers, dormant=True)
+
+        self.table = Table(self.table_container, data, color_pickers=self.colorpickers.color_pickers, dormant=True)
 
-        self.table = Table(self.table_container, data, color_pickers=self.colorpickers.color_pickers)
+        self._tab_widgets = [self.heatmap, self.bargraphs, self.table]
+        self._tabs.on_change("active", self._on_tab_change)
 
         self.excel_importer = ExcelImportWidget(self.importer_container, app, self)
 
         self.csv_importer = CSVImportWidget(self.importer_csv_container, app, self, {"genes": data["genes"], "samples": data["samples"]})
 
+        self.exclusion_editor = ExclusionEditor(self.exclusions_container, app)
+
         for widget in [self.heatmap, self.bargraphs, self.table]:
             for data_name in data:
                 self.link(widget, data_name)
@@ -100,10 +178,24 @@ class RootWidget(Widget):
         self.link(self.csv_importer, "genes")
         self.link(self.csv_importer, "samples")
 
+    @property
+    def doc(self):
+        return self.root.document
+
     def update(self, d):
         super().update(d)
         print(d)
 
+    def _on_tab_change(self, attr, old, new):
+        for i, widget in enumerate(self._tab_widgets):
+            if i == new:
+                widget.wake()
+            else:
+                widget.sleep()
+
+    def show_update(self):
+        self._button_bar.show_update()
+
     def show_excel_importer(self):
         self.root.children.remove(self._main_column)
         self.root.children.append(self.importer_container)
@@ -120,12 +212,62 @@ class RootWidget(Widget):
             self.root.children.remove(self.importer_csv_container)
         self.root.children.append(self._main_column)
 
+class JobProgress(Widget):
+    """Progress of the running jobs and a button cancelling them"""
+
+    def __init__(self, root, app):
+        super().__init__({})
+        self.app = app
+
+        self._text = Div(text="")
+        self._button_cancel = Button(label="Cancel", width=100, visible=False)
+        self._button_cancel.on_click(self.cancel)
+
+        self._root_widget = Row(self._text, self._button_cancel)
+        root.children.append(self._root_widget)
+
+    def cancel(self):
+        for job in list(self.app.jobs.jobs.values()):
+            self.app.jobs.cancel(job)
+        self.show([])
+
+    def show(self, changed):
+        """Show the running jobs and the jobs in `changed` that did not finish successfully"""
+        running = list(self.app.jobs.jobs.values())
+        lines = [f"{job.name}: {job.progress:.0%} {job.message}" for job in running]
+        lines += [f"{job.name}: {job.message} {job.error or ''}" for job in changed if job.status in (FAILED, CANCELLED)]
+        self._text.text = "<br>".join(lines)
+        self._button_cancel.visible = bool(running)
+
 class ButtonBar(Widget):
 
     def __init__(self, root, app, root_widget):
         super().__init__({})
         self.app = app
 
+        if app.rpc is None:
+            _buttons = self._browser_buttons(root_widget)
+        else:
+            _buttons = self._desktop_buttons(root_widget)
+
+        self._root_widget = Row(children=_buttons)
+        root.children.append(self._root_widget)
+
+    def _browser_buttons(self, root_widget):
+        """Without the desktop window there are no OS dialogs, files are uploaded from the browser"""
+        _buttons = []
+
+        upload = FileInput(accept=".menqu", width=200)
+        upload.on_change("value", lambda attr, old, new: self.app.load_upload(new))
+        _buttons.append(Div(text="Open", width=40))
+        _buttons.append(upload)
+
+        button_import = Button(label="Import from CSV", width=200)
+        button_import.on_click(root_widget.show_csv_importer)
+        _buttons.append(button_import)
+        return _buttons
+
+    def _desktop_buttons(self, root_widget):
         _buttons = []
         BUTTON_WIDTH = 100
 
@@ -157,21 +299,27 @@ class ButtonBar(Widget):
         button_ordering.on_click(lambda: asyncio.ensure_future(self.app._import_graph_ordering()))
         _buttons.append(button_ordering)
 
-        button_update = Button(label="Update", width=200)
-        button_ordering.on_click(lambda: asyncio.ensure_future(self.app.update()))
-        update_needed, self._update_url = self.app.update_needed()
-        if update_needed:
-            _buttons.append(button_update)
+        # shown by `show_update` when the update check found a newer version
+        self._button_update = Button(label="Update", width=200, button_type="success", visible=False)
+        self._button_update.on_click(lambda: asyncio.ensure_future(self.app.update()))
+        _buttons.append(self._button_update)
+        return _buttons
 
-        self._root_widget = Row(children=_buttons)
-        root.children.append(self._root_widget)
+    def show_update(self):
+        self._button_update.visible = True
 
 class WithConditions(Widget):
 
+    def _structure(self):
+        """Data the models are built for, a change requires a redraw"""
+        return (list(self._data["genes"]), list(self._data["samples"]), list(self._data["conditions"]))
+
     def draw_conditions(self, xaxis, condition_data):
         p = figure(x_range=xaxis, frame_height=25*len(self._data["conditions"]), frame_width=self._width*len(self._data["samples"]), toolbar_location=None, y_range=self._data["conditions"])
         apply_theme(p, CONDITIONS_THEME)
 
+        self._condition_source = ColumnDataSource(dict(condition_data))
+        self._condition_renderers = {}
         for condition in self._data["conditions"]:
             default_color = "black"
             if condition in self._color_pickers:
@@ -179,7 +327,8 @@ class WithConditions(Widget):
                 default_color = cp.color
 
             fill_alpha = general_mapper(condition, [0, 1], ["False", "True"])
-            r = p.rect(x="Sample", y=value(condition), fill_alpha=fill_alpha, line_alpha=fill_alpha, source=condition_data, width=0.8, height=0.8, color=default_color)
+            r = p.rect(x="Sample", y=value(condition), fill_alpha=fill_alpha, line_alpha=fill_alpha, source=self._condition_source, width=0.8, height=0.8, color=default_color)
+            self._condition_renderers[condition] = r
 
             if condition in self._color_pickers:
                 cp.js_link("color", r.glyph, "fill_color")
@@ -193,14 +342,39 @@ class WithConditions(Widget):
 
         return p
 
+    def update_conditions(self, names):
+        """Apply new condition data and colors to the existing condition plot"""
+        if "condition_data" in names:
+            self._condition_source.data = dict(self._data["condition_data"])
+        if "colors" in names:
+            for condition, r in self._condition_renderers.items():
+                color = self._data["colors"].get(condition)
+                if color is not None:
+                    r.glyph.fill_color = color
+                    r.glyph.line_color = color
+
 class BarGraphs(WithConditions):
+    """Bar graph of the fold changes of every gene over all samples.
 
-    def __init__(self, root, data, color_pickers={}):
-        super().__init__(data)
+    In "facets" mode all genes are drawn into one figure from one ColumnDataSource: every
+    gene gets a horizontal band of the y axis and is scaled to its own maximum, so the number
+    of models does not depend on the number of genes. The y axis is labelled with the fold
+    changes of every band and the gene is written into its band. "figures" mode draws one
+    figure per gene.
+    """
+
+    MODES = ("facets", "figures")
+    # height of the band of one gene in y axis units, bands start every 2 units
+    FACET_HEIGHT = 1.5
+
+    def __init__(self, root, data, color_pickers={}, mode="facets", dormant=False):
+        super().__init__(data, dormant)
 
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown bar graph mode {mode}, choose one of {self.MODES}")
+        self._mode = mode
         self._color_pickers = color_pickers
 
-        self._maxvalue = max(max(self._data["gene_data"]["R1"]), max(self._data["gene_data"]["R2"]), max(self._data["gene_data"]["R3"]))
         self._width = 25
         self._height = 25
         self._linear_color_mapper = None
@@ -208,7 +382,8 @@ class BarGraphs(WithConditions):
         self._condition_height = 25
 
         self._root_widget = Column()
-        self._draw()
+        if self._built:
+            self._draw()
 
         root.children.append(self._root_widget)
 
@@ -216,41 +391,165 @@ class BarGraphs(WithConditions):
         self._root_widget.children = []
         self._draw()
 
+    def _structure(self):
+        return (*super()._structure(), replicate_columns(self._data["gene_data"]))
+
+    def _gene_sources_data(self):
+        """Data of the ColumnDataSource of every gene plot"""
+        gene_data = self._data["gene_data"]
+        genes = np.asarray(gene_data["Gene"])
+        samples = np.asarray(gene_data["Sample"])
+        columns = {"mean": np.asarray(gene_data["mean"], dtype=np.float64),
+                   **{r: np.asarray(gene_data[r], dtype=np.float64) for r in replicate_columns(gene_data)}}
+        data = {}
+        for gene in self._data["genes"]:
+            mask = genes == gene
+            data[gene] = {"Sample": samples[mask], **{name: column[mask] for name, column in columns.items()}}
+        return data
+
+    def _facet_data(self):
+        """One row per (gene, sample) with bars, replicates and whiskers placed in the band of the gene.
+
+        Returns the data and the maximum of every gene, which is the top of its band.
+        """
+        gene_data = self._data["gene_data"]
+        genes = self._data["genes"]
+        gene_index = category_index(gene_data["Gene"], genes)
+        keep = (gene_index >= 0) & (category_index(gene_data["Sample"], self._data["samples"]) >= 0)
+        gene_index = gene_index[keep]
+
+        names = replicate_columns(gene_data)
+        # no replicate columns when nothing was measured, e.g. all wells excluded
+        replicates = np.empty((len(names), np.count_nonzero(keep)))
+        for i, name in enumerate(names):
+            replicates[i] = np.asarray(gene_data[name], dtype=np.float64)[keep]
+        mean = np.asarray(gene_data["mean"], dtype=np.float64)[keep]
+        count = np.sum(~np.isnan(replicates), axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            replicate_mean = np.nansum(replicates, axis=0) / count
+            std = np.sqrt(np.nansum((replicates - replicate_mean) ** 2, axis=0) / count)
+
+        # maximum of every gene over bars, whiskers and replicates
+        maxima = np.zeros(len(genes))
+        np.fmax.at(maxima, gene_index, np.fmax.reduce(np.vstack([mean, mean + std, replicates]), axis=0))
+        scale = np.where(maxima > 0, maxima, 1)[gene_index]
+        base = 2.0 * (len(genes) - 1 - gene_index)
+
+        def placed(values):
+            return base + self.FACET_HEIGHT * values / scale
+
+        return {"Sample": np.asarray(gene_data["Sample"])[keep],
+                "Gene": np.asarray(gene_data["Gene"])[keep],
+                "mean": mean,
+                "base": base,
+                "top": placed(mean),
+                "upper": placed(mean + std),
+                "lower": placed(np.maximum(mean - std, 0)),
+                **{name: placed(values) for name, values in zip(names, replicates)}}, maxima
+
+    def _set_facet_ticks(self, maxima):
+        """Fold change ticks in the band of every gene"""
+        ticks, labels = [], {}
+        for i, maximum in enumerate(maxima):
+            base = 2.0 * (len(maxima) - 1 - i)
+            scale = maximum if maximum > 0 else 1
+            for value in _nice_ticks(scale):
+                tick = _tick_key(base + self.FACET_HEIGHT * value / scale)
+                ticks.append(tick)
+                labels[tick] = f"{value:g}"
+        self._facet_axis.ticker.ticks = ticks
+        self._facet_axis.major_label_overrides = labels
+
+    def _draw_facets(self):
+        genes = self._data["genes"]
+        TOOLTIPS = [
+                ("Sample", "@Sample"),
+                ("Gene", "@Gene"),
+                ("Foldchange", "@mean"),
+                ]
+        p = figure(frame_width=self._width*len(self._data["samples"]), frame_height=self._height*2*len(genes),
+                   x_range=self._xrange, y_range=(-0.25, 2 * len(genes) - 0.25), tooltips=TOOLTIPS)
+        p.xaxis.visible = False
+        p.ygrid.visible = False
+        p.yaxis.axis_label = "Foldchange"
+
+        data, maxima = self._facet_data()
+        self._facet_axis = p.yaxis[0]
+        self._facet_axis.ticker = FixedTicker(ticks=[])
+        self._set_facet_ticks(maxima)
+
+        tops = [2.0 * (len(genes) - 1 - i) + self.FACET_HEIGHT + 0.4 for i in range(len(genes))]
+        p.add_layout(LabelSet(x=5, y="top", text="Gene", x_units="screen", text_baseline="top", text_font_size="10pt",
+                              source=ColumnDataSource({"top": tops, "Gene": [str(gene) for gene in genes]})))
+
+        source = ColumnDataSource(data)
+        p.vbar(x="Sample", top="top", bottom="base", fill_color="black", line_color="black", fill_alpha=0.5, width=0.8, source=source)
+        p.add_layout(Whisker(source=source, base="Sample", upper="upper", lower="lower"))
+        for r in replicate_columns(self._data["gene_data"]):
+            p.circle(x="Sample", y=r, color="black", source=source)
+
+        p.min_border_left = MIN_BORDER_LEFT
+
+        self._facet_source = source
+        self._root_widget.children.append(p)
+
     def _draw(self):
+        self._drawn = self._structure()
         self._xrange = FactorRange(factors=self._data["samples"])
-        for gene in self._data["genes"]:
+        if self._mode == "facets":
+            self._draw_facets()
+        else:
+            self._draw_figures()
+
+        p = self.draw_conditions(self._xrange, self._data["condition_data"])
+        self._root_widget.children.append(p)
+
+    def _draw_figures(self):
+        self._gene_sources = {}
+        for gene, data in self._gene_sources_data().items():
             p = figure(frame_width=self._width*len(self._data["samples"]), frame_height = self._height*2, x_range=self._xrange, title=gene)
             p.xaxis.visible = False
-            mask = np.array(self._data["gene_data"]["Gene"]) == gene
-            x_values = np.array(self._data["gene_data"]["Sample"])[mask]
-            rs =  [np.array(self._data["gene_data"][replicate], dtype=np.float)[mask] for replicate in [f"R{i}" for i in range(1, len(self._data["gene_data"])-2)]]
-            p.vbar(x=x_values, top=np.array(self._data["gene_data"]["mean"])[mask], bottom=0, fill_color="black", line_color="black", fill_alpha=0.5, width=0.8)
-            for r in rs:
-                p.circle(x=x_values, y=r, color="black")
-
-            stacked_data = np.stack(rs)
-            mean = np.nanmean(stacked_data, axis=0)
-            std = np.nanstd(stacked_data, axis=0)
+            source = ColumnDataSource(data)
+            p.vbar(x="Sample", top="mean", bottom=0, fill_color="black", line_color="black", fill_alpha=0.5, width=0.8, source=source)
+            for r in replicate_columns(self._data["gene_data"]):
+                p.circle(x="Sample", y=r, color="black", source=source)
 
             #whisker = Whisker(source=ColumnDataSource({"Sample": self._samples, "mean+var": mean+std, "mean-var": mean-std}), base="Sample", upper="mean+var", lower="mean-var")
             #p.add_layout(whisker)
 
             p.min_border_left = MIN_BORDER_LEFT
 
+            self._gene_sources[gene] = source
             self._root_widget.children.append(p)
 
-        p = self.draw_conditions(self._xrange, self._data["condition_data"])
-        self._root_widget.children.append(p)
-
-    def update(self, d):
-        super().update(d)
-        self.redraw()
+    def _update(self, names):
+        if self._structure() != self._drawn:
+            self.redraw()
+            return
+        if "gene_data" in names and self._mode == "facets":
+            self._facet_source.data, maxima = self._facet_data()
+            self._set_facet_ticks(maxima)
+        elif "gene_data" in names:
+            for gene, data in self._gene_sources_data().items():
+                self._gene_sources[gene].data = data
+        self.update_conditions(names)
 
 class HeatmapGraphs(WithConditions):
+    """Heatmap of the mean fold change of every (gene, sample), each gene scaled to its maximum.
 
-    def __init__(self, root, data, color_pickers={}):
-        super().__init__(data)
+    In "image" mode the data is pivoted into a dense gene x sample matrix which is drawn as
+    one image glyph, so drawing cost depends on the size of the matrix only. "rect" mode draws
+    one rect glyph per gene.
+    """
+
+    MODES = ("image", "rect")
+
+    def __init__(self, root, data, color_pickers={}, mode="image", dormant=False):
+        super().__init__(data, dormant)
 
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown heatmap mode {mode}, choose one of {self.MODES}")
+        self._mode = mode
         self._color_pickers = color_pickers
 
         self._width = 25
@@ -260,7 +559,8 @@ class HeatmapGraphs(WithConditions):
         self._condition_height = 25
 
         self._root_widget = Column()
-        self._draw_everything()
+        if self._built:
+            self._draw_everything()
 
         root.children.append(self._root_widget)
 
@@ -270,32 +570,35 @@ class HeatmapGraphs(WithConditions):
         self._draw_everything()
 
     def _calculate_maxvalues(self):
-        maxvalues = {}
-        for gene in self._data["genes"]:
-            mask = np.array(self._data["gene_data"]["Gene"]) == gene
-            data = np.array(self._data["gene_data"]["mean"])[mask]
-            if len(data) > 0:
-                m = np.max(data)
-            else:
-                m = 0
-            maxvalues[gene] = m
-        return maxvalues
+        maxvalues = np.nan_to_num(np.nanmax(self._matrix, axis=1, initial=-np.inf), neginf=0)
+        return dict(zip(self._data["genes"], maxvalues.tolist()))
+
+    def _calculate_matrix(self):
+        self._matrix = pivot(self._data["gene_data"], self._data["genes"], self._data["samples"])
+        self._maxvalues = self._calculate_maxvalues()
+
+    def _normalized_matrix(self):
+        maxvalues = np.array([self._maxvalues[gene] for gene in self._data["genes"]])
+        scale = np.where(maxvalues > 0, maxvalues, 1)
+        return self._matrix / scale[:, None]
 
     def _draw_everything(self):
 
-        self._maxvalues = self._calculate_maxvalues()
+        self._drawn = self._structure()
+        self._calculate_matrix()
 
         self._xrange = FactorRange(factors=self._data["samples"])
 
-        p_heatmap = self.draw_heatmap(self._xrange, self._data["gene_data"], self._data["genes"])
+        if self._mode == "image":
+            p_heatmap = self.draw_heatmap_image(self._xrange, self._data["genes"])
+        else:
+            p_heatmap = self.draw_heatmap(self._xrange, self._data["gene_data"], self._data["genes"])
         p_cond = self.draw_conditions(self._xrange, self._data["condition_data"])
 
         self._root_widget.children.append(p_heatmap)
         self._root_widget.children.append(p_cond)
 
-    def draw_heatmap(self, xaxis, source, genes):
-        cds = ColumnDataSource(source)
-
+    def _heatmap_figure(self, xaxis, genes):
         TOOLTIPS = [
                 ("Sample", "@Sample"),
                 ("Gene", "@Gene"),
@@ -311,17 +614,55 @@ class HeatmapGraphs(WithConditions):
 
         p.xaxis.visible = False
         p.min_border_left = MIN_BORDER_LEFT
+        return p
+
+    def draw_heatmap_image(self, xaxis, genes):
+        samples = self._data["samples"]
+
+        # hover looks up every field at the hovered pixel, so names are passed as matrices too
+        cds = ColumnDataSource({"image": [self._normalized_matrix()],
+                                "mean": [self._matrix],
+                                "Gene": [[[gene] * len(samples) for gene in genes]],
+                                "Sample": [[list(samples)] * len(genes)]})
+
+        p = self._heatmap_figure(xaxis, genes)
+        self._linear_color_mapper = LinearColorMapper(palette=Viridis256, low=0, high=1, nan_color=(0, 0, 0, 0))
+        # on factor ranges every factor is one unit wide, starting at 0
+        p.image(image="image", x=0, y=0, dw=len(samples), dh=len(genes), color_mapper=self._linear_color_mapper, source=cds)
+        self._heatmap_source = cds
+        return p
+
+    def draw_heatmap(self, xaxis, source, genes):
+        cds = ColumnDataSource(source)
+
+        p = self._heatmap_figure(xaxis, genes)
+        gene_column = np.asarray(source["Gene"])
+        self._gene_filters = {}
         for gene in genes:
-            view = CDSView(source=cds, filters=[BooleanFilter([x == gene for x in source["Gene"]])])
+            view = CDSView(source=cds, filters=[BooleanFilter(gene_column == gene)])
             color = linear_cmap('mean', Viridis256, low=0, high=self._maxvalues.get(gene, 1))
             self._linear_color_mapper = color["transform"]
             p.rect(x='Sample', y='Gene', width=1, height=1, color=color, source=cds, view=view)
+            self._gene_filters[gene] = (view.filters[0], color["transform"])
 
+        self._heatmap_source = cds
         return p
 
-    def update(self, d):
-        super().update(d)
-        self.redraw()
+    def _update(self, names):
+        if self._structure() != self._drawn:
+            self.redraw()
+            return
+        if "gene_data" in names:
+            self._calculate_matrix()
+            if self._mode == "image":
+                self._heatmap_source.data.update(image=[self._normalized_matrix()], mean=[self._matrix])
+            else:
+                self._heatmap_source.data = dict(self._data["gene_data"])
+                gene_column = np.asarray(self._data["gene_data"]["Gene"])
+                for gene, (boolean_filter, mapper) in self._gene_filters.items():
+                    boolean_filter.booleans = gene_column == gene
+                    mapper.high = self._maxvalues.get(gene, 1)
+        self.update_conditions(names)
 
 class ColorPickers(Widget):
 
@@ -337,15 +678,25 @@ class ColorPickers(Widget):
 
     def _update_color(self, condition, attr, old, new):
         self._data["colors"][condition] = new
-        self.app.save_colors()
+        self.app.save_colors({condition: new})
+
+    def _update(self, names):
+        if list(self._data["conditions"]) != self._drawn_conditions:
+            self._redraw_conditions()
+        elif "colors" in names:
+            for cond, cp in self.color_pickers.items():
+                cp.color = self._data["colors"].get(cond, cp.color)
 
     def _redraw_conditions(self):
+        self._drawn_conditions = list(self._data["conditions"])
         self._root_widget.children = []
+        # cleared in place, the graphs and the table hold this dict
+        self.color_pickers.clear()
         current_row = Row()
         cond_idx = 0
         for cond in self._data["conditions"]:
             cp = ColorPicker(color=self._data["colors"].get(cond, "blue"), title=cond, width=60)
-            cp.on_change("color", lambda attr, old, new: self._update_color(cond, attr, old, new))
+            cp.on_change("color", lambda attr, old, new, cond=cond: self._update_color(cond, attr, old, new))
             self.color_pickers[cond] = cp
             if cond_idx == self._columns:
                 self._root_widget.children.append(current_row)
@@ -354,12 +705,18 @@ class ColorPickers(Widget):
         self._root_widget.children.append(current_row)
 
 class Table(Widget):
+    """Table of all measurements, paged, sorted and filtered on the server.
 
-    def __init__(self, root, data, color_pickers={}):
-        super().__init__(data)
+    All rows are kept as numpy columns and only the rows of the visible page are sent to
+    the client. Condition columns are looked up through a sample -> condition row index.
+    """
+
+    PAGE_SIZE = 100
+
+    def __init__(self, root, data, color_pickers={}, dormant=False):
+        super().__init__(data, dormant)
         self._color_pickers = color_pickers
 
-        self._maxvalue = max(max(self._data["gene_data"]["R1"]), max(self._data["gene_data"]["R2"]), max(self._data["gene_data"]["R3"]))
         self._width = 25
         self._height = 25
         self._linear_color_mapper = None
@@ -367,7 +724,8 @@ class Table(Widget):
         self._condition_height = 25
 
         self._root_widget = Column()
-        self._draw()
+        if self._built:
+            self._draw()
 
         root.children.append(self._root_widget)
 
@@ -375,15 +733,78 @@ class Table(Widget):
         self._root_widget.children = []
         self._draw()
 
-    def update(self, d):
-        super().update(d)
-        self.redraw()
+    def _table_data(self):
+        gene_data = self._data["gene_data"]
+        condition_data = self._data["condition_data"]
+        d = {"Sample": np.asarray(gene_data["Sample"], dtype=object),
+             "Gene": np.asarray(gene_data["Gene"], dtype=object),
+             **{r: np.asarray(gene_data[r], dtype=np.float64) for r in replicate_columns(gene_data)}}
+
+        # -1 for samples without conditions selects the empty string appended to every column
+        condition_rows = category_index(gene_data["Sample"], condition_data["Sample"])
+        for condition in self._data["conditions"]:
+            d[condition] = np.append(np.asarray(condition_data[condition], dtype=object), "")[condition_rows]
+        return d
+
+    def _set_rows(self):
+        self._rows = self._table_data()
+        self._search = {name: np.char.lower(self._rows[name].astype(str)) for name in ["Sample", "Gene"]}
+        self._sort.options = ["", *self._rows]
+
+    def _sort_key(self, name):
+        column = self._rows[name]
+        if column.dtype == object:
+            # numbered samples sort by number, names alphabetically
+            return natural_rank(column)
+        return column
+
+    def _set_view(self, page=0):
+        """Filter and sort all rows and show `page` of the result"""
+        index = np.arange(len(self._rows["Sample"]))
+        query = self._filter.value_input.strip().lower()
+        if query:
+            found = (np.char.find(self._search["Sample"], query) >= 0) | (np.char.find(self._search["Gene"], query) >= 0)
+            index = index[found]
+        if self._sort.value in self._rows:
+            key = self._sort_key(self._sort.value)[index]
+            # negated, so missing values stay last and equal rows keep their order
+            if self._descending.active:
+                key = -key
+            index = index[np.argsort(key, kind="stable")]
+        self._view = index
+        self._show_page(page)
+
+    def _show_page(self, page):
+        pages = max(1, -(-len(self._view) // self.PAGE_SIZE))
+        self._page = min(max(page, 0), pages - 1)
+        start = self._page * self.PAGE_SIZE
+        rows = self._view[start:start + self.PAGE_SIZE]
+        self._source.data = {name: column[rows] for name, column in self._rows.items()}
+        self._info.text = f"Rows {start + 1 if len(rows) else 0}-{start + len(rows)} of {len(self._view)}"
+
+    def _update(self, names):
+        if list(self._data["conditions"]) != self._drawn_conditions:
+            self.redraw()
+        elif names & {"gene_data", "condition_data"}:
+            self._set_rows()
+            self._set_view(self._page)
 
     def _draw(self):
-        d = self._data["gene_data"]
+        self._drawn_conditions = list(self._data["conditions"])
 
-        for condition in self._data["conditions"]:
-            d[condition] = [self._data["condition_data"][condition][self._data["condition_data"]["Sample"].index(sample)] for sample in d["Sample"] if sample in self._data["condition_data"]["Sample"]]
+        BUTTON_WIDTH = 100
+        self._filter = TextInput(placeholder="Filter samples and genes", width=200)
+        self._filter.on_change("value_input", lambda attr, old, new: self._set_view())
+        self._sort = Select(title="", value="", options=[""], width=BUTTON_WIDTH)
+        self._sort.on_change("value", lambda attr, old, new: self._set_view())
+        self._descending = Toggle(label="Descending", width=BUTTON_WIDTH)
+        self._descending.on_change("active", lambda attr, old, new: self._set_view())
+        button_previous = Button(label="Previous", width=BUTTON_WIDTH)
+        button_previous.on_click(lambda: self._show_page(self._page - 1))
+        button_next = Button(label="Next", width=BUTTON_WIDTH)
+        button_next.on_click(lambda: self._show_page(self._page + 1))
+        self._info = Div(text="")
+        self._set_rows()
 
         template_update_1 = '<% if (value === "True") {print(\'<div style="height: 20px; width: 20px; background-color:'
         template_update_2 = ';"></div>\')} %>'
@@ -401,23 +822,23 @@ class Table(Widget):
         columns = [
                 TableColumn(field="Sample", title="Sample", width=200),
                 TableColumn(field="Gene", title="Gene", width=10),
-                TableColumn(field="R1", title="R1"),
-                TableColumn(field="R2", title="R2"),
-                TableColumn(field="R3", title="R3"),
+                *[TableColumn(field=r, title=r) for r in replicate_columns(self._data["gene_data"])],
                 *condition_columns
                 ]
 
-        dt = DataTable(source=ColumnDataSource(d), columns=columns, width_policy="fit")
+        self._source = ColumnDataSource({})
+        dt = DataTable(source=self._source, columns=columns, width_policy="fit", sortable=False, index_position=None)
+        self._set_view()
 
         code = f"form.template = '{template_update_1_esc}' + cp.color + '{template_update_2_esc}'; dt.change.emit();"
 
-        for cp, formatter, col in zip(self._color_pickers.values(), formatters, condition_columns):
+        for cond, formatter, col in zip(self._data["conditions"], formatters, condition_columns):
+            cp = self._color_pickers[cond]
             cp.js_on_change("color", CustomJS(args={"cp": cp, "col":col, "form": formatter, "dt": dt}, code=code))
 
+        self._root_widget.children.append(Row(self._filter, self._sort, self._descending, button_previous, button_next, self._info))
         self._root_widget.children.append(dt)
 
-        dt.source.patch({})
-
 class WellExcluder:
 
     def __init__(self, root):
@@ -429,6 +850,28 @@ class WellExcluder:
     def get_excluded_wells(self):
         return [parse_well(well.strip()) if well.strip() else None for well in self._tp.value.split(",")]
 
+class ExclusionEditor(Widget):
+    """Excluded wells of a run imported as `IncrementalAnalysis`, hidden for other data"""
+
+    def __init__(self, root, app):
+        super().__init__({})
+        self.app = app
+
+        self._input = TextInput(title="Excluded wells", width=400)
+        self._input.on_change("value", lambda attr, old, new: self.app.set_excluded_wells(new))
+        self._message = Div(text="")
+        self._root_widget = Row(self._input, self._message, visible=False)
+        root.children.append(self._root_widget)
+
+    def show(self, analysis):
+        self._root_widget.visible = analysis is not None
+        self._message.text = ""
+        if analysis is not None:
+            self._input.value = ", ".join(sorted(analysis.excluded, key=lambda well: (well[0], int(well[1:]))))
+
+    def show_message(self, message):
+        self._message.text = message
+
 class ExcelImportWidget(Widget):
 
     def __init__(self, root, app, root_widget):
@@ -441,7 +884,7 @@ class ExcelImportWidget(Widget):
         self._button_back.on_click(root_widget.show_main)
 
         self._button = Button(label="Import", width=BUTTON_WIDTH)
-        self._button.on_click(lambda: asyncio.ensure_future(self.import_))
+        self._button.on_click(lambda: asyncio.ensure_future(self.import_()))
 
         self._button_bar = Row(self._button_back, self._button)
 
@@ -450,13 +893,10 @@ class ExcelImportWidget(Widget):
         self.well_excluder = WellExcluder(self._root_widget)
         root.children.append(self._root_widget)
 
-        self._importer = ExcelImporter()
-
     async def import_(self):
         excluded_wells = self.well_excluder.get_excluded_wells()
-        self._importer.prepare()
-        data = self._importer.import_(excluded_wells)
-        self.app.load_data(data)
+        # Excel is driven over COM, which only works from this process
+        self.app.jobs.submit(import_excel, excluded_wells, name="Excel import", on_done=self.app.load_data, thread=True)
 
 class HKSelector(Widget):
 
@@ -513,6 +953,14 @@ class CSVImportWidget(Widget):
         self._button_genes.on_click(lambda: asyncio.ensure_future(self.import_genes()))
 
         self._button_bar = Row(self._button_back, self._button_genes, self._button)
+        if app.rpc is None:
+            upload_meta = FileInput(accept=".csv", width=200)
+            upload_meta.on_change("value", lambda attr, old, new: asyncio.ensure_future(
+                self.import_genes(self.app.store_upload("layout.csv", new))))
+            upload_data = FileInput(accept=".csv", width=200)
+            upload_data.on_change("value", lambda attr, old, new: asyncio.ensure_future(
+                self.import_(self.app.store_upload("data.csv", new))))
+            self._button_bar = Row(self._button_back, Div(text="Plate layout"), upload_meta, Div(text="Data"), upload_data)
 
 
 
@@ -530,20 +978,20 @@ class CSVImportWidget(Widget):
 
         self._importer = CSVImporter()
 
-    async def import_genes(self):
-        path = await self.app._load_file_dialog()
-        print(path)
-        if path is not None and path != b"":
-            meta = self._importer.read_meta(path.decode("utf-8"))
+    async def import_genes(self, path=None):
+        path = path or await self.app._load_file_dialog()
+        if path:
+            meta = self._importer.read_meta(path)
             self.update({"genes": self._importer.genes, "samples": self._importer.samples})
 
-    async def import_(self):
+    async def import_(self, path=None):
 
         housekeeping = self.hk_selector.get_value()
         normalize = self.norm_selector.get_value()
 
         excluded_wells = self.well_excluder.get_excluded_wells()
-        path = await self.app._load_file_dialog()
-        self._importer.path_data = path.decode("utf8")
-        data = self._importer.import_(excluded_wells, housekeeping, normalize)
-        self.app.load_data(data)
+        path = path or await self.app._load_file_dialog()
+        if not path:
+            return
+        self.app.jobs.submit(analyse_csv, self._importer.path_meta, path, excluded_wells, housekeeping, normalize,
+                             name=os.path.basename(path), on_done=self.app.load_analysis)
@@ -32,6 +32,6 @@ setup(
     menqu=menqu.cli:main
     """,
     # This are the versions I tested with, but if you know what you do you can also change these for compatibility reasons
-    install_requires=["xlwings", "colr", "click", "pandas", "zmq", "bokeh", "pywebview", "selenium", "wheel", "appdirs", "requests"],
+    install_requires=["xlwings", "colr", "click", "pandas", "zmq", "bokeh", "pywebview", "selenium", "wheel", "appdirs", "requests", "openpyxl"],
     extras_require={"SVG export": []},
 )